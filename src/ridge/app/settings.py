@@ -15,6 +15,7 @@ import logging
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
 from django.templatetags.static import static
 
 from ridge.utils.helpers import is_env_var_true
@@ -188,6 +189,47 @@ DATABASES = {
     }
 }
 
+# Reuse database connections across requests from a connection pool, if psycopg 3 and its pool are installed.
+# Connections are returned to the pool after each request, sync endpoint call, indexing run and scheduled job.
+# So the pool only needs to cover the database queries running at the same time, not every worker thread
+try:
+    import psycopg_pool  # noqa: F401
+
+    DB_POOL_ENABLED = is_env_var_true("RIDGE_DB_POOL", default="true")
+except ImportError:
+    DB_POOL_ENABLED = False
+
+if DB_POOL_ENABLED:
+    DATABASES["default"]["OPTIONS"] = {
+        "pool": {
+            "min_size": int(os.getenv("RIDGE_DB_POOL_MIN_SIZE", 2)),
+            "max_size": int(os.getenv("RIDGE_DB_POOL_MAX_SIZE", 50)),
+            "timeout": float(os.getenv("RIDGE_DB_POOL_TIMEOUT", 10)),
+        }
+    }
+
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+if os.getenv("RIDGE_RATE_LIMIT_CACHE_URL") or os.getenv("RIDGE_AUTH_CACHE_URL"):
+    try:
+        import redis  # noqa: F401
+    except ImportError:
+        raise ImproperlyConfigured(
+            "Install ridge with the redis extra, via pip install 'ridge[redis]', "
+            "to use the Redis cache set by RIDGE_RATE_LIMIT_CACHE_URL or RIDGE_AUTH_CACHE_URL"
+        )
+# Share rate limit request counts across workers via a Redis server, if configured
+if os.getenv("RIDGE_RATE_LIMIT_CACHE_URL"):
+    CACHES["ratelimit"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("RIDGE_RATE_LIMIT_CACHE_URL"),
+    }
+# Share authenticated users across workers via a Redis server, if configured
+if os.getenv("RIDGE_AUTH_CACHE_URL"):
+    CACHES["auth"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("RIDGE_AUTH_CACHE_URL"),
+    }
+
 # User Settings
 AUTH_USER_MODEL = "database.RidgeUser"
 
@@ -1,9 +1,10 @@
+import asyncio
 import json
 import logging
 import os
+import uuid
 from datetime import datetime
 from enum import Enum
-from functools import wraps
 from typing import Optional
 
 import openai
@@ -13,44 +14,52 @@ from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.db import close_old_connections, connections
 from django.utils.timezone import make_aware
-from fastapi import Request, Response
+from fastapi import Response
+from fastapi.routing import APIRoute
 from starlette.authentication import (
     AuthCredentials,
     AuthenticationBackend,
     SimpleUser,
     UnauthenticatedUser,
 )
-from starlette.concurrency import run_in_threadpool
-from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.middleware.httpsredirect import HTTPSRedirectMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.requests import ClientDisconnect, HTTPConnection
-from starlette.types import ASGIApp, Receive, Scope, Send
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from ridge.database.adapters import (
     AgentAdapters,
     ClientApplicationAdapters,
     ConversationAdapters,
     ProcessLockAdapters,
+    aget_cached_auth,
     aget_or_create_user_by_phone_number,
     aget_user_by_phone_number,
     ais_user_subscribed,
+    aset_cached_auth,
+    auth_cache_key,
     delete_ratelimit_records,
     delete_user_requests,
     get_all_users,
     get_or_create_search_models,
 )
 from ridge.database.models import ClientApplication, RidgeUser, ProcessLock, Subscription
+from ridge.processor.conversation.offline.whisper import get_offline_transcriber
+from ridge.processor.conversation.utils import tokenizer_registry
 from ridge.processor.embeddings import CrossEncoderModel, EmbeddingsModel
 from ridge.routers.api_content import configure_content, configure_search
 from ridge.routers.twilio import is_twilio_enabled
 from ridge.utils import constants, state
 from ridge.utils.config import SearchType
 from ridge.utils.fs_syncer import collect_files
-from ridge.utils.helpers import is_none_or_empty, telemetry_disabled
+from ridge.utils.helpers import (
+    clean_connections,
+    is_none_or_empty,
+    telemetry_disabled,
+)
 from ridge.utils.rawconfig import FullConfig
+from ridge.utils.tracing import Span, set_trace_attributes, span_exporter, traced
 
 logger = logging.getLogger(__name__)
 
@@ -62,33 +71,30 @@ class AuthenticatedRidgeUser(SimpleUser):
         super().__init__(user.username)
 
 
-class AsyncCloseConnectionsMiddleware(BaseHTTPMiddleware):
+class AsyncCloseConnectionsMiddleware:
     """
-    Using this middleware to call close_old_connections() twice is a pretty yucky hack,
-    as it appears that run_in_threadpool (used by Starlette/FastAPI) and sync_to_async
-    (used by Django) have divergent behavior, ultimately acquiring the incorrect thread
-    in mixed sync/async which has the effect of duplicating connections.
-    We could fix the duplicate connections too if we normalized the thread behavior,
-    but at minimum we need to clean up connections in each case to prevent persistent
-    "InterfaceError: connection already closed" errors when the database connection is
-    reset via a database restart or something -- so here we are!
-    If we always use smart_sync_to_async(), this double calling isn't necessary, but
-    depending on what levels of abstraction we introduce, we might silently break the
-    assumptions. Better to be safe than sorry!
-    Attribution: https://gist.github.com/bryanhelmig/6fb091f23c1a4b7462dddce51cfaa1ca
+    Release database connections used by a http request once its response is sent.
+    Connections are returned to the connection pool, if enabled, or closed. Unusable connections are discarded.
+    Django ORM calls from async code run on the single thread shared by thread sensitive sync_to_async calls,
+    so one cleanup call on that thread releases the connections used by the request.
     """
 
-    async def dispatch(self, request, call_next):
-        await run_in_threadpool(close_old_connections)
-        await sync_to_async(close_old_connections)()
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
         try:
-            response = await call_next(request)
+            await self.app(scope, receive, send)
         finally:
             # in tests, use @override_settings(CLOSE_CONNECTIONS_AFTER_REQUEST=True)
             if getattr(settings, "CLOSE_CONNECTIONS_AFTER_REQUEST", False):
-                await run_in_threadpool(connections.close_all)
                 await sync_to_async(connections.close_all)()
-        return response
+            else:
+                await sync_to_async(close_old_connections)()
 
 
 class UserAuthenticationBackend(AuthenticationBackend):
@@ -112,9 +118,16 @@ class UserAuthenticationBackend(AuthenticationBackend):
             renewal_date = make_aware(datetime.strptime("2100-04-01", "%Y-%m-%d"))
             Subscription.objects.create(user=default_user, type=Subscription.Type.STANDARD, renewal_date=renewal_date)
 
+    @traced("auth")
     async def authenticate(self, request: HTTPConnection):
         current_user = request.session.get("user")
         if current_user and current_user.get("email"):
+            # Use cached user and scopes authenticated by the session recently
+            cache_key = auth_cache_key("session", current_user.get("email"))
+            if cached_auth := await aget_cached_auth(cache_key):
+                user, scopes = cached_auth
+                return AuthCredentials(scopes), AuthenticatedRidgeUser(user)
+
             user = (
                 await self.ridgeuser_manager.filter(email=current_user.get("email"))
                 .prefetch_related("subscription")
@@ -122,14 +135,20 @@ class UserAuthenticationBackend(AuthenticationBackend):
             )
             if user:
                 subscribed = await ais_user_subscribed(user)
-                if subscribed:
-                    return AuthCredentials(["authenticated", "premium"]), AuthenticatedRidgeUser(user)
-                return AuthCredentials(["authenticated"]), AuthenticatedRidgeUser(user)
+                scopes = ["authenticated", "premium"] if subscribed else ["authenticated"]
+                await aset_cached_auth(cache_key, user, scopes)
+                return AuthCredentials(scopes), AuthenticatedRidgeUser(user)
 
         # Request from Desktop, Emacs, Obsidian clients
         if len(request.headers.get("Authorization", "").split("Bearer ")) == 2:
             # Get bearer token from header
             bearer_token = request.headers["Authorization"].split("Bearer ")[1]
+            # Use cached user and scopes authenticated by the token recently
+            cache_key = auth_cache_key("token", bearer_token)
+            if cached_auth := await aget_cached_auth(cache_key):
+                user, scopes = cached_auth
+                return AuthCredentials(scopes), AuthenticatedRidgeUser(user)
+
             # Get user owning token
             user_with_token = (
                 await self.ridgeapiuser_manager.filter(token=bearer_token)
@@ -139,9 +158,9 @@ class UserAuthenticationBackend(AuthenticationBackend):
             )
             if user_with_token:
                 subscribed = await ais_user_subscribed(user_with_token.user)
-                if subscribed:
-                    return AuthCredentials(["authenticated", "premium"]), AuthenticatedRidgeUser(user_with_token.user)
-                return AuthCredentials(["authenticated"]), AuthenticatedRidgeUser(user_with_token.user)
+                scopes = ["authenticated", "premium"] if subscribed else ["authenticated"]
+                await aset_cached_auth(cache_key, user_with_token.user, scopes)
+                return AuthCredentials(scopes), AuthenticatedRidgeUser(user_with_token.user)
 
         # Request from Whatsapp client
         client_id = request.query_params.get("client_id")
@@ -200,26 +219,6 @@ def initialize_server(config: Optional[FullConfig]):
         raise e
 
 
-def clean_connections(func):
-    """
-    A decorator that ensures that Django database connections that have become unusable, or are obsolete, are closed
-    before and after a method is executed (see: https://docs.djangoproject.com/en/dev/ref/databases/#general-notes
-    for background).
-    """
-
-    @wraps(func)
-    def func_wrapper(*args, **kwargs):
-        close_old_connections()
-        try:
-            result = func(*args, **kwargs)
-        finally:
-            close_old_connections()
-
-        return result
-
-    return func_wrapper
-
-
 def configure_server(
     config: FullConfig,
     regenerate: bool = False,
@@ -285,6 +284,19 @@ def configure_server(
     except Exception as e:
         logger.error(f"Failed to load some search models: {e}", exc_info=True)
 
+    # Load tokenizers of the chat models upfront to not load them on the chat request path
+    try:
+        tokenizer_registry.preload(ConversationAdapters.get_conversation_processor_options())
+    except Exception as e:
+        logger.error(f"Failed to load some chat model tokenizers: {e}", exc_info=True)
+
+    # Load offline speech to text model upfront to not load it on the transcription request path
+    try:
+        if speech_to_text_config := ConversationAdapters.get_offline_speech_to_text_config():
+            get_offline_transcriber(speech_to_text_config.model_name).preload()
+    except Exception as e:
+        logger.error(f"Failed to load offline speech to text model: {e}", exc_info=True)
+
 
 def setup_default_agent(user: RidgeUser):
     AgentAdapters.create_default_agent(user)
@@ -344,27 +356,69 @@ def configure_routes(app):
         app.include_router(api_phone, prefix="/api/phone")
         logger.info("📞 Enabled Twilio")
 
+    # Sync endpoints run on threadpool threads. Release the database connections they use on the thread they ran on.
+    # Otherwise each threadpool thread holds on to a pooled connection between requests
+    for route in app.routes:
+        if isinstance(route, APIRoute) and not asyncio.iscoroutinefunction(route.dependant.call):
+            route.dependant.call = clean_connections(route.dependant.call)
+
 
 def configure_middleware(app, ssl_enabled: bool = False):
-    class NextJsMiddleware(Middleware):
+    class NextJsMiddleware:
+        def __init__(self, app: ASGIApp) -> None:
+            self.app = app
+
         async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
             if scope["type"] == "http" and scope["path"].startswith("/_next"):
                 scope["path"] = "/static" + scope["path"]
             await self.app(scope, receive, send)
 
+    class TracingMiddleware:
+        "Trace each request. Spans of the request are tagged with the request and user ids"
+
         def __init__(self, app: ASGIApp) -> None:
-            super().__init__(app)
             self.app = app
 
-    class SuppressClientDisconnectMiddleware(BaseHTTPMiddleware):
-        async def dispatch(self, request: Request, call_next):
+        async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+            if scope["type"] != "http":
+                await self.app(scope, receive, send)
+                return
+
+            request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode() or str(uuid.uuid4())
+            with Span("http_request", method=scope["method"], path=scope["path"]):
+                set_trace_attributes(request_id=request_id)
+                try:
+                    await self.app(scope, receive, send)
+                finally:
+                    user = scope.get("user")
+                    if user and user.is_authenticated and hasattr(user, "object"):
+                        set_trace_attributes(user_id=str(user.object.uuid))
+
+    class SuppressClientDisconnectMiddleware:
+        def __init__(self, app: ASGIApp) -> None:
+            self.app = app
+
+        async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+            if scope["type"] != "http":
+                await self.app(scope, receive, send)
+                return
+
+            response_started = False
+
+            async def send_wrapper(message: Message) -> None:
+                nonlocal response_started
+                if message["type"] == "http.response.start":
+                    response_started = True
+                await send(message)
+
             try:
-                return await call_next(request)
+                await self.app(scope, receive, send_wrapper)
             except ClientDisconnect:
                 logger.debug("Client disconnected before response completion.")
-                # Return a minimal response to potentially satisfy the ASGI server
+                # Send a minimal response, if none started, to potentially satisfy the ASGI server
                 # and prevent further error logging.
-                return Response(status_code=499)
+                if not response_started:
+                    await Response(status_code=499)(scope, receive, send)
 
     if ssl_enabled:
         app.add_middleware(HTTPSRedirectMiddleware)
@@ -373,6 +427,8 @@ def configure_middleware(app, ssl_enabled: bool = False):
     app.add_middleware(AuthenticationMiddleware, backend=UserAuthenticationBackend())
     app.add_middleware(NextJsMiddleware)
     app.add_middleware(SessionMiddleware, secret_key=os.environ.get("RIDGE_DJANGO_SECRET_KEY", "!secret"))
+    if span_exporter.enabled:
+        app.add_middleware(TracingMiddleware)
 
 
 def update_content_index():
@@ -1,3 +1,5 @@
+import copy
+import hashlib
 import json
 import logging
 import math
@@ -5,7 +7,6 @@ import os
 import random
 import re
 import secrets
-import sys
 from datetime import date, datetime, timedelta, timezone
 from enum import Enum
 from functools import wraps
@@ -17,15 +18,22 @@ from typing import (
     List,
     Optional,
     ParamSpec,
+    Tuple,
     TypeVar,
 )
 
 import cron_descriptor
 from apscheduler.job import Job
 from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.sessions.backends.db import SessionStore
-from django.db.models import Prefetch, Q
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import JSONField, Max, Prefetch, Q, Sum
+from django.db.models.expressions import RawSQL
 from django.db.models.manager import BaseManager
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.db.utils import IntegrityError
 from django.utils import timezone as django_timezone
 from django_apscheduler import util
@@ -40,7 +48,9 @@ from ridge.database.models import (
     ChatModel,
     ClientApplication,
     Conversation,
+    ConversationMessage,
     Entry,
+    EntryStats,
     FileObject,
     GithubConfig,
     GithubRepoConfig,
@@ -565,13 +575,88 @@ async def set_user_github_config(user: RidgeUser, pat_token: str, repos: list):
 
 
 def get_default_search_model() -> SearchModelConfig:
-    default_search_model = SearchModelConfig.objects.filter(name="default").first()
-
+    default_search_model = state.server_config_cache.get("default_search_model")
     if default_search_model:
         return default_search_model
-    elif SearchModelConfig.objects.count() == 0:
-        SearchModelConfig.objects.create()
-    return SearchModelConfig.objects.first()
+
+    default_search_model = SearchModelConfig.objects.filter(name="default").first()
+    if not default_search_model:
+        if SearchModelConfig.objects.count() == 0:
+            SearchModelConfig.objects.create()
+        default_search_model = SearchModelConfig.objects.first()
+
+    state.server_config_cache.set("default_search_model", default_search_model)
+    return default_search_model
+
+
+@receiver([post_save, post_delete], sender=Agent)
+@receiver([post_save, post_delete], sender=AiModelApi)
+@receiver([post_save, post_delete], sender=ChatModel)
+@receiver([post_save, post_delete], sender=SearchModelConfig)
+@receiver([post_save, post_delete], sender=ServerChatSettings)
+@receiver([post_save, post_delete], sender=WebScraper)
+def clear_server_config_cache(sender, **kwargs):
+    "Drop cached server configuration when it is changed, e.g via the admin panel"
+    state.server_config_cache.clear()
+
+
+def auth_cache_key(kind: str, identifier: str) -> str:
+    "Key to cache the user and scopes authenticated by a session email or API token. Hashed to not store tokens"
+    return f"auth:{kind}:{hashlib.sha256(identifier.encode()).hexdigest()}"
+
+
+def get_shared_auth_cache():
+    "Get cache shared by workers to cache authenticated users in, if configured"
+    return caches["auth"] if "auth" in settings.CACHES else None
+
+
+async def aget_cached_auth(key: str) -> Optional[Tuple[RidgeUser, List[str]]]:
+    if shared_auth_cache := get_shared_auth_cache():
+        cached_auth = await shared_auth_cache.aget(key)
+    else:
+        cached_auth = state.auth_cache.get(key)
+    if cached_auth is None:
+        return None
+    # Do not share user objects across requests
+    user, scopes = cached_auth
+    return copy.copy(user), scopes
+
+
+async def aset_cached_auth(key: str, user: RidgeUser, scopes: List[str]):
+    if shared_auth_cache := get_shared_auth_cache():
+        await shared_auth_cache.aset(key, (user, scopes), timeout=state.auth_cache.ttl)
+    else:
+        state.auth_cache.set(key, (user, scopes))
+
+
+def clear_cached_auth(keys: List[str]):
+    if shared_auth_cache := get_shared_auth_cache():
+        shared_auth_cache.delete_many(keys)
+    else:
+        for key in keys:
+            state.auth_cache.delete(key)
+
+
+@receiver([post_save, post_delete], sender=RidgeApiUser)
+def clear_token_auth_cache(sender, instance: RidgeApiUser, **kwargs):
+    "Drop cached user authenticated by an API token when the token is changed or deleted"
+    clear_cached_auth([auth_cache_key("token", instance.token)])
+
+
+@receiver([post_save, post_delete], sender=RidgeUser)
+@receiver([post_save, post_delete], sender=Subscription)
+def clear_user_auth_cache(sender, instance, **kwargs):
+    "Drop cached user and their scopes when the user or their subscription is changed"
+    if isinstance(instance, RidgeUser):
+        user_id, email = instance.id, instance.email
+    else:
+        user_id = instance.user_id
+        email = RidgeUser.objects.filter(id=user_id).values_list("email", flat=True).first()
+    tokens = RidgeApiUser.objects.filter(user_id=user_id).values_list("token", flat=True)
+    keys = [auth_cache_key("token", token) for token in tokens]
+    if email:
+        keys.append(auth_cache_key("session", email))
+    clear_cached_auth(keys)
 
 
 def get_or_create_search_models():
@@ -772,7 +857,16 @@ class AgentAdapters:
 
     @staticmethod
     def get_default_agent():
-        return Agent.objects.filter(name=AgentAdapters.DEFAULT_AGENT_NAME).first()
+        default_agent = state.server_config_cache.get("default_agent")
+        if default_agent is None:
+            default_agent = (
+                Agent.objects.filter(name=AgentAdapters.DEFAULT_AGENT_NAME)
+                .prefetch_related("chat_model", "chat_model__ai_model_api")
+                .first()
+            )
+            if default_agent:
+                state.server_config_cache.set("default_agent", default_agent)
+        return default_agent
 
     @staticmethod
     def create_default_agent(user: RidgeUser):
@@ -810,7 +904,16 @@ class AgentAdapters:
 
     @staticmethod
     async def aget_default_agent():
-        return await Agent.objects.filter(name=AgentAdapters.DEFAULT_AGENT_NAME).afirst()
+        default_agent = state.server_config_cache.get("default_agent")
+        if default_agent is None:
+            default_agent = (
+                await Agent.objects.filter(name=AgentAdapters.DEFAULT_AGENT_NAME)
+                .prefetch_related("chat_model", "chat_model__ai_model_api")
+                .afirst()
+            )
+            if default_agent:
+                state.server_config_cache.set("default_agent", default_agent)
+        return default_agent
 
     @staticmethod
     def get_agent_chat_model(agent: Agent, user: Optional[RidgeUser]) -> Optional[ChatModel]:
@@ -939,7 +1042,27 @@ class AgentAdapters:
 class PublicConversationAdapters:
     @staticmethod
     def get_public_conversation_by_slug(slug: str):
-        return PublicConversation.objects.filter(slug=slug).first()
+        # Defer loading the conversation log until it is accessed, as it can be large
+        return PublicConversation.objects.filter(slug=slug).defer("conversation_log").first()
+
+    @staticmethod
+    def get_public_conversation_log(public_conversation: PublicConversation, n: int = None) -> dict:
+        """
+        Get the conversation log of the public conversation.
+        Use n > 0 to only get the latest n chat messages, n < 0 to get all but the latest n chat messages.
+        """
+        if not n:
+            return public_conversation.conversation_log
+
+        # Slice the chat messages in the database to avoid loading the whole conversation log
+        chat_range = f"$.chat[last - {n - 1} to last]" if n > 0 else f"$.chat[0 to last - {-n}]"
+        chat = (
+            PublicConversation.objects.filter(id=public_conversation.id)
+            .annotate(chat=RawSQL("jsonb_path_query_array(conversation_log, %s::jsonpath)", (chat_range,), JSONField()))
+            .values_list("chat", flat=True)
+            .first()
+        )
+        return {"chat": chat or []}
 
     @staticmethod
     def get_public_conversation_url(public_conversation: PublicConversation):
@@ -951,13 +1074,99 @@ class PublicConversationAdapters:
         return PublicConversation.objects.filter(source_owner=user, slug=slug).first().delete()
 
 
+def get_chat_message_range(n: Optional[int], num_messages: int) -> Tuple[int, int]:
+    """
+    Get the range of chat messages to return from a conversation with num_messages messages.
+    Use n > 0 to get the latest n messages, n < 0 to get all but the latest n messages and None to get all messages.
+    """
+    if not n:
+        return 0, num_messages
+    elif n > 0:
+        return max(num_messages - n, 0), num_messages
+    else:
+        return 0, max(num_messages + n, 0)
+
+
 class ConversationAdapters:
+    server_chat_settings_relations = [
+        "chat_default",
+        "chat_default__ai_model_api",
+        "chat_advanced",
+        "chat_advanced__ai_model_api",
+        "web_scraper",
+    ]
+
+    @staticmethod
+    def get_conversation_log(conversation: Conversation, n: int = None) -> dict:
+        """
+        Get the conversation log with the legacy chat messages followed by the stored chat messages.
+        Use n > 0 to only get the latest n chat messages, n < 0 to get all but the latest n chat messages.
+        """
+        conversation_log = {key: value for key, value in conversation.conversation_log.items() if key != "chat"}
+        legacy_chat = conversation.conversation_log.get("chat", [])
+        stored_messages = ConversationMessage.objects.filter(conversation=conversation).order_by("position")
+
+        num_messages = len(legacy_chat) + stored_messages.count() if n else None
+        start, end = get_chat_message_range(n, num_messages) if n else (0, None)
+        stored_start = max(start - len(legacy_chat), 0)
+        stored_end = max(end - len(legacy_chat), stored_start) if end is not None else None
+
+        conversation_log["chat"] = legacy_chat[start:end] + [
+            message.data for message in stored_messages[stored_start:stored_end]
+        ]
+        return conversation_log
+
+    @staticmethod
+    async def aget_conversation_log(conversation: Conversation, n: int = None) -> dict:
+        """
+        Get the conversation log with the legacy chat messages followed by the stored chat messages.
+        Use n > 0 to only get the latest n chat messages, n < 0 to get all but the latest n chat messages.
+        """
+        conversation_log = {key: value for key, value in conversation.conversation_log.items() if key != "chat"}
+        legacy_chat = conversation.conversation_log.get("chat", [])
+        stored_messages = ConversationMessage.objects.filter(conversation=conversation).order_by("position")
+
+        num_messages = len(legacy_chat) + await stored_messages.acount() if n else None
+        start, end = get_chat_message_range(n, num_messages) if n else (0, None)
+        stored_start = max(start - len(legacy_chat), 0)
+        stored_end = max(end - len(legacy_chat), stored_start) if end is not None else None
+
+        conversation_log["chat"] = legacy_chat[start:end] + [
+            message.data async for message in stored_messages[stored_start:stored_end]
+        ]
+        return conversation_log
+
+    @staticmethod
+    def append_conversation_messages(conversation: Conversation, messages: List[dict], slug: str = None):
+        """
+        Append the chat messages to the conversation without rewriting its previous messages
+        """
+        with transaction.atomic():
+            # Lock the conversation to serialize appending messages to it
+            Conversation.objects.select_for_update().filter(id=conversation.id).values_list("id", flat=True).first()
+            last_position = ConversationMessage.objects.filter(conversation=conversation).aggregate(
+                last_position=Max("position")
+            )["last_position"]
+            next_position = 0 if last_position is None else last_position + 1
+            ConversationMessage.objects.bulk_create(
+                [
+                    ConversationMessage(
+                        conversation=conversation,
+                        position=next_position + index,
+                        turn_id=message.get("turnId"),
+                        data=message,
+                    )
+                    for index, message in enumerate(messages)
+                ]
+            )
+            Conversation.objects.filter(id=conversation.id).update(slug=slug, updated_at=datetime.now(tz=timezone.utc))
+
     @staticmethod
     def make_public_conversation_copy(conversation: Conversation):
         return PublicConversation.objects.create(
             source_owner=conversation.user,
             agent=conversation.agent,
-            conversation_log=conversation.conversation_log,
+            conversation_log=ConversationAdapters.get_conversation_log(conversation),
             slug=conversation.slug,
             title=conversation.title if conversation.title else conversation.slug,
         )
@@ -992,7 +1201,7 @@ class ConversationAdapters:
                 "agent": conversation.agent.name if conversation.agent else "Ridge",
                 "created_at": datetime.strftime(conversation.created_at, "%Y-%m-%d %H:%M:%S"),
                 "updated_at": datetime.strftime(conversation.updated_at, "%Y-%m-%d %H:%M:%S"),
-                "conversation_log": conversation.conversation_log,
+                "conversation_log": ConversationAdapters.get_conversation_log(conversation),
                 "file_filters": conversation.file_filters,
             }
             histories.append(history)
@@ -1111,11 +1320,14 @@ class ConversationAdapters:
 
     @staticmethod
     async def aget_vision_enabled_config():
+        vision_enabled_config = state.server_config_cache.get("vision_enabled_config", default=False)
+        if vision_enabled_config is not False:
+            return vision_enabled_config
+
         chat_models = await ConversationAdapters.aget_all_chat_models()
-        for config in chat_models:
-            if config.vision_enabled:
-                return config
-        return None
+        vision_enabled_config = next((config for config in chat_models if config.vision_enabled), None)
+        state.server_config_cache.set("vision_enabled_config", vision_enabled_config)
+        return vision_enabled_config
 
     @staticmethod
     def get_ai_model_api():
@@ -1211,11 +1423,35 @@ class ConversationAdapters:
             return voice_model_config.setting
         return VoiceModelOption.objects.first()
 
+    @staticmethod
+    def get_server_chat_settings() -> Optional[ServerChatSettings]:
+        server_chat_settings = state.server_config_cache.get("server_chat_settings", default=False)
+        if server_chat_settings is False:
+            server_chat_settings = (
+                ServerChatSettings.objects.filter()
+                .prefetch_related(*ConversationAdapters.server_chat_settings_relations)
+                .first()
+            )
+            state.server_config_cache.set("server_chat_settings", server_chat_settings)
+        return server_chat_settings
+
+    @staticmethod
+    async def aget_server_chat_settings() -> Optional[ServerChatSettings]:
+        server_chat_settings = state.server_config_cache.get("server_chat_settings", default=False)
+        if server_chat_settings is False:
+            server_chat_settings = (
+                await ServerChatSettings.objects.filter()
+                .prefetch_related(*ConversationAdapters.server_chat_settings_relations)
+                .afirst()
+            )
+            state.server_config_cache.set("server_chat_settings", server_chat_settings)
+        return server_chat_settings
+
     @staticmethod
     def get_default_chat_model(user: RidgeUser = None):
         """Get default conversation config. Prefer chat model by server admin > user > first created chat model"""
         # Get the server chat settings
-        server_chat_settings = ServerChatSettings.objects.first()
+        server_chat_settings = ConversationAdapters.get_server_chat_settings()
 
         is_subscribed = is_user_subscribed(user) if user else False
         if server_chat_settings:
@@ -1235,17 +1471,14 @@ class ConversationAdapters:
         return ChatModel.objects.filter().first()
 
     @staticmethod
-    async def aget_default_chat_model(user: RidgeUser = None, fallback_chat_model: Optional[ChatModel] = None):
+    async def aget_default_chat_model(
+        user: RidgeUser = None, fallback_chat_model: Optional[ChatModel] = None, is_subscribed: Optional[bool] = None
+    ):
         """Get default conversation config. Prefer chat model by server admin > agent > user > first created chat model"""
         # Get the server chat settings
-        server_chat_settings: ServerChatSettings = (
-            await ServerChatSettings.objects.filter()
-            .prefetch_related(
-                "chat_default", "chat_default__ai_model_api", "chat_advanced", "chat_advanced__ai_model_api"
-            )
-            .afirst()
-        )
-        is_subscribed = await ais_user_subscribed(user) if user else False
+        server_chat_settings = await ConversationAdapters.aget_server_chat_settings()
+        if is_subscribed is None:
+            is_subscribed = await ais_user_subscribed(user) if user else False
 
         if server_chat_settings:
             # If the user is subscribed and the advanced model is enabled, return the advanced model
@@ -1275,18 +1508,14 @@ class ConversationAdapters:
 
     @staticmethod
     def get_advanced_chat_model(user: RidgeUser):
-        server_chat_settings = ServerChatSettings.objects.first()
+        server_chat_settings = ConversationAdapters.get_server_chat_settings()
         if server_chat_settings is not None and server_chat_settings.chat_advanced is not None:
             return server_chat_settings.chat_advanced
         return ConversationAdapters.get_default_chat_model(user)
 
     @staticmethod
     async def aget_advanced_chat_model(user: RidgeUser = None):
-        server_chat_settings: ServerChatSettings = (
-            await ServerChatSettings.objects.filter()
-            .prefetch_related("chat_advanced", "chat_advanced__ai_model_api")
-            .afirst()
-        )
+        server_chat_settings = await ConversationAdapters.aget_server_chat_settings()
         if server_chat_settings is not None and server_chat_settings.chat_advanced is not None:
             return server_chat_settings.chat_advanced
         return await ConversationAdapters.aget_default_chat_model(user)
@@ -1302,7 +1531,7 @@ class ConversationAdapters:
 
     @staticmethod
     async def aget_server_webscraper():
-        server_chat_settings = await ServerChatSettings.objects.filter().prefetch_related("web_scraper").afirst()
+        server_chat_settings = await ConversationAdapters.aget_server_chat_settings()
         if server_chat_settings is not None and server_chat_settings.web_scraper is not None:
             return server_chat_settings.web_scraper
         return None
@@ -1372,20 +1601,25 @@ class ConversationAdapters:
         scrubbed_title = public_conversation.title if public_conversation.title else public_conversation.slug
         if scrubbed_title:
             scrubbed_title = scrubbed_title.replace("-", " ")
-        return Conversation.objects.create(
+        conversation_log = public_conversation.conversation_log
+        conversation = Conversation.objects.create(
             user=user,
-            conversation_log=public_conversation.conversation_log,
+            conversation_log={key: value for key, value in conversation_log.items() if key != "chat"},
             client=client_app,
             slug=scrubbed_title,
             title=public_conversation.title,
             agent=public_conversation.agent,
         )
+        ConversationAdapters.append_conversation_messages(
+            conversation, conversation_log.get("chat", []), scrubbed_title
+        )
+        return conversation
 
     @staticmethod
     @require_valid_user
     async def save_conversation(
         user: RidgeUser,
-        conversation_log: dict,
+        messages: List[dict],
         client_application: ClientApplication = None,
         conversation_id: str = None,
         user_message: str = None,
@@ -1400,15 +1634,10 @@ class ConversationAdapters:
                 await Conversation.objects.filter(user=user, client=client_application).order_by("-updated_at").afirst()
             )
 
-        if conversation:
-            conversation.conversation_log = conversation_log
-            conversation.slug = slug
-            conversation.updated_at = datetime.now(tz=timezone.utc)
-            await conversation.asave()
-        else:
-            await Conversation.objects.acreate(
-                user=user, conversation_log=conversation_log, client=client_application, slug=slug
-            )
+        if not conversation:
+            conversation = await Conversation.objects.acreate(user=user, client=client_application, slug=slug)
+
+        await sync_to_async(ConversationAdapters.append_conversation_messages)(conversation, messages, slug)
 
     @staticmethod
     def get_conversation_processor_options():
@@ -1433,6 +1662,10 @@ class ConversationAdapters:
     async def get_speech_to_text_config():
         return await SpeechToTextModelOptions.objects.filter().prefetch_related("ai_model_api").afirst()
 
+    @staticmethod
+    def get_offline_speech_to_text_config():
+        return SpeechToTextModelOptions.objects.filter(model_type=SpeechToTextModelOptions.ModelType.OFFLINE).first()
+
     @staticmethod
     @arequire_valid_user
     async def aget_conversation_starters(user: RidgeUser, max_results=3):
@@ -1573,13 +1806,20 @@ class ConversationAdapters:
     @require_valid_user
     def delete_message_by_turn_id(user: RidgeUser, conversation_id: str, turn_id: str):
         conversation = ConversationAdapters.get_conversation_by_user(user, conversation_id=conversation_id)
-        if not conversation or not conversation.conversation_log or not conversation.conversation_log.get("chat"):
+        if not conversation:
             return False
-        conversation_log = conversation.conversation_log
-        updated_log = [msg for msg in conversation_log["chat"] if msg.get("turnId") != turn_id]
-        conversation.conversation_log["chat"] = updated_log
-        conversation.save()
-        return True
+
+        num_deleted, _ = ConversationMessage.objects.filter(conversation=conversation, turn_id=turn_id).delete()
+
+        # Remove the turn from the legacy chat messages, if present
+        legacy_chat = conversation.conversation_log.get("chat", [])
+        updated_log = [msg for msg in legacy_chat if msg.get("turnId") != turn_id]
+        if len(updated_log) < len(legacy_chat):
+            conversation.conversation_log["chat"] = updated_log
+            conversation.save()
+            return True
+
+        return num_deleted > 0
 
 
 class FileObjectAdapters:
@@ -1796,10 +2036,43 @@ class EntryAdapters:
     @staticmethod
     @require_valid_user
     def get_size_of_indexed_data_in_mb(user: RidgeUser):
-        entries = Entry.objects.filter(user=user).iterator()
-        total_size = sum(sys.getsizeof(entry.compiled) for entry in entries)
+        total_size = EntryStats.objects.filter(user=user).aggregate(total=Sum("size_in_bytes"))["total"] or 0
         return total_size / 1024 / 1024
 
+    @staticmethod
+    @arequire_valid_user
+    async def aget_size_of_indexed_data_in_mb(user: RidgeUser):
+        total_size = (await EntryStats.objects.filter(user=user).aaggregate(total=Sum("size_in_bytes")))["total"] or 0
+        return total_size / 1024 / 1024
+
+    @staticmethod
+    @require_valid_user
+    def get_indexed_data_stats_by_file_type(user: RidgeUser) -> dict[str, dict[str, int]]:
+        return {
+            stats.file_type: {"num_entries": stats.num_entries, "size_in_bytes": stats.size_in_bytes}
+            for stats in EntryStats.objects.filter(user=user, num_entries__gt=0)
+        }
+
+    @staticmethod
+    def rebuild_entry_stats(user: RidgeUser = None) -> int:
+        "Recompute entry stats from the entry table. Blocks writes to entries while running to avoid drift."
+        user_filter = "AND user_id = %s" if user else ""
+        params = [user.id] if user else []
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {Entry._meta.db_table} IN SHARE MODE")
+            EntryStats.objects.filter(**({"user": user} if user else {})).delete()
+            cursor.execute(
+                f"""
+                INSERT INTO {EntryStats._meta.db_table} (user_id, file_type, num_entries, size_in_bytes, created_at, updated_at)
+                SELECT user_id, file_type, count(*), coalesce(sum(octet_length(compiled)), 0), now(), now()
+                FROM {Entry._meta.db_table}
+                WHERE user_id IS NOT NULL {user_filter}
+                GROUP BY user_id, file_type
+                """,
+                params,
+            )
+            return cursor.rowcount
+
     @staticmethod
     def apply_filters(user: RidgeUser, query: str, file_type_filter: str = None, agent: Agent = None):
         q_filter_terms = Q()
@@ -14,6 +14,7 @@ from django_apscheduler.jobstores import DjangoJobStore
 from django_apscheduler.models import DjangoJob, DjangoJobExecution
 from unfold import admin as unfold_admin
 
+from ridge.database.adapters import ConversationAdapters
 from ridge.database.models import (
     Agent,
     AiModelApi,
@@ -21,6 +22,7 @@ from ridge.database.models import (
     ClientApplication,
     Conversation,
     Entry,
+    EntryStats,
     GithubConfig,
     RidgeUser,
     NotionConfig,
@@ -216,6 +218,21 @@ class EntryAdmin(unfold_admin.ModelAdmin):
     ordering = ("-created_at",)
 
 
+@admin.register(EntryStats)
+class EntryStatsAdmin(unfold_admin.ModelAdmin):
+    list_display = (
+        "id",
+        "user",
+        "file_type",
+        "num_entries",
+        "size_in_bytes",
+        "updated_at",
+    )
+    search_fields = ("user__email", "user__username")
+    list_filter = ("file_type",)
+    ordering = ("-size_in_bytes",)
+
+
 @admin.register(Subscription)
 class RidgeUserSubscription(unfold_admin.ModelAdmin):
     list_display = (
@@ -317,7 +334,7 @@ class ConversationAdmin(unfold_admin.ModelAdmin):
         writer.writerow(["id", "user", "created_at", "updated_at", "conversation_log"])
 
         for conversation in queryset:
-            modified_log = conversation.conversation_log
+            modified_log = ConversationAdapters.get_conversation_log(conversation)
             chat_log = modified_log.get("chat", [])
             for idx, log in enumerate(chat_log):
                 if log["by"] == "ridge" and log["images"]:
@@ -351,7 +368,7 @@ class ConversationAdmin(unfold_admin.ModelAdmin):
 
         for conversation in queryset:
             return_log = dict()
-            chat_log = conversation.conversation_log.get("chat", [])
+            chat_log = ConversationAdapters.get_conversation_log(conversation).get("chat", [])
             for idx, log in enumerate(chat_log):
                 updated_log = {}
                 for key in fields_to_keep:
@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 from tqdm import tqdm
 
-from ridge.database.models import Conversation
+from ridge.database.models import ConversationMessage
 from ridge.utils.helpers import ImageIntentType, is_none_or_empty
 
 
@@ -37,24 +37,18 @@ class Command(BaseCommand):
 
         destination = options["source"] if options["reverse"] else options["destination"]
         source = options["destination"] if options["reverse"] else options["source"]
-        for conversation in Conversation.objects.all():
-            conversation_updated = False
-            for chat in tqdm(conversation.conversation_log.get("chat", []), desc="Processing Conversations"):
-                if (
-                    chat.get("by", "") == "ridge"
-                    and not is_none_or_empty(chat.get("message"))
-                    and chat.get("message", "").startswith(source)
-                    and chat.get("intent", {}).get("type", "") == ImageIntentType.TEXT_TO_IMAGE2.value
-                    and chat.get("message", "").endswith(".webp")
-                ):
-                    # Convert source url to destination url
-                    chat["message"] = chat["message"].replace(source, destination)
-                    conversation_updated = True
-                    updated_count += 1
-
-            if conversation_updated:
-                print(f"Save the updated conversation {conversation.id} to the database.")
-                conversation.save()
+        chat_messages = ConversationMessage.objects.filter(
+            data__by="ridge",
+            data__intent__type=ImageIntentType.TEXT_TO_IMAGE2.value,
+            data__message__startswith=source,
+        )
+        for chat_message in tqdm(chat_messages.iterator(), desc="Processing Chat Messages"):
+            chat = chat_message.data
+            if not is_none_or_empty(chat.get("message")) and chat.get("message", "").endswith(".webp"):
+                # Convert source url to destination url
+                chat["message"] = chat["message"].replace(source, destination)
+                chat_message.save(update_fields=["data", "updated_at"])
+                updated_count += 1
 
         if updated_count > 0:
             success = f"Successfully converted {updated_count} image URLs from {source} to {destination}.".strip()
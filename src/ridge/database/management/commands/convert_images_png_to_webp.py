@@ -4,7 +4,7 @@ import io
 from django.core.management.base import BaseCommand
 from PIL import Image
 
-from ridge.database.models import Conversation
+from ridge.database.models import ConversationMessage
 from ridge.utils.helpers import ImageIntentType
 
 
@@ -21,77 +21,83 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         updated_count = 0
-        for conversation in Conversation.objects.all():
-            conversation_updated = False
-            for chat in conversation.conversation_log.get("chat", []):
-                if (
-                    chat.get("by", "") == "ridge"
-                    and chat.get("intent", {}).get("type", "") == ImageIntentType.TEXT_TO_IMAGE.value
-                    and not options["reverse"]
-                ):
-                    # Decode the base64 encoded PNG image
-                    print("Decode the base64 encoded PNG image")
-                    decoded_image = base64.b64decode(chat["message"])
+        image_intent_types = [
+            ImageIntentType.TEXT_TO_IMAGE.value,
+            ImageIntentType.TEXT_TO_IMAGE2.value,
+            ImageIntentType.TEXT_TO_IMAGE_V3.value,
+        ]
+        chat_messages = ConversationMessage.objects.filter(data__by="ridge", data__intent__type__in=image_intent_types)
+        for chat_message in chat_messages.iterator():
+            chat = chat_message.data
+            message_updated = False
+            if (
+                chat.get("by", "") == "ridge"
+                and chat.get("intent", {}).get("type", "") == ImageIntentType.TEXT_TO_IMAGE.value
+                and not options["reverse"]
+            ):
+                # Decode the base64 encoded PNG image
+                print("Decode the base64 encoded PNG image")
+                decoded_image = base64.b64decode(chat["message"])
 
-                    # Convert images from PNG to WebP format
-                    print("Convert images from PNG to WebP format")
-                    image_io = io.BytesIO(decoded_image)
-                    with Image.open(image_io) as png_image:
-                        webp_image_io = io.BytesIO()
-                        png_image.save(webp_image_io, "WEBP")
+                # Convert images from PNG to WebP format
+                print("Convert images from PNG to WebP format")
+                image_io = io.BytesIO(decoded_image)
+                with Image.open(image_io) as png_image:
+                    webp_image_io = io.BytesIO()
+                    png_image.save(webp_image_io, "WEBP")
 
-                        # Encode the WebP image back to base64
-                        webp_image_bytes = webp_image_io.getvalue()
-                        chat["message"] = base64.b64encode(webp_image_bytes).decode()
-                        chat["intent"]["type"] = ImageIntentType.TEXT_TO_IMAGE_V3.value
-                        webp_image_io.close()
-                    conversation_updated = True
-                    updated_count += 1
+                    # Encode the WebP image back to base64
+                    webp_image_bytes = webp_image_io.getvalue()
+                    chat["message"] = base64.b64encode(webp_image_bytes).decode()
+                    chat["intent"]["type"] = ImageIntentType.TEXT_TO_IMAGE_V3.value
+                    webp_image_io.close()
+                message_updated = True
+                updated_count += 1
 
-                elif (
-                    chat.get("by", "") == "ridge"
-                    and chat.get("intent", {}).get("type", "") == ImageIntentType.TEXT_TO_IMAGE_V3.value
-                    and options["reverse"]
-                ):
-                    # Decode the base64 encoded WebP image
-                    print("Decode the base64 encoded WebP image")
-                    decoded_image = base64.b64decode(chat["message"])
+            elif (
+                chat.get("by", "") == "ridge"
+                and chat.get("intent", {}).get("type", "") == ImageIntentType.TEXT_TO_IMAGE_V3.value
+                and options["reverse"]
+            ):
+                # Decode the base64 encoded WebP image
+                print("Decode the base64 encoded WebP image")
+                decoded_image = base64.b64decode(chat["message"])
 
-                    # Convert images from WebP to PNG format
-                    print("Convert images from WebP to PNG format")
-                    image_io = io.BytesIO(decoded_image)
-                    with Image.open(image_io) as png_image:
-                        webp_image_io = io.BytesIO()
-                        png_image.save(webp_image_io, "PNG")
+                # Convert images from WebP to PNG format
+                print("Convert images from WebP to PNG format")
+                image_io = io.BytesIO(decoded_image)
+                with Image.open(image_io) as png_image:
+                    webp_image_io = io.BytesIO()
+                    png_image.save(webp_image_io, "PNG")
 
-                        # Encode the WebP image back to base64
-                        webp_image_bytes = webp_image_io.getvalue()
-                        chat["message"] = base64.b64encode(webp_image_bytes).decode()
-                        chat["intent"]["type"] = ImageIntentType.TEXT_TO_IMAGE.value
-                        webp_image_io.close()
-                    conversation_updated = True
-                    updated_count += 1
+                    # Encode the WebP image back to base64
+                    webp_image_bytes = webp_image_io.getvalue()
+                    chat["message"] = base64.b64encode(webp_image_bytes).decode()
+                    chat["intent"]["type"] = ImageIntentType.TEXT_TO_IMAGE.value
+                    webp_image_io.close()
+                message_updated = True
+                updated_count += 1
 
-                elif (
-                    chat.get("by", "") == "ridge"
-                    and chat.get("intent", {}).get("type", "") == ImageIntentType.TEXT_TO_IMAGE2.value
-                ):
-                    if options["reverse"] and chat.get("message", "").endswith(".webp"):
-                        # Convert WebP url to PNG url
-                        print("Convert WebP url to PNG url")
-                        chat["message"] = chat["message"].replace(".webp", ".png")
-                        conversation_updated = True
-                        updated_count += 1
-                    elif chat.get("message", "").endswith(".png"):
-                        # Convert PNG url to WebP url
-                        print("Convert PNG url to WebP url")
-                        chat["message"] = chat["message"].replace(".png", ".webp")
-                        conversation_updated = True
-                        updated_count += 1
+            elif (
+                chat.get("by", "") == "ridge"
+                and chat.get("intent", {}).get("type", "") == ImageIntentType.TEXT_TO_IMAGE2.value
+            ):
+                if options["reverse"] and chat.get("message", "").endswith(".webp"):
+                    # Convert WebP url to PNG url
+                    print("Convert WebP url to PNG url")
+                    chat["message"] = chat["message"].replace(".webp", ".png")
+                    message_updated = True
+                    updated_count += 1
+                elif chat.get("message", "").endswith(".png"):
+                    # Convert PNG url to WebP url
+                    print("Convert PNG url to WebP url")
+                    chat["message"] = chat["message"].replace(".png", ".webp")
+                    message_updated = True
+                    updated_count += 1
 
-            if conversation_updated:
-                print("Save the updated conversation")
-                conversation.save()
+            if message_updated:
+                print("Save the updated chat message")
+                chat_message.save(update_fields=["data", "updated_at"])
 
         if updated_count > 0 and options["reverse"]:
             self.stdout.write(self.style.SUCCESS(f"Successfully converted {updated_count} WebP images to PNG format."))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from ridge.database.adapters import EntryAdapters
+from ridge.database.models import EntryStats, RidgeUser
+
+
+class Command(BaseCommand):
+    help = "Recompute the per user, per file type entry count and size stats from the indexed entries."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user",
+            action="store",
+            help="Email of the user to rebuild entry stats for. Rebuilds stats for all users if not set.",
+        )
+
+    def handle(self, *args, **options):
+        user = None
+        if options.get("user"):
+            user = RidgeUser.objects.filter(email=options["user"]).first()
+            if not user:
+                self.stdout.write(self.style.ERROR(f"User with email {options['user']} not found."))
+                return
+
+        num_stats = EntryAdapters.rebuild_entry_stats(user)
+        num_users = (
+            EntryStats.objects.filter(**({"user": user} if user else {}))
+            .aggregate(num_users=Count("user", distinct=True))
+            .get("num_users")
+        )
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {num_stats} entry stats for {num_users} users."))
+        if user:
+            for file_type, stats in EntryAdapters.get_indexed_data_stats_by_file_type(user).items():
+                self.stdout.write(
+                    f"{file_type}: {stats['num_entries']} entries, {stats['size_in_bytes'] / 1024 / 1024:.2f} MB"
+                )
@@ -0,0 +1,121 @@
+# Generated by Django 5.1.8 on 2025-04-25 10:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Statement level triggers keep the entry stats in sync with the entry table within the same transaction.
+# Transition tables let a bulk insert or delete of entries update the stats with a single aggregate query.
+create_entry_stats_triggers = """
+CREATE OR REPLACE FUNCTION database_entry_stats_sync() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE database_entrystats AS stats
+        SET num_entries = stats.num_entries - removed.num_entries,
+            size_in_bytes = stats.size_in_bytes - removed.size_in_bytes,
+            updated_at = now()
+        FROM (
+            SELECT user_id, file_type, count(*) AS num_entries, coalesce(sum(octet_length(compiled)), 0) AS size_in_bytes
+            FROM old_entries
+            WHERE user_id IS NOT NULL
+            GROUP BY user_id, file_type
+        ) AS removed
+        WHERE stats.user_id = removed.user_id AND stats.file_type = removed.file_type;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO database_entrystats (user_id, file_type, num_entries, size_in_bytes, created_at, updated_at)
+        SELECT user_id, file_type, count(*), coalesce(sum(octet_length(compiled)), 0), now(), now()
+        FROM new_entries
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id, file_type
+        ON CONFLICT (user_id, file_type) DO UPDATE
+        SET num_entries = database_entrystats.num_entries + EXCLUDED.num_entries,
+            size_in_bytes = database_entrystats.size_in_bytes + EXCLUDED.size_in_bytes,
+            updated_at = now();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER database_entry_stats_on_insert
+AFTER INSERT ON database_entry
+REFERENCING NEW TABLE AS new_entries
+FOR EACH STATEMENT EXECUTE FUNCTION database_entry_stats_sync();
+
+CREATE TRIGGER database_entry_stats_on_update
+AFTER UPDATE ON database_entry
+REFERENCING OLD TABLE AS old_entries NEW TABLE AS new_entries
+FOR EACH STATEMENT EXECUTE FUNCTION database_entry_stats_sync();
+
+CREATE TRIGGER database_entry_stats_on_delete
+AFTER DELETE ON database_entry
+REFERENCING OLD TABLE AS old_entries
+FOR EACH STATEMENT EXECUTE FUNCTION database_entry_stats_sync();
+"""
+
+drop_entry_stats_triggers = """
+DROP TRIGGER IF EXISTS database_entry_stats_on_insert ON database_entry;
+DROP TRIGGER IF EXISTS database_entry_stats_on_update ON database_entry;
+DROP TRIGGER IF EXISTS database_entry_stats_on_delete ON database_entry;
+DROP FUNCTION IF EXISTS database_entry_stats_sync();
+"""
+
+backfill_entry_stats = """
+INSERT INTO database_entrystats (user_id, file_type, num_entries, size_in_bytes, created_at, updated_at)
+SELECT user_id, file_type, count(*), coalesce(sum(octet_length(compiled)), 0), now(), now()
+FROM database_entry
+WHERE user_id IS NOT NULL
+GROUP BY user_id, file_type;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("database", "0089_chatmodel_price_tier_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EntryStats",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "file_type",
+                    models.CharField(
+                        choices=[
+                            ("image", "Image"),
+                            ("pdf", "Pdf"),
+                            ("plaintext", "Plaintext"),
+                            ("markdown", "Markdown"),
+                            ("org", "Org"),
+                            ("notion", "Notion"),
+                            ("github", "Github"),
+                            ("conversation", "Conversation"),
+                            ("docx", "Docx"),
+                        ],
+                        default="plaintext",
+                        max_length=30,
+                    ),
+                ),
+                ("num_entries", models.BigIntegerField(default=0)),
+                ("size_in_bytes", models.BigIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="entry_stats",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(fields=("user", "file_type"), name="unique_entry_stats_per_user_file_type")
+                ],
+            },
+        ),
+        migrations.RunSQL(create_entry_stats_triggers, reverse_sql=drop_entry_stats_triggers),
+        migrations.RunSQL(backfill_entry_stats, reverse_sql=migrations.RunSQL.noop),
+    ]
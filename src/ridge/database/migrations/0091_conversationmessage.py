@@ -0,0 +1,70 @@
+# Generated by Django 5.1.8 on 2025-04-28 09:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Move the chat messages of each conversation log into its own row, in order.
+# The chat messages are then removed from the conversation log to not store them twice.
+backfill_conversation_messages = """
+INSERT INTO database_conversationmessage (conversation_id, position, turn_id, data, created_at, updated_at)
+SELECT conversation.id, message.position - 1, message.data->>'turnId', message.data, now(), now()
+FROM database_conversation AS conversation
+CROSS JOIN LATERAL jsonb_array_elements(conversation.conversation_log->'chat') WITH ORDINALITY AS message(data, position)
+WHERE jsonb_typeof(conversation.conversation_log->'chat') = 'array';
+
+UPDATE database_conversation
+SET conversation_log = conversation_log - 'chat'
+WHERE conversation_log ? 'chat';
+"""
+
+restore_conversation_logs = """
+UPDATE database_conversation AS conversation
+SET conversation_log = jsonb_set(
+    coalesce(conversation.conversation_log, '{}'::jsonb),
+    '{chat}',
+    coalesce(conversation.conversation_log->'chat', '[]'::jsonb) || messages.chat
+)
+FROM (
+    SELECT conversation_id, jsonb_agg(data ORDER BY position) AS chat
+    FROM database_conversationmessage
+    GROUP BY conversation_id
+) AS messages
+WHERE conversation.id = messages.conversation_id;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("database", "0090_entrystats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ConversationMessage",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("position", models.PositiveIntegerField()),
+                ("turn_id", models.CharField(blank=True, default=None, max_length=200, null=True)),
+                ("data", models.JSONField(default=dict)),
+                (
+                    "conversation",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="chat_messages",
+                        to="database.conversation",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["conversation", "turn_id"], name="conversation_message_turn_idx")],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("conversation", "position"), name="unique_conversation_message_position"
+                    )
+                ],
+            },
+        ),
+        migrations.RunSQL(backfill_conversation_messages, reverse_sql=restore_conversation_logs),
+    ]
@@ -643,7 +643,8 @@ class Conversation(DbBaseModel):
     def messages(self) -> List[ChatMessage]:
         """Type-hinted accessor for conversation messages"""
         validated_messages = []
-        for msg in self.conversation_log.get("chat", []):
+        stored_messages = [message.data for message in self.chat_messages.order_by("position")]
+        for msg in self.conversation_log.get("chat", []) + stored_messages:
             try:
                 # Clean up inferred queries if they contain None
                 if msg.get("intent") and msg["intent"].get("inferred-queries"):
@@ -658,6 +659,25 @@ class Conversation(DbBaseModel):
         return validated_messages
 
 
+class ConversationMessage(DbBaseModel):
+    """
+    A chat message in a conversation. Messages are only appended, to avoid rewriting the whole conversation per turn.
+
+    Messages in the legacy Conversation.conversation_log["chat"] precede the stored messages.
+    """
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="chat_messages")
+    position = models.PositiveIntegerField()
+    turn_id = models.CharField(max_length=200, default=None, null=True, blank=True)
+    data = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["conversation", "position"], name="unique_conversation_message_position")
+        ]
+        indexes = [models.Index(fields=["conversation", "turn_id"], name="conversation_message_turn_idx")]
+
+
 class PublicConversation(DbBaseModel):
     source_owner = models.ForeignKey(RidgeUser, on_delete=models.CASCADE)
     conversation_log = models.JSONField(default=dict)
@@ -739,6 +759,26 @@ class Entry(DbBaseModel):
             raise ValidationError("An Entry cannot be associated with both a user and an agent.")
 
 
+class EntryStats(DbBaseModel):
+    """
+    Running count and size of a user's indexed entries per file type.
+    Kept in sync with the Entry table by database triggers. Rebuild with the rebuild_entry_stats command.
+    """
+
+    user = models.ForeignKey(RidgeUser, on_delete=models.CASCADE, related_name="entry_stats")
+    file_type = models.CharField(max_length=30, choices=Entry.EntryType.choices, default=Entry.EntryType.PLAINTEXT)
+    num_entries = models.BigIntegerField(default=0)
+    size_in_bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "file_type"], name="unique_entry_stats_per_user_file_type"),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.file_type}: {self.num_entries} entries, {self.size_in_bytes} bytes"
+
+
 class EntryDates(DbBaseModel):
     date = models.DateField()
     entry = models.ForeignKey(Entry, on_delete=models.CASCADE, related_name="embeddings_dates")
@@ -193,6 +193,11 @@ def run(should_start_server=True):
     # Configure Middleware
     configure_middleware(app, state.ssl_config)
 
+    # Share pooled HTTP client connections to external services while the server runs
+    app.router.on_startup.append(state.http_client_pool.open)
+    app.router.on_shutdown.append(state.http_client_pool.close)
+    app.router.on_shutdown.append(state.rate_limiter.aflush)
+
     initialize_server(args.config)
 
     # If the server is started through gunicorn (external to the script), don't start the server
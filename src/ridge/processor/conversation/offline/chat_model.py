@@ -4,7 +4,7 @@ import os
 from datetime import datetime, timedelta
 from threading import Thread
 from time import perf_counter
-from typing import Any, AsyncGenerator, Dict, List, Optional, Union
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Union
 
 import pyjson5
 from langchain.schema import ChatMessage
@@ -12,6 +12,10 @@ from llama_cpp import Llama
 
 from ridge.database.models import Agent, ChatModel, RidgeUser
 from ridge.processor.conversation import prompts
+from ridge.processor.conversation.offline.scheduler import (
+    OfflineChatCancelled,
+    get_offline_chat_scheduler,
+)
 from ridge.processor.conversation.offline.utils import download_model
 from ridge.processor.conversation.utils import (
     clean_json,
@@ -19,7 +23,6 @@ from ridge.processor.conversation.utils import (
     generate_chatml_messages_with_context,
     messages_to_print,
 )
-from ridge.utils import state
 from ridge.utils.constants import empty_escape_sequences
 from ridge.utils.helpers import (
     ConversationCommand,
@@ -99,19 +102,15 @@ def extract_questions_offline(
         query_files=query_files,
     )
 
-    state.chat_lock.acquire()
-    try:
-        response = send_message_to_model_offline(
-            messages,
-            loaded_model=offline_chat_model,
-            model_name=model,
-            max_prompt_size=max_prompt_size,
-            temperature=temperature,
-            response_type="json_object",
-            tracer=tracer,
-        )
-    finally:
-        state.chat_lock.release()
+    response = send_message_to_model_offline(
+        messages,
+        loaded_model=offline_chat_model,
+        model_name=model,
+        max_prompt_size=max_prompt_size,
+        temperature=temperature,
+        response_type="json_object",
+        tracer=tracer,
+    )
 
     # Extract and clean the chat model's response
     try:
@@ -166,10 +165,12 @@ async def converse_offline(
     generated_files: List[FileAttachment] = None,
     additional_context: List[str] = None,
     generated_asset_results: Dict[str, Dict] = {},
+    cancelled: Optional[Callable[[], bool]] = None,
     tracer: dict = {},
 ) -> AsyncGenerator[str, None]:
     """
-    Converse with user using Llama (Async Version)
+    Converse with user using Llama (Async Version).
+    Stop generating the response once cancelled, e.g when the client disconnects.
     """
     # Initialize Variables
     assert loaded_model is None or isinstance(loaded_model, Llama), "loaded_model must be of type Llama, if configured"
@@ -249,6 +250,7 @@ async def converse_offline(
 
     # Use asyncio.Queue and a thread to bridge sync iterator
     queue: asyncio.Queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
     stop_phrases = ["<s>", "INST]", "Notes:"]
     aggregated_response_container = {"response": ""}
 
@@ -256,31 +258,32 @@ async def converse_offline(
         """Synchronous function to run in a separate thread."""
         aggregated_response = ""
         start_time = perf_counter()
-        state.chat_lock.acquire()
+        response_iterator = None
         try:
-            response_iterator = send_message_to_model_offline(
-                messages,
-                loaded_model=offline_chat_model,
-                stop=stop_phrases,
-                max_prompt_size=max_prompt_size,
-                streaming=True,
-                tracer=tracer,
-            )
-            for response in response_iterator:
-                response_delta = response["choices"][0]["delta"].get("content", "")
-                # Log the time taken to start response
-                if aggregated_response == "" and response_delta != "":
-                    logger.info(f"First response took: {perf_counter() - start_time:.3f} seconds")
-                # Handle response chunk
-                aggregated_response += response_delta
-                # Put chunk into the asyncio queue (non-blocking)
-                try:
-                    queue.put_nowait(response_delta)
-                except asyncio.QueueFull:
-                    # Should not happen with default queue size unless consumer is very slow
-                    logger.warning("Asyncio queue full during offline LLM streaming.")
-                    # Potentially block here or handle differently if needed
-                    asyncio.run(queue.put(response_delta))
+            # Wait for a free instance of the chat model to generate the response with
+            with get_offline_chat_scheduler(offline_chat_model).acquire(cancelled) as chat_model_instance:
+                response_iterator = send_message_to_model_offline(
+                    messages,
+                    loaded_model=chat_model_instance,
+                    stop=stop_phrases,
+                    max_prompt_size=max_prompt_size,
+                    streaming=True,
+                    tracer=tracer,
+                )
+                for response in response_iterator:
+                    # Free the chat model for other requests once the client disconnects
+                    if cancelled and cancelled():
+                        logger.info("Stopped offline chat response generation as request was cancelled")
+                        break
+                    response_delta = response["choices"][0]["delta"].get("content", "")
+                    # Log the time taken to start response
+                    if aggregated_response == "" and response_delta != "":
+                        logger.info(f"First response took: {perf_counter() - start_time:.3f} seconds")
+                    # Handle response chunk
+                    aggregated_response += response_delta
+                    # Put chunk into the asyncio queue from this thread
+                    loop.call_soon_threadsafe(queue.put_nowait, response_delta)
+                response_iterator.close()
 
             # Log the time taken to stream the entire response
             logger.info(f"Chat streaming took: {perf_counter() - start_time:.3f} seconds")
@@ -290,12 +293,13 @@ async def converse_offline(
             if is_promptrace_enabled():
                 commit_conversation_trace(messages, aggregated_response, tracer)
 
+        except OfflineChatCancelled:
+            logger.info("Offline chat request cancelled while waiting for chat model")
         except Exception as e:
             logger.error(f"Error in offline LLM thread: {e}", exc_info=True)
         finally:
-            state.chat_lock.release()
             # Signal end of stream
-            queue.put_nowait(None)
+            loop.call_soon_threadsafe(queue.put_nowait, None)
             aggregated_response_container["response"] = aggregated_response
 
     # Start the synchronous thread
@@ -312,7 +316,6 @@ async def converse_offline(
         queue.task_done()
 
     # Wait for the thread to finish (optional, ensures cleanup)
-    loop = asyncio.get_running_loop()
     await loop.run_in_executor(None, thread.join)
 
     # Call the completion function after streaming is done
@@ -331,21 +334,26 @@ def send_message_to_model_offline(
     response_type: str = "text",
     tracer: dict = {},
 ):
+    """
+    Send messages to offline chat model. Non-streaming requests wait for a free instance of the chat model.
+    Streaming requests need to be scheduled by the calling function, as the model is in use until the response is consumed.
+    """
     assert loaded_model is None or isinstance(loaded_model, Llama), "loaded_model must be of type Llama, if configured"
     offline_chat_model = loaded_model or download_model(model_name, max_tokens=max_prompt_size)
     messages_dict = [{"role": message.role, "content": message.content} for message in messages]
     seed = int(os.getenv("RIDGE_LLM_SEED")) if os.getenv("RIDGE_LLM_SEED") else None
-    response = offline_chat_model.create_chat_completion(
-        messages_dict,
-        stop=stop,
-        stream=streaming,
-        temperature=temperature,
-        response_format={"type": response_type},
-        seed=seed,
-    )
+    completion_kwargs = {
+        "stop": stop,
+        "temperature": temperature,
+        "response_format": {"type": response_type},
+        "seed": seed,
+    }
 
     if streaming:
-        return response
+        return offline_chat_model.create_chat_completion(messages_dict, stream=True, **completion_kwargs)
+
+    with get_offline_chat_scheduler(offline_chat_model).acquire() as chat_model_instance:
+        response = chat_model_instance.create_chat_completion(messages_dict, stream=False, **completion_kwargs)
 
     response_text = response["choices"][0]["message"].get("content", "")
 
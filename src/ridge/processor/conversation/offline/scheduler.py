@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+from weakref import WeakKeyDictionary
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineChatCancelled(Exception):
+    """Offline chat request was cancelled while waiting for a chat model instance"""
+
+
+class OfflineChatScheduler:
+    """
+    Schedule offline chat requests across the loaded instances of an offline chat model.
+    Each instance runs one request at a time. Waiting requests are served first come, first served.
+    """
+
+    def __init__(self, models: List[Any]):
+        self.models = list(models)
+        self._idle_models = list(models)
+        self._waiting: deque = deque()
+        self._condition = threading.Condition()
+        self.requests = 0
+        self.cancelled_requests = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def busy_instances(self) -> int:
+        return len(self.models) - len(self._idle_models)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "instances": len(self.models),
+            "busy_instances": self.busy_instances,
+            "queue_depth": self.queue_depth,
+            "requests": self.requests,
+            "cancelled_requests": self.cancelled_requests,
+            "average_wait_time": self.total_wait_time / self.requests if self.requests else 0.0,
+            "max_wait_time": self.max_wait_time,
+        }
+
+    @contextmanager
+    def acquire(self, cancelled: Optional[Callable[[], bool]] = None):
+        """
+        Wait for a free chat model instance to run the request on.
+        Stop waiting with OfflineChatCancelled if the request is cancelled, e.g when the client disconnects.
+        """
+        ticket = object()
+        start_time = time.perf_counter()
+        with self._condition:
+            self._waiting.append(ticket)
+            try:
+                while self._waiting[0] is not ticket or not self._idle_models:
+                    if cancelled and cancelled():
+                        self.cancelled_requests += 1
+                        raise OfflineChatCancelled("Offline chat request cancelled while waiting for chat model")
+                    self._condition.wait(timeout=0.5)
+                model = self._idle_models.pop()
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+            wait_time = time.perf_counter() - start_time
+            self.requests += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            queue_depth = self.queue_depth
+
+        if wait_time > 0.1:
+            logger.info(
+                f"Offline chat request waited {wait_time:.3f} seconds for chat model. Queue depth: {queue_depth}"
+            )
+        try:
+            yield model
+        finally:
+            with self._condition:
+                self._idle_models.append(model)
+                self._condition.notify_all()
+
+
+# Schedulers of the loaded offline chat models, by the chat model instance passed to the chat actors
+offline_chat_schedulers: WeakKeyDictionary = WeakKeyDictionary()
+offline_chat_schedulers_lock = threading.Lock()
+
+
+def get_offline_chat_scheduler(model) -> OfflineChatScheduler:
+    "Get scheduler of the offline chat model. Models loaded without a scheduler get one with a single instance"
+    with offline_chat_schedulers_lock:
+        if model not in offline_chat_schedulers:
+            offline_chat_schedulers[model] = OfflineChatScheduler([model])
+        return offline_chat_schedulers[model]
+
+
+def set_offline_chat_scheduler(model, scheduler: OfflineChatScheduler):
+    with offline_chat_schedulers_lock:
+        offline_chat_schedulers[model] = scheduler
@@ -1,21 +1,52 @@
+import fnmatch
 import glob
 import logging
 import math
 import os
-from typing import Any, Dict
+import struct
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
 
 from huggingface_hub.constants import HF_HUB_CACHE
+from llama_cpp.llama_cache import BaseLlamaCache, LlamaDiskCache, LlamaRAMCache
 
 from ridge.utils import state
 from ridge.utils.helpers import get_device_memory
 
 logger = logging.getLogger(__name__)
 
+# Cache model state after evaluating prompts in RAM or on disk to reuse it for prompts with the same prefix
+PROMPT_CACHE = os.getenv("RIDGE_OFFLINE_CHAT_PROMPT_CACHE", "ram").lower()
+PROMPT_CACHE_SIZE = int(os.getenv("RIDGE_OFFLINE_CHAT_PROMPT_CACHE_SIZE", 2 << 30))
+PROMPT_CACHE_DIR = os.getenv("RIDGE_OFFLINE_CHAT_PROMPT_CACHE_DIR", os.path.expanduser("~/.cache/ridge/prompt_cache"))
+
 
 def download_model(repo_id: str, filename: str = "*Q4_K_M.gguf", max_tokens: int = None):
+    from llama_cpp.llama import Llama
+
+    start_time = time.perf_counter()
+    load_status = state.offline_chat_load_status
+    load_status.update({"model": repo_id, "error": None})
+
+    # Check if the model is already downloaded
+    model_path = load_model_from_cache(repo_id, filename)
+    downloaded = model_path is None
+    if downloaded:
+        load_status["status"] = "downloading"
+        model_path = download_model_file(repo_id, filename)
+
+    # Read model parameters from the model file header to only load the model weights once
+    metadata = read_gguf_metadata(model_path)
+    model_context_window = get_model_context_window(metadata)
+
     # Initialize Model Parameters
-    # Use n_ctx=0 to get context size from the model
-    kwargs: Dict[str, Any] = {"n_threads": 4, "n_ctx": 0, "verbose": False}
+    # Set context size based on:
+    # 1. context size supported by model and
+    # 2. configured size or machine (V)RAM
+    # Use n_ctx=0 to get context size from the model if it is not in the model metadata
+    kwargs: Dict[str, Any] = {"n_threads": 4, "verbose": False}
+    kwargs["n_ctx"] = infer_max_tokens(model_context_window, max_tokens) if model_context_window else 0
 
     # Decide whether to load model to GPU or CPU
     device = "gpu" if state.chat_on_gpu and state.device != "cpu" else "cpu"
@@ -26,36 +57,116 @@ def download_model(repo_id: str, filename: str = "*Q4_K_M.gguf", max_tokens: int
         kwargs["chat_format"] = "llama-3"
     elif "gemma-2" in repo_id.lower():
         kwargs["chat_format"] = "gemma"
+    elif chat_format := guess_chat_format(metadata):
+        kwargs["chat_format"] = chat_format
 
-    # Check if the model is already downloaded
-    model_path = load_model_from_cache(repo_id, filename)
-    chat_model = None
+    load_status["status"] = "loading"
     try:
-        chat_model = load_model(model_path, repo_id, filename, kwargs)
-    except:
-        # Load model on CPU if GPU is not available
-        kwargs["n_gpu_layers"], device = 0, "cpu"
-        chat_model = load_model(model_path, repo_id, filename, kwargs)
+        try:
+            chat_model = Llama(model_path, **kwargs)
+        except Exception:
+            if kwargs["n_gpu_layers"] == 0:
+                raise
+            # Load model on CPU if GPU is not available
+            kwargs["n_gpu_layers"], device = 0, "cpu"
+            chat_model = Llama(model_path, **kwargs)
 
-    # Now load the model with context size set based on:
-    # 1. context size supported by model and
-    # 2. configured size or machine (V)RAM
-    kwargs["n_ctx"] = infer_max_tokens(chat_model.n_ctx(), max_tokens)
-    chat_model = load_model(model_path, repo_id, filename, kwargs)
+        # Reload model with a smaller context size if the context size read from the model does not fit
+        # the configured size or machine (V)RAM. Only happens when the context size is not in the model metadata
+        n_ctx = infer_max_tokens(chat_model.n_ctx(), max_tokens)
+        if not model_context_window and n_ctx < chat_model.n_ctx():
+            chat_model.close()
+            kwargs["n_ctx"] = n_ctx
+            chat_model = Llama(model_path, **kwargs)
+    except Exception as e:
+        load_status.update({"status": "failed", "error": str(e)})
+        raise
+
+    # Reuse evaluated prompt prefixes, like the system prompt and conversation history, across chat requests
+    if prompt_cache := get_prompt_cache(repo_id, chat_model.n_ctx()):
+        chat_model.set_cache(prompt_cache)
 
+    load_status.update({"status": "ready", "load_time": time.perf_counter() - start_time})
     logger.debug(
-        f"{'Loaded' if model_path else 'Downloaded'} chat model to {device.upper()} with {kwargs['n_ctx']} token context window."
+        f"{'Downloaded' if downloaded else 'Loaded'} chat model to {device.upper()} with {chat_model.n_ctx()} token context window."
     )
     return chat_model
 
 
-def load_model(model_path: str, repo_id: str, filename: str = "*Q4_K_M.gguf", kwargs: dict = {}):
-    from llama_cpp.llama import Llama
+class LlamaStateRAMCache(LlamaRAMCache):
+    """
+    Cache of model states in RAM. Counts the logits of each model state towards the cache capacity.
+    The logits of a state can take hundreds of megabytes, much more than the llama.cpp state itself.
+    """
 
-    if model_path:
-        return Llama(model_path, **kwargs)
-    else:
-        return Llama.from_pretrained(repo_id=repo_id, filename=filename, **kwargs)
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size + state.scores.nbytes for state in self.cache_state.values())
+
+
+class PromptCache(BaseLlamaCache):
+    """
+    Thread safe cache of model states by the prompt tokens evaluated to reach them.
+    Shared by the instances of an offline chat model to skip evaluating the longest cached prefix of each prompt.
+    """
+
+    def __init__(self, cache: BaseLlamaCache):
+        super().__init__(cache.capacity_bytes)
+        self.cache = cache
+        self._lock = threading.Lock()
+
+    @property
+    def cache_size(self) -> int:
+        with self._lock:
+            return self.cache.cache_size
+
+    def _find_longest_prefix_key(self, key: Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+        with self._lock:
+            return self.cache._find_longest_prefix_key(key)
+
+    def __getitem__(self, key: Sequence[int]):
+        with self._lock:
+            return self.cache[key]
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self._lock:
+            return key in self.cache
+
+    def __setitem__(self, key: Sequence[int], value):
+        with self._lock:
+            self.cache[key] = value
+
+
+# Prompt caches of the loaded offline chat models, by model and context size
+prompt_caches: Dict[Tuple[str, int], PromptCache] = {}
+prompt_caches_lock = threading.Lock()
+
+
+def get_prompt_cache(repo_id: str, n_ctx: int) -> Optional[PromptCache]:
+    "Get prompt cache shared by instances of the offline chat model with the same context size"
+    if PROMPT_CACHE not in ["ram", "disk"]:
+        return None
+
+    with prompt_caches_lock:
+        if (repo_id, n_ctx) not in prompt_caches:
+            cache: BaseLlamaCache
+            if PROMPT_CACHE == "disk":
+                cache_dir = os.path.join(PROMPT_CACHE_DIR, f"{repo_id.replace('/', '--')}-{n_ctx}")
+                cache = LlamaDiskCache(cache_dir, capacity_bytes=PROMPT_CACHE_SIZE)
+            else:
+                cache = LlamaStateRAMCache(capacity_bytes=PROMPT_CACHE_SIZE)
+            prompt_caches[(repo_id, n_ctx)] = PromptCache(cache)
+        return prompt_caches[(repo_id, n_ctx)]
+
+
+def download_model_file(repo_id: str, filename: str = "*Q4_K_M.gguf") -> str:
+    "Download first model file matching the filename pattern from the Hugging Face repository"
+    from huggingface_hub import HfApi, hf_hub_download
+
+    matching_files = sorted(fnmatch.filter(HfApi().list_repo_files(repo_id), filename))
+    if not matching_files:
+        raise ValueError(f"No file matching {filename} found in {repo_id}")
+    return hf_hub_download(repo_id=repo_id, filename=matching_files[0])
 
 
 def load_model_from_cache(repo_id: str, filename: str, repo_type="models"):
@@ -78,3 +189,76 @@ def infer_max_tokens(model_context_window: int, configured_max_tokens=None) -> i
     vram_based_n_ctx = int(get_device_memory() / 1e6)  # based on heuristic
     configured_max_tokens = configured_max_tokens or math.inf  # do not use if set to None
     return min(configured_max_tokens, vram_based_n_ctx, model_context_window)
+
+
+# Struct format of the fixed size GGUF metadata value types
+GGUF_STRING, GGUF_ARRAY = 8, 9
+gguf_value_formats = {
+    0: "<B",
+    1: "<b",
+    2: "<H",
+    3: "<h",
+    4: "<I",
+    5: "<i",
+    6: "<f",
+    7: "<?",
+    10: "<Q",
+    11: "<q",
+    12: "<d",
+}
+
+
+def read_gguf_metadata(model_path: str) -> Dict[str, Any]:
+    """
+    Read metadata from the header of a GGUF model file without loading the model weights.
+    Array values, like the model vocabulary, are skipped.
+    """
+    with open(model_path, "rb") as model_file:
+
+        def read(fmt: str):
+            return struct.unpack(fmt, model_file.read(struct.calcsize(fmt)))[0]
+
+        def read_string() -> str:
+            return model_file.read(read("<Q")).decode("utf-8", errors="replace")
+
+        def skip_value(value_type: int):
+            if value_type == GGUF_STRING:
+                model_file.seek(read("<Q"), os.SEEK_CUR)
+            elif value_type == GGUF_ARRAY:
+                item_type, item_count = read("<I"), read("<Q")
+                if item_type in gguf_value_formats:
+                    model_file.seek(item_count * struct.calcsize(gguf_value_formats[item_type]), os.SEEK_CUR)
+                else:
+                    for _ in range(item_count):
+                        skip_value(item_type)
+            else:
+                model_file.seek(struct.calcsize(gguf_value_formats[value_type]), os.SEEK_CUR)
+
+        if model_file.read(4) != b"GGUF":
+            raise ValueError(f"{model_path} is not a GGUF model file")
+        if (version := read("<I")) < 2:
+            raise ValueError(f"Unsupported GGUF version {version} of model file {model_path}")
+        _, metadata_count = read("<Q"), read("<Q")
+
+        metadata: Dict[str, Any] = {}
+        for _ in range(metadata_count):
+            key, value_type = read_string(), read("<I")
+            if value_type == GGUF_STRING:
+                metadata[key] = read_string()
+            elif value_type in gguf_value_formats:
+                metadata[key] = read(gguf_value_formats[value_type])
+            else:
+                skip_value(value_type)
+    return metadata
+
+
+def get_model_context_window(metadata: Dict[str, Any]) -> Optional[int]:
+    "Get context window the model was trained with from its GGUF metadata"
+    return metadata.get(f"{metadata.get('general.architecture')}.context_length")
+
+
+def guess_chat_format(metadata: Dict[str, Any]) -> Optional[str]:
+    "Guess chat format from the chat template in the GGUF metadata. Llama uses the chat template as is if unknown"
+    from llama_cpp.llama_chat_format import guess_chat_format_from_gguf_metadata
+
+    return guess_chat_format_from_gguf_metadata(metadata)
@@ -1,15 +1,171 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Dict, List, Tuple
+
+import numpy as np
 import whisper
-from asgiref.sync import sync_to_async
 
-from ridge.utils import state
+from ridge.utils.helpers import timer
+
+logger = logging.getLogger(__name__)
+
+# Number of whisper model instances to transcribe speech segments with in parallel
+TRANSCRIBE_WORKERS = int(os.getenv("RIDGE_OFFLINE_TRANSCRIBE_WORKERS", 1))
+
+
+def detect_speech_segments(
+    audio: np.ndarray,
+    sample_rate: int = whisper.audio.SAMPLE_RATE,
+    frame_duration: float = 0.03,
+    min_silence_duration: float = 0.5,
+    padding_duration: float = 0.2,
+    max_segment_duration: float = 30.0,
+    min_energy: float = 0.003,
+) -> List[Tuple[int, int]]:
+    """
+    Detect segments of speech in audio using the energy of short audio frames.
+    Segments are split at pauses in speech and, if longer than whisper's 30 second window, at their quietest frame.
+    Returns start and end sample index of each speech segment.
+    """
+    frame_size = int(sample_rate * frame_duration)
+    num_frames = len(audio) // frame_size
+    if num_frames == 0:
+        return [(0, len(audio))] if len(audio) > 0 else []
+
+    # Mark frames louder than the background noise of the recording as speech.
+    # Cap the threshold below the loud frames for recordings with little to no silence
+    frames = audio[: num_frames * frame_size].reshape(num_frames, frame_size)
+    energy = np.sqrt(np.mean(frames**2, axis=1))
+    noise_floor, speech_level = np.percentile(energy, [10, 90])
+    threshold = max(min_energy, min(3 * noise_floor, 0.2 * speech_level))
+    speech_frames = np.flatnonzero(energy > threshold)
+
+    # Merge speech frames separated by pauses shorter than the min silence duration into segments
+    min_silence_frames = int(min_silence_duration / frame_duration)
+    segments: List[List[int]] = []
+    for frame in speech_frames:
+        if segments and frame - segments[-1][1] <= min_silence_frames:
+            segments[-1][1] = frame + 1
+        else:
+            segments.append([frame, frame + 1])
+
+    # Split segments longer than the max segment duration at their quietest frame
+    max_segment_frames = int(max_segment_duration / frame_duration) - 2 * int(padding_duration / frame_duration)
+    split_segments: List[Tuple[int, int]] = []
+    for start, end in segments:
+        while end - start > max_segment_frames:
+            split = (
+                start
+                + max_segment_frames // 2
+                + int(np.argmin(energy[start + max_segment_frames // 2 : start + max_segment_frames]))
+            )
+            split_segments.append((start, split))
+            start = split
+        split_segments.append((start, end))
+
+    # Pad segments to not clip the start and end of speech. Convert frame to sample index
+    padding = int(padding_duration * sample_rate)
+    return [
+        (max(0, start * frame_size - padding), min(len(audio), end * frame_size + padding))
+        for start, end in split_segments
+    ]
+
+
+class OfflineTranscriber:
+    """
+    Transcribe audio offline with a pool of whisper model instances.
+    Audio is split into speech segments, which are transcribed in parallel and returned in order as they complete.
+    Each whisper model instance transcribes one segment at a time.
+    """
+
+    def __init__(self, model_name: str, workers: int = TRANSCRIBE_WORKERS):
+        self.model_name = model_name
+        self.workers = workers
+        self._models: queue.Queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcribe")
+        self._loaded = threading.Event()
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        "Load whisper model instances. Safe to call from multiple threads, the models are only loaded once"
+        with self._load_lock:
+            if self._loaded.is_set():
+                return
+            with timer(f"Loaded {self.workers} instances of {self.model_name} whisper model", logger):
+                for _ in range(self.workers):
+                    self._models.put(whisper.load_model(self.model_name))
+            self._loaded.set()
+
+    def preload(self):
+        "Load whisper models in the background to not load them on the transcription request path"
+
+        def _load():
+            try:
+                self.load()
+            except Exception as e:
+                logger.error(f"Failed to preload {self.model_name} whisper model: {e}", exc_info=True)
+
+        threading.Thread(target=_load, name="whisper-preload", daemon=True).start()
+
+    def transcribe_segment(self, audio_segment: np.ndarray) -> str:
+        self.load()
+        model = self._models.get()
+        try:
+            return model.transcribe(audio_segment, fp16=model.device.type != "cpu")["text"].strip()
+        finally:
+            self._models.put(model)
+
+    async def transcribe(self, audio: np.ndarray) -> AsyncGenerator[str, None]:
+        """
+        Transcribe speech segments of the audio in parallel and yield their text in order.
+        Only keep as many segments in flight as there are workers to share workers fairly across requests.
+        """
+        loop = asyncio.get_running_loop()
+        segments = deque(detect_speech_segments(audio))
+        in_flight: deque = deque()
+        while segments or in_flight:
+            while segments and len(in_flight) < self.workers:
+                start, end = segments.popleft()
+                in_flight.append(loop.run_in_executor(self._executor, self.transcribe_segment, audio[start:end]))
+            if text := await in_flight.popleft():
+                yield text
+
+
+# Offline transcriber of the configured speech to text model
+offline_transcribers: Dict[str, OfflineTranscriber] = {}
+offline_transcribers_lock = threading.Lock()
+
+
+def get_offline_transcriber(model_name: str) -> OfflineTranscriber:
+    "Get transcriber of the offline speech to text model. Replaces the transcriber of the previously configured model"
+    with offline_transcribers_lock:
+        if model_name not in offline_transcribers:
+            offline_transcribers.clear()
+            offline_transcribers[model_name] = OfflineTranscriber(model_name)
+        return offline_transcribers[model_name]
+
+
+async def load_audio(audio_filename: str) -> np.ndarray:
+    "Decode audio file into 16kHz mono audio samples"
+    return await asyncio.to_thread(whisper.load_audio, audio_filename)
+
+
+async def transcribe_audio_offline_stream(audio: np.ndarray, model: str) -> AsyncGenerator[str, None]:
+    """
+    Transcribe audio offline using Whisper. Yield transcribed text of each speech segment as it completes
+    """
+    async for text in get_offline_transcriber(model).transcribe(audio):
+        yield text
 
 
 async def transcribe_audio_offline(audio_filename: str, model: str) -> str:
     """
     Transcribe audio file offline using Whisper
     """
-    # Send the audio data to the Whisper API
-    if not state.whisper_model:
-        state.whisper_model = whisper.load_model(model)
-    response = await sync_to_async(state.whisper_model.transcribe)(audio_filename)
-    return response["text"]
+    audio = await load_audio(audio_filename)
+    return " ".join([text async for text in transcribe_audio_offline_stream(audio, model)])
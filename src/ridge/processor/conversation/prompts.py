@@ -714,6 +714,38 @@ Collate only relevant information from the document to answer the target query.
 """.strip()
 )
 
+system_prompt_summarize_document_chunk = """
+As a professional analyst, create a detailed summary of a part of a document.
+The text provided is directly from within the document. The summaries of all parts of the document will later be used to answer questions about the document.
+Keep the key facts, figures, names, dates and conclusions. Rely strictly on the provided text, without including external information.
+""".strip()
+
+summarize_document_chunk = PromptTemplate.from_template(
+    """
+Document: {file_name}, Part {part} of {total_parts}
+
+Document Contents:
+{chunk}
+
+Create a detailed summary of this part of the document.
+""".strip()
+)
+
+system_prompt_combine_document_summaries = """
+As a professional analyst, combine the summaries of consecutive parts of a document into a single detailed summary.
+The combined summary will later be used, along with the summaries of the other parts of the document, to answer questions about the document.
+Keep the key facts, figures, names, dates and conclusions. Rely strictly on the provided summaries, without including external information.
+""".strip()
+
+combine_document_summaries = PromptTemplate.from_template(
+    """
+Document Summaries:
+{summaries}
+
+Combine these summaries of consecutive parts of the document into a single detailed summary.
+""".strip()
+)
+
 personality_context = PromptTemplate.from_template(
     """
 Here's some additional context about you:
@@ -729,13 +761,13 @@ Create a multi-step plan and intelligently iterate on the plan based on the retr
 {personality_context}
 
 # Instructions
-- Ask highly diverse, detailed queries to the tool AIs, one tool AI at a time, to discover required information or run calculations. Their response will be shown to you in the next iteration.
-- Break down your research process into independent, self-contained steps that can be executed sequentially using the available tool AIs to answer the user's query. Write your step-by-step plan in the scratchpad.
+{tool_calls_instructions}
+- Break down your research process into independent, self-contained steps that can be executed using the available tool AIs to answer the user's query. Write your step-by-step plan in the scratchpad.
 - Always ask a new query that was not asked to the tool AI in a previous iteration. Build on the results of the previous iterations.
 - Ensure that all required context is passed to the tool AIs for successful execution. They only know the context provided in your query.
 - Think step by step to come up with creative strategies when the previous iteration did not yield useful results.
 - You are allowed upto {max_iterations} iterations to use the help of the provided tool AIs to answer the user's question.
-- Stop when you have the required information by returning a JSON object with the "tool" field set to "text" and "query" field empty. E.g., {{"scratchpad": "I have all I need", "tool": "text", "query": ""}}
+- Stop when you have the required information by returning a JSON object {stop_response}
 
 # Examples
 Assuming you can search the user's notes and the internet.
@@ -768,12 +800,41 @@ Which of the tool AIs listed below would you use to answer the user's question?
 # Chat History:
 {chat_history}
 
+{response_format}
+""".strip()
+)
+
+plan_single_tool_call_instructions = """
+- Ask highly diverse, detailed queries to the tool AIs, one tool AI at a time, to discover required information or run calculations. Their response will be shown to you in the next iteration.
+""".strip()
+
+plan_single_tool_call_stop_response = """
+with the "tool" field set to "text" and "query" field empty. E.g., {"scratchpad": "I have all I need", "tool": "text", "query": ""}
+""".strip()
+
+plan_single_tool_call_response_format = """
 Return the next tool AI to use and the query to ask it. Your response should always be a valid JSON object. Do not say anything else.
 Response format:
-{{"scratchpad": "<your_scratchpad_to_reason_about_which_tool_to_use>", "tool": "<name_of_tool_ai>", "query": "<your_detailed_query_for_the_tool_ai>"}}
+{"scratchpad": "<your_scratchpad_to_reason_about_which_tool_to_use>", "tool": "<name_of_tool_ai>", "query": "<your_detailed_query_for_the_tool_ai>"}
+""".strip()
+
+plan_parallel_tool_calls_instructions = PromptTemplate.from_template(
+    """
+- Ask highly diverse, detailed queries to the tool AIs to discover required information or run calculations. Their responses will be shown to you in the next iteration.
+- You can ask upto {max_tool_calls} queries to the tool AIs in each iteration. They are run in parallel, so only ask queries in the same iteration that do not depend on each other's results.
 """.strip()
 )
 
+plan_parallel_tool_calls_stop_response = """
+with an empty "tool_calls" list. E.g., {"scratchpad": "I have all I need", "tool_calls": []}
+""".strip()
+
+plan_parallel_tool_calls_response_format = """
+Return the next tool AIs to use and the queries to ask them. Your response should always be a valid JSON object. Do not say anything else.
+Response format:
+{"scratchpad": "<your_scratchpad_to_reason_about_which_tools_to_use>", "tool_calls": [{"tool": "<name_of_tool_ai>", "query": "<your_detailed_query_for_the_tool_ai>"}]}
+""".strip()
+
 previous_iteration = PromptTemplate.from_template(
     """
 ## Iteration {index}:
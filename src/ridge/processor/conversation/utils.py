@@ -1,4 +1,6 @@
 import base64
+import copy
+import hashlib
 import json
 import logging
 import math
@@ -6,13 +8,16 @@ import mimetypes
 import os
 import queue
 import re
+import threading
 import uuid
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
+from functools import partial
 from io import BytesIO
+from itertools import zip_longest
 from time import perf_counter
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 import PIL.Image
 import pyjson5
@@ -21,24 +26,32 @@ import tiktoken
 import yaml
 from langchain.schema import ChatMessage
 from llama_cpp.llama import Llama
+from llama_cpp.llama_tokenizer import LlamaTokenizer
 from transformers import AutoTokenizer
 
 from ridge.database.adapters import ConversationAdapters
 from ridge.database.models import ChatModel, ClientApplication, RidgeUser
 from ridge.processor.conversation import prompts
-from ridge.processor.conversation.offline.utils import download_model, infer_max_tokens
+from ridge.processor.conversation.offline.utils import (
+    infer_max_tokens,
+    load_model_from_cache,
+)
 from ridge.search_filter.base_filter import BaseFilter
 from ridge.search_filter.date_filter import DateFilter
 from ridge.search_filter.file_filter import FileFilter
 from ridge.search_filter.word_filter import WordFilter
 from ridge.utils import state
 from ridge.utils.helpers import (
+    LRU,
     ConversationCommand,
     is_none_or_empty,
     is_promptrace_enabled,
     merge_dicts,
+    timer,
+    truncate_code_context,
 )
 from ridge.utils.rawconfig import FileAttachment
+from ridge.utils.tracing import traced
 from ridge.utils.yaml import yaml_dump
 
 logger = logging.getLogger(__name__)
@@ -49,6 +62,10 @@ except ImportError:
     if is_promptrace_enabled():
         logger.warning("GitPython not installed. `pip install gitpython` to use prompt tracer.")
 
+# Cache token counts of chat messages to avoid re-encoding the conversation history on each chat turn
+token_count_cache = LRU(capacity=10000)
+token_count_cache_lock = threading.Lock()
+
 model_to_prompt_size = {
     # OpenAI Models
     "gpt-4o": 60000,
@@ -229,7 +246,6 @@ async def save_to_conversation_log(
     q: str,
     chat_response: str,
     user: RidgeUser,
-    meta_log: Dict,
     user_message_time: str = None,
     compiled_references: List[Dict[str, Any]] = [],
     online_results: Dict[str, Any] = {},
@@ -270,16 +286,16 @@ async def save_to_conversation_log(
     if generated_mermaidjs_diagram:
         ridge_message_metadata["mermaidjsDiagram"] = generated_mermaidjs_diagram
 
-    updated_conversation = message_to_log(
+    new_messages = message_to_log(
         user_message=q,
         chat_response=chat_response,
         user_message_metadata=user_message_metadata,
         ridge_message_metadata=ridge_message_metadata,
-        conversation_log=meta_log.get("chat", []),
+        conversation_log=[],
     )
     await ConversationAdapters.save_conversation(
         user,
-        {"chat": updated_conversation},
+        new_messages,
         client_application=client_application,
         conversation_id=conversation_id,
         user_message=q,
@@ -343,6 +359,7 @@ def gather_raw_query_files(
     return f"I have attached the following files:\n\n{contextual_data}"
 
 
+@traced("prompt_building")
 def generate_chatml_messages_with_context(
     user_message,
     system_message=None,
@@ -362,18 +379,20 @@ def generate_chatml_messages_with_context(
 ):
     """Generate chat messages with appropriate context from previous conversation to send to the chat model"""
     # Set max prompt size from user config or based on pre-configured for model and machine specs
-    if not max_prompt_size:
-        if loaded_model:
-            max_prompt_size = infer_max_tokens(loaded_model.n_ctx(), model_to_prompt_size.get(model_name, math.inf))
-        else:
-            max_prompt_size = model_to_prompt_size.get(model_name, 10000)
+    max_prompt_size = get_max_prompt_size(model_name, max_prompt_size, loaded_model)
 
     # Scale lookback turns proportional to max prompt size supported by model
     lookback_turns = max_prompt_size // 750
 
-    # Extract Chat History for Context
+    encoder, tokenizer_key = tokenizer_registry.get(model_name, tokenizer_name, loaded_model)
+
+    # Extract Chat History for Context, starting from the latest turn.
+    # Stop once the chat history alone exceeds the max prompt size, as older turns would be truncated anyway.
     chatml_messages: List[ChatMessage] = []
-    for chat in conversation_log.get("chat", []):
+    chat_history_tokens = 0
+    for chat in reversed(conversation_log.get("chat", [])):
+        # Messages of a turn are collected from latest to earliest, like the chat history
+        turn_messages: List[ChatMessage] = []
         message_context = ""
         message_attached_files = ""
 
@@ -386,6 +405,11 @@ def generate_chatml_messages_with_context(
         if chat["by"] == "ridge" and "excalidraw" in chat["intent"].get("type", ""):
             chat_message = chat["intent"].get("inferred-queries")[0]
 
+        message_content = construct_structured_message(
+            chat_message, chat.get("images") if role == "user" else [], model_type, vision_enabled
+        )
+        turn_messages.append(ChatMessage(content=message_content, role=role))
+
         if not is_none_or_empty(chat.get("context")):
             references = "\n\n".join(
                 {
@@ -396,21 +420,11 @@ def generate_chatml_messages_with_context(
             )
             message_context += f"{prompts.notes_conversation.format(references=references)}\n\n"
 
-        if chat.get("queryFiles"):
-            raw_query_files = chat.get("queryFiles")
-            query_files_dict = dict()
-            for file in raw_query_files:
-                query_files_dict[file["name"]] = file["content"]
-
-            message_attached_files = gather_raw_query_files(query_files_dict)
-            chatml_messages.append(ChatMessage(content=message_attached_files, role=role))
-
         if not is_none_or_empty(chat.get("onlineContext")):
             message_context += f"{prompts.online_search_conversation.format(online_results=chat.get('onlineContext'))}"
 
         if not is_none_or_empty(message_context):
-            reconstructed_context_message = ChatMessage(content=message_context, role="user")
-            chatml_messages.insert(0, reconstructed_context_message)
+            turn_messages.append(ChatMessage(content=message_context, role="user"))
 
         if not is_none_or_empty(chat.get("images")) and role == "assistant":
             generated_assets["image"] = {
@@ -423,21 +437,26 @@ def generate_chatml_messages_with_context(
             }
 
         if not is_none_or_empty(generated_assets):
-            chatml_messages.append(
+            turn_messages.append(
                 ChatMessage(
                     content=f"{prompts.generated_assets_context.format(generated_assets=yaml_dump(generated_assets))}\n",
                     role="user",
                 )
             )
 
-        message_content = construct_structured_message(
-            chat_message, chat.get("images") if role == "user" else [], model_type, vision_enabled
-        )
+        if chat.get("queryFiles"):
+            raw_query_files = chat.get("queryFiles")
+            query_files_dict = dict()
+            for file in raw_query_files:
+                query_files_dict[file["name"]] = file["content"]
+
+            message_attached_files = gather_raw_query_files(query_files_dict)
+            turn_messages.append(ChatMessage(content=message_attached_files, role=role))
 
-        reconstructed_message = ChatMessage(content=message_content, role=role)
-        chatml_messages.insert(0, reconstructed_message)
+        chatml_messages += turn_messages
+        chat_history_tokens += sum(count_tokens(m.content, encoder, tokenizer_key) + 4 for m in turn_messages)
 
-        if len(chatml_messages) >= 3 * lookback_turns:
+        if len(chatml_messages) >= 3 * lookback_turns or chat_history_tokens > max_prompt_size:
             break
 
     messages = []
@@ -484,6 +503,226 @@ def generate_chatml_messages_with_context(
     return messages[::-1]
 
 
+class TokenizerRegistry:
+    """
+    Process wide registry of chat model tokenizers.
+    Resolves the tokenizer of each chat model once and can be shared across threads.
+    Only loads the vocabulary of offline chat models, never their weights, to tokenize.
+    """
+
+    default_tokenizer = "gpt-4o"
+
+    def __init__(self):
+        self._tokenizers: Dict[Tuple[str, Optional[str]], Tuple[Any, str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name: str, tokenizer_name: str = None, loaded_model: Optional[Llama] = None):
+        """Get tokenizer for the chat model and a key to identify the tokenizer by"""
+        if loaded_model:
+            return loaded_model.tokenizer(), f"llama:{loaded_model.model_path}"
+
+        key = (model_name, tokenizer_name)
+        if key in self._tokenizers:
+            return self._tokenizers[key]
+
+        with self._lock:
+            if key not in self._tokenizers:
+                self._tokenizers[key] = self._load(model_name, tokenizer_name)
+            return self._tokenizers[key]
+
+    def preload(self, chat_models: Iterable[ChatModel]):
+        """Resolve tokenizers of the chat models ahead of their first use"""
+        for chat_model in chat_models:
+            with timer(f"Loaded tokenizer for {chat_model.name} chat model", logger):
+                self.get(chat_model.name, chat_model.tokenizer)
+
+    def _load(self, model_name: str, tokenizer_name: str = None):
+        try:
+            if model_name.startswith("gpt-") or model_name.startswith("o1"):
+                # as tiktoken doesn't recognize o1 model series yet
+                encoder = tiktoken.encoding_for_model("gpt-4o" if model_name.startswith("o1") else model_name)
+                return encoder, f"tiktoken:{encoder.name}"
+            elif tokenizer_name:
+                return AutoTokenizer.from_pretrained(tokenizer_name), f"pretrained:{tokenizer_name}"
+            elif "/" in model_name and (model_path := load_model_from_cache(model_name, "*Q4_K_M.gguf")):
+                # Only load the vocabulary of the downloaded offline chat model
+                return LlamaTokenizer.from_ggml_file(model_path), f"llama:{model_path}"
+        except Exception as e:
+            logger.warning(f"Failed to load tokenizer for {model_name} chat model: {e}")
+
+        encoder = tiktoken.encoding_for_model(self.default_tokenizer)
+        logger.debug(
+            f"Fallback to default chat model tokenizer: {self.default_tokenizer}.\nConfigure tokenizer for model: {model_name} in Ridge settings to improve context stuffing."
+        )
+        return encoder, f"tiktoken:{encoder.name}"
+
+
+tokenizer_registry = TokenizerRegistry()
+
+
+def count_tokens(content: Any, encoder, tokenizer_key: str) -> int:
+    """Count tokens in text message content. Cache token count by tokenizer and content hash"""
+    # TODO: Count tokens of multi-part message.content, i.e when message.content is a list[dict] rather than a string
+    if type(content) != str:
+        return 0
+
+    cache_key = (tokenizer_key, hashlib.blake2b(content.encode("utf-8", "surrogatepass"), digest_size=16).digest())
+    with token_count_cache_lock:
+        if cache_key in token_count_cache:
+            return token_count_cache[cache_key]
+
+    num_tokens = len(encoder.encode(content))
+    with token_count_cache_lock:
+        token_count_cache[cache_key] = num_tokens
+    return num_tokens
+
+
+def get_max_prompt_size(model_name: str, max_prompt_size: int = None, loaded_model: Optional[Llama] = None) -> int:
+    """Get max prompt size from user config or based on pre-configured for model and machine specs"""
+    if max_prompt_size:
+        return max_prompt_size
+    if loaded_model:
+        return infer_max_tokens(loaded_model.n_ctx(), model_to_prompt_size.get(model_name, math.inf))
+    return model_to_prompt_size.get(model_name, 10000)
+
+
+# Share of the max prompt size each context source can fill
+context_budgets = {
+    "notes": float(os.getenv("RIDGE_NOTES_CONTEXT_BUDGET", 0.25)),
+    "online": float(os.getenv("RIDGE_ONLINE_CONTEXT_BUDGET", 0.25)),
+    "code": float(os.getenv("RIDGE_CODE_CONTEXT_BUDGET", 0.1)),
+}
+# Word overlap above which two context items are considered near-duplicates
+near_duplicate_threshold = float(os.getenv("RIDGE_NEAR_DUPLICATE_THRESHOLD", 0.8))
+# Truncate an item to fit the remaining budget only if it leaves enough tokens for the item to be useful
+min_truncated_item_tokens = 64
+
+
+@dataclass
+class PackedContext:
+    references: List[Dict[str, Any]]
+    online_results: Dict[str, Dict]
+    code_results: Dict[str, Any]
+    tokens: Dict[str, int]
+
+
+def word_shingles(text: str, size: int = 3) -> set[str]:
+    words = re.findall(r"\w+", text.lower())
+    return {" ".join(words[idx : idx + size]) for idx in range(max(len(words) - size + 1, 1))}
+
+
+def fill_context_budget(
+    items: Iterable[Tuple[str, Callable[[str], None], bool]],
+    budget: int,
+    encoder,
+    tokenizer_key: str,
+) -> int:
+    """
+    Add context items, ordered by relevance, until the token budget is filled. Returns the number of tokens added.
+
+    Each item is a tuple of its text, a function to add the (truncated) text to the context
+    and whether the text can be truncated to fit in the remaining budget.
+    The highest ranked item is always added, truncated to the budget if needed, so a source is never left empty.
+    Items that are near-duplicates of an already added item are skipped.
+    """
+    tokens = 0
+    added_shingles: List[set[str]] = []
+    for text, add_item, truncatable in items:
+        shingles = word_shingles(text)
+        if any(len(shingles & other) / len(shingles | other) >= near_duplicate_threshold for other in added_shingles):
+            continue
+
+        item_tokens = count_tokens(text, encoder, tokenizer_key)
+        remaining_tokens = budget - tokens
+        if item_tokens > remaining_tokens:
+            is_top_item = not added_shingles
+            if remaining_tokens <= 0:
+                continue
+            if not is_top_item and (not truncatable or remaining_tokens < min_truncated_item_tokens):
+                continue
+            text = encoder.decode(encoder.encode(text)[:remaining_tokens]).strip()
+            item_tokens = remaining_tokens
+
+        add_item(text)
+        added_shingles.append(shingles)
+        tokens += item_tokens
+    return tokens
+
+
+def pack_context(
+    references: List[Dict[str, Any]],
+    online_results: Dict[str, Dict],
+    code_results: Dict[str, Dict],
+    model_name: str,
+    max_prompt_size: int = None,
+    tokenizer_name: str = None,
+    loaded_model: Optional[Llama] = None,
+) -> PackedContext:
+    """
+    Pack the most relevant, distinct notes, online and code context for the chat model
+    within the token budget of each source. References are expected to be ordered by relevance.
+    """
+    max_prompt_size = get_max_prompt_size(model_name, max_prompt_size, loaded_model)
+    encoder, tokenizer_key = tokenizer_registry.get(model_name, tokenizer_name, loaded_model)
+    budgets = {source: int(share * max_prompt_size) for source, share in context_budgets.items()}
+    packed = PackedContext(references=[], online_results={}, code_results={}, tokens={})
+
+    # Pack notes
+    def add_reference(reference: Dict[str, Any], text: str):
+        packed.references.append({**reference, "compiled": text})
+
+    note_items = [
+        (reference.get("compiled", ""), partial(add_reference, reference), True) for reference in references or []
+    ]
+    packed.tokens["notes"] = fill_context_budget(note_items, budgets["notes"], encoder, tokenizer_key)
+
+    # Pack online results. Interleave results of each subquery to not starve later subqueries
+    def add_online_result(subquery: str, field: str, result: Any, text_field: Optional[str], full_text: str, text: str):
+        if text_field:
+            result = {**result, text_field: text}
+        elif text != full_text:
+            # Add the truncated yaml dump of results without a content or snippet to truncate
+            result = text
+        subquery_results = packed.online_results.setdefault(subquery, {})
+        if isinstance(online_results[subquery][field], list):
+            subquery_results.setdefault(field, []).append(result)
+        else:
+            subquery_results[field] = result
+
+    online_items_by_subquery = []
+    for subquery, subquery_results in (online_results or {}).items():
+        subquery_items = []
+        for field in ["answerBox", "webpages", "knowledgeGraph", "organic", "peopleAlsoAsk"]:
+            field_results = subquery_results.get(field)
+            if is_none_or_empty(field_results):
+                continue
+            for result in field_results if isinstance(field_results, list) else [field_results]:
+                # Truncate the page content or snippet of a result, if present
+                text_field = next(
+                    (key for key in ["content", "snippet"] if isinstance(result, dict) and result.get(key)), None
+                )
+                text = result[text_field] if text_field else yaml_dump(result)
+                add_item = partial(add_online_result, subquery, field, result, text_field, text)
+                subquery_items.append((text, add_item, text_field is not None))
+        online_items_by_subquery.append(subquery_items)
+    online_items = [item for items in zip_longest(*online_items_by_subquery) for item in items if item]
+    packed.tokens["online"] = fill_context_budget(online_items, budgets["online"], encoder, tokenizer_key)
+
+    # Pack code results
+    def add_code_result(code: str, full_text: str, text: str):
+        # Add the truncated yaml dump of the code result if it had to be truncated to fit the budget
+        packed.code_results[code] = code_results[code] if text == full_text else text
+
+    code_items = []
+    for code, result in (code_results or {}).items():
+        text = yaml_dump(truncate_code_context({code: result})[code])
+        code_items.append((text, partial(add_code_result, code, text), False))
+    packed.tokens["code"] = fill_context_budget(code_items, budgets["code"], encoder, tokenizer_key)
+
+    logger.debug(f"Packed context tokens by source: {packed.tokens}")
+    return packed
+
+
 def truncate_messages(
     messages: list[ChatMessage],
     max_prompt_size: int,
@@ -492,28 +731,7 @@ def truncate_messages(
     tokenizer_name=None,
 ) -> list[ChatMessage]:
     """Truncate messages to fit within max prompt size supported by model"""
-    default_tokenizer = "gpt-4o"
-
-    try:
-        if loaded_model:
-            encoder = loaded_model.tokenizer()
-        elif model_name.startswith("gpt-") or model_name.startswith("o1"):
-            # as tiktoken doesn't recognize o1 model series yet
-            encoder = tiktoken.encoding_for_model("gpt-4o" if model_name.startswith("o1") else model_name)
-        elif tokenizer_name:
-            if tokenizer_name in state.pretrained_tokenizers:
-                encoder = state.pretrained_tokenizers[tokenizer_name]
-            else:
-                encoder = AutoTokenizer.from_pretrained(tokenizer_name)
-                state.pretrained_tokenizers[tokenizer_name] = encoder
-        else:
-            encoder = download_model(model_name).tokenizer()
-    except:
-        encoder = tiktoken.encoding_for_model(default_tokenizer)
-        if state.verbose > 2:
-            logger.debug(
-                f"Fallback to default chat model tokenizer: {default_tokenizer}.\nConfigure tokenizer for model: {model_name} in Ridge settings to improve context stuffing."
-            )
+    encoder, tokenizer_key = tokenizer_registry.get(model_name, tokenizer_name, loaded_model)
 
     # Extract system message from messages
     system_message = None
@@ -522,18 +740,21 @@ def truncate_messages(
             system_message = messages.pop(idx)
             break
 
-    # TODO: Handle truncation of multi-part message.content, i.e when message.content is a list[dict] rather than a string
-    system_message_tokens = (
-        len(encoder.encode(system_message.content)) if system_message and type(system_message.content) == str else 0
-    )
-
-    tokens = sum([len(encoder.encode(message.content)) for message in messages if type(message.content) == str])
+    system_message_tokens = count_tokens(system_message.content, encoder, tokenizer_key) if system_message else 0
 
-    # Drop older messages until under max supported prompt size by model
+    # Keep latest messages until adding the next older message would exceed max supported prompt size by model.
+    # Each message is encoded once and its tokens added to the running total of the messages to keep.
     # Reserves 4 tokens to demarcate each message (e.g <|im_start|>user, <|im_end|>, <|endoftext|> etc.)
-    while (tokens + system_message_tokens + 4 * len(messages)) > max_prompt_size and len(messages) > 1:
-        messages.pop()
-        tokens = sum([len(encoder.encode(message.content)) for message in messages if type(message.content) == str])
+    tokens = 0
+    num_messages_to_keep = 0
+    for message in messages:
+        message_tokens = count_tokens(message.content, encoder, tokenizer_key)
+        prompt_tokens = tokens + message_tokens + system_message_tokens + 4 * (num_messages_to_keep + 1)
+        if num_messages_to_keep > 0 and prompt_tokens > max_prompt_size:
+            break
+        tokens += message_tokens
+        num_messages_to_keep += 1
+    del messages[num_messages_to_keep:]
 
     # Truncate current message if still over max supported prompt size by model
     if (tokens + system_message_tokens) > max_prompt_size:
@@ -686,8 +907,8 @@ def commit_conversation_trace(
     repo_path: str = None,
 ) -> str:
     """
-    Save trace of conversation step using git. Useful to visualize, compare and debug traces.
-    Returns the path to the repository.
+    Save trace of conversation step using git in the background. Useful to visualize, compare and debug traces.
+    Returns the path to the repository if the trace was queued to be saved.
     """
     try:
         from git import Repo
@@ -699,20 +920,195 @@ def commit_conversation_trace(
     if not repo_path:
         return None
 
-    # Serialize session, system message and response to yaml
-    system_message_yaml = json.dumps(system_message, ensure_ascii=False, sort_keys=False)
-    response_yaml = json.dumps(response, ensure_ascii=False, sort_keys=False)
-    formatted_session = [{"role": message.role, "content": message.content} for message in session]
-    session_yaml = json.dumps(formatted_session, ensure_ascii=False, sort_keys=False)
-    query = (
-        json.dumps(session[-1].content, ensure_ascii=False, sort_keys=False).strip().removeprefix("'").removesuffix("'")
-    )  # Extract serialized query from chat session
+    # Snapshot the conversation step as the session and tracer can be updated by the caller
+    trace = {
+        "type": "commit",
+        "repo_path": repo_path,
+        "session": [{"role": message.role, "content": message.content} for message in session],
+        "response": response,
+        "system_message": system_message,
+        "tracer": copy.deepcopy(tracer),
+    }
+    return repo_path if prompt_trace_writer.put(trace) else None
 
-    # Extract chat metadata for session
-    uid, cid, mid = tracer.get("uid", "main"), tracer.get("cid", "main"), tracer.get("mid")
 
+def merge_message_into_conversation_trace(query: str, response: str, tracer: dict, repo_path=None) -> bool:
+    """
+    Merge the message branch into its parent conversation branch in the background.
+
+    Args:
+        query: User query
+        response: Assistant response
+        tracer: Dictionary containing uid, cid and mid
+        repo_path: Path to the git repository
+
+    Returns:
+        bool: True if merge was queued, False otherwise
+    """
     try:
-        # Prepare git repository
+        from git import Repo
+    except ImportError:
+        return False
+
+    # Infer repository path from environment variable or provided path
+    repo_path = repo_path if not is_none_or_empty(repo_path) else os.getenv("PROMPTRACE_DIR")
+    if not repo_path:
+        return None
+
+    trace = {
+        "type": "merge",
+        "repo_path": repo_path,
+        "query": query,
+        "response": response,
+        "tracer": copy.deepcopy(tracer),
+    }
+    return prompt_trace_writer.put(trace)
+
+
+def trace_commit_message(query: str, response: str | list[dict], tracer: dict) -> str:
+    metadata_yaml = yaml.dump(tracer, allow_unicode=True, sort_keys=False, default_flow_style=False)
+    return f"""
+{query[:250]}
+
+Response:
+---
+{response[:500]}...
+
+Metadata
+---
+{metadata_yaml}
+""".strip()
+
+
+class PromptTraceWriter:
+    """
+    Save conversation traces to git repositories from a background thread.
+
+    Traces are saved in the order they are queued. Traces of the same conversation message in a batch
+    are committed together, to only check out the message branch once per batch.
+    When the queue is full, traces are spilled to a file next to the repository,
+    or dropped if spilling is disabled or fails.
+    Later traces are spilled too until the spilled traces are saved, once the traces queued before them are saved.
+    """
+
+    def __init__(self, max_queue_size: int = 1000, batch_size: int = 50, spill: bool = True):
+        self.batch_size = batch_size
+        self.spill = spill
+        self.dropped_traces = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._repos: Dict[str, Tuple[Any, Any]] = {}
+        self._spill_paths: set[str] = set()
+        self._spill_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def put(self, trace: dict) -> bool:
+        "Queue trace to save. Returns False if the trace was dropped"
+        self._start()
+        if self.spill and self._spill_paths:
+            # Spill trace after the spilled traces to save traces in the order they are queued
+            if self._spill(trace):
+                return True
+        else:
+            try:
+                self._queue.put_nowait(trace)
+                return True
+            except queue.Full:
+                if self.spill and self._spill(trace):
+                    return True
+        self.dropped_traces += 1
+        if self.dropped_traces % 100 == 1:
+            logger.warning(f"Dropped {self.dropped_traces} conversation traces as the prompt trace queue is full")
+        return False
+
+    def flush(self):
+        "Wait until all queued traces are saved"
+        self._queue.join()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="prompt-trace-writer", daemon=True)
+                self._thread.start()
+
+    def _spill(self, trace: dict) -> bool:
+        spill_path = f"{trace['repo_path'].rstrip(os.sep)}.spill.jsonl"
+        try:
+            with self._spill_lock, open(spill_path, "a", encoding="utf-8") as spill_file:
+                spill_file.write(json.dumps(trace, ensure_ascii=False, default=str) + "\n")
+                self._spill_paths.add(spill_path)
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to spill conversation trace to {spill_path}: {e}")
+            return False
+
+    def _read_spilled(self) -> List[dict]:
+        traces = []
+        with self._spill_lock:
+            for spill_path in list(self._spill_paths):
+                try:
+                    with open(spill_path, "r", encoding="utf-8") as spill_file:
+                        traces += [json.loads(line) for line in spill_file if line.strip()]
+                    os.remove(spill_path)
+                except Exception as e:
+                    logger.warning(f"Failed to read spilled conversation traces from {spill_path}: {e}")
+                self._spill_paths.discard(spill_path)
+        return traces
+
+    def _run(self):
+        while True:
+            if self._spill_paths and self._queue.empty():
+                # Save spilled traces once the traces queued before them are saved
+                self._write(self._read_spilled())
+                continue
+
+            try:
+                traces = [self._queue.get(timeout=1)]
+                queued = 1
+            except queue.Empty:
+                continue
+
+            while len(traces) < self.batch_size:
+                try:
+                    traces.append(self._queue.get_nowait())
+                    queued += 1
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(traces)
+            finally:
+                for _ in range(queued):
+                    self._queue.task_done()
+
+    def _write(self, traces: List[dict]):
+        # Group traces by conversation message, in the order they were queued
+        traces_by_message: Dict[tuple, List[dict]] = {}
+        for trace in traces:
+            tracer = trace["tracer"]
+            message_key = (trace["repo_path"], tracer.get("uid", "main"), tracer.get("cid", "main"), tracer.get("mid"))
+            traces_by_message.setdefault(message_key, []).append(trace)
+
+        for message_traces in traces_by_message.values():
+            for trace in message_traces:
+                try:
+                    repo, initial_commit = self._open_repo(trace["repo_path"])
+                    if trace["type"] == "commit":
+                        save_conversation_trace(repo, initial_commit, trace)
+                    else:
+                        merge_conversation_trace(repo, trace)
+                except Exception as e:
+                    logger.error(f"Failed to save conversation trace to repo: {str(e)}", exc_info=True)
+
+    def _open_repo(self, repo_path: str):
+        "Prepare git repository to save traces to. Returns the repository and its initial commit"
+        if repo_path in self._repos:
+            return self._repos[repo_path]
+
+        from git import Repo
+
         os.makedirs(repo_path, exist_ok=True)
         repo = Repo.init(repo_path)
 
@@ -730,122 +1126,92 @@ def commit_conversation_trace(
         # Create an initial commit if the repository is newly created
         if not repo.head.is_valid():
             repo.index.commit("And then there was a trace")
+        initial_commit = repo.commit(repo.git.rev_list("--max-parents=0", "HEAD").splitlines()[-1])
 
-        # Check out the initial commit
-        initial_commit = repo.commit("HEAD~0")
-        repo.head.reference = initial_commit
-        repo.head.reset(index=True, working_tree=True)
-
-        # Create or switch to user branch from initial commit
-        user_branch = f"u_{uid}"
-        if user_branch not in repo.branches:
-            repo.create_head(user_branch)
-        repo.heads[user_branch].checkout()
-
-        # Create or switch to conversation branch from user branch
-        conv_branch = f"c_{cid}"
-        if conv_branch not in repo.branches:
-            repo.create_head(conv_branch)
-        repo.heads[conv_branch].checkout()
-
-        # Create or switch to message branch from conversation branch
-        msg_branch = f"m_{mid}" if mid else None
-        if msg_branch and msg_branch not in repo.branches:
-            repo.create_head(msg_branch)
-        if msg_branch:
-            repo.heads[msg_branch].checkout()
-
-        # Include file with content to commit
-        files_to_commit = {"query": session_yaml, "response": response_yaml, "system_prompt": system_message_yaml}
-
-        # Write files and stage them
-        for filename, content in files_to_commit.items():
-            file_path = os.path.join(repo_path, filename)
-            # Unescape special characters in content for better readability
-            content = content.strip().replace("\\n", "\n").replace("\\t", "\t")
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(content)
-            repo.index.add([filename])
-
-        # Create commit
-        metadata_yaml = yaml.dump(tracer, allow_unicode=True, sort_keys=False, default_flow_style=False)
-        commit_message = f"""
-{query[:250]}
+        self._repos[repo_path] = (repo, initial_commit)
+        return repo, initial_commit
 
-Response:
----
-{response[:500]}...
 
-Metadata
----
-{metadata_yaml}
-""".strip()
+def checkout_branch(repo, branch: str):
+    if repo.head.is_detached or repo.active_branch.name != branch:
+        repo.heads[branch].checkout()
 
-        repo.index.commit(commit_message)
 
-        logger.debug(f"Saved conversation trace to repo at {repo_path}")
-        return repo_path
-    except Exception as e:
-        logger.error(f"Failed to add conversation trace to repo: {str(e)}", exc_info=True)
-        return None
+def save_conversation_trace(repo, initial_commit, trace: dict):
+    "Commit trace of conversation step to its message branch"
+    session, response, system_message = trace["session"], trace["response"], trace["system_message"]
 
+    # Serialize session, system message and response to yaml
+    system_message_yaml = json.dumps(system_message, ensure_ascii=False, sort_keys=False)
+    response_yaml = json.dumps(response, ensure_ascii=False, sort_keys=False)
+    session_yaml = json.dumps(session, ensure_ascii=False, sort_keys=False)
+    query = (
+        json.dumps(session[-1]["content"], ensure_ascii=False, sort_keys=False)
+        .strip()
+        .removeprefix("'")
+        .removesuffix("'")
+    )  # Extract serialized query from chat session
 
-def merge_message_into_conversation_trace(query: str, response: str, tracer: dict, repo_path=None) -> bool:
-    """
-    Merge the message branch into its parent conversation branch.
+    # Extract chat metadata for session
+    tracer = trace["tracer"]
+    uid, cid, mid = tracer.get("uid", "main"), tracer.get("cid", "main"), tracer.get("mid")
 
-    Args:
-        query: User query
-        response: Assistant response
-        tracer: Dictionary containing uid, cid and mid
-        repo_path: Path to the git repository
+    # Create user branch from initial commit
+    user_branch = f"u_{uid}"
+    if user_branch not in repo.branches:
+        repo.create_head(user_branch, initial_commit)
 
-    Returns:
-        bool: True if merge was successful, False otherwise
-    """
-    try:
-        from git import Repo
-    except ImportError:
-        return False
-    try:
-        # Extract branch names
-        msg_branch = f"m_{tracer['mid']}"
-        conv_branch = f"c_{tracer['cid']}"
-
-        # Infer repository path from environment variable or provided path
-        repo_path = repo_path if not is_none_or_empty(repo_path) else os.getenv("PROMPTRACE_DIR")
-        if not repo_path:
-            return None
-        repo = Repo(repo_path)
-
-        # Checkout conversation branch
-        repo.heads[conv_branch].checkout()
-
-        # Create commit message
-        metadata_yaml = yaml.dump(tracer, allow_unicode=True, sort_keys=False, default_flow_style=False)
-        commit_message = f"""
-{query[:250]}
+    # Create conversation branch from user branch
+    conv_branch = f"c_{cid}"
+    if conv_branch not in repo.branches:
+        repo.create_head(conv_branch, repo.heads[user_branch])
 
-Response:
----
-{response[:500]}...
+    # Create message branch from conversation branch
+    msg_branch = f"m_{mid}" if mid else None
+    if msg_branch and msg_branch not in repo.branches:
+        repo.create_head(msg_branch, repo.heads[conv_branch])
 
-Metadata
----
-{metadata_yaml}
-""".strip()
+    # Switch to message branch, or conversation branch if no message id
+    checkout_branch(repo, msg_branch or conv_branch)
 
-        # Merge message branch into conversation branch
-        repo.git.merge(msg_branch, no_ff=True, m=commit_message)
+    # Include file with content to commit
+    files_to_commit = {"query": session_yaml, "response": response_yaml, "system_prompt": system_message_yaml}
 
-        # Delete message branch after merge
-        repo.delete_head(msg_branch, force=True)
+    # Write files and stage them
+    for filename, content in files_to_commit.items():
+        file_path = os.path.join(repo.working_tree_dir, filename)
+        # Unescape special characters in content for better readability
+        content = content.strip().replace("\\n", "\n").replace("\\t", "\t")
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(content)
+    repo.index.add(list(files_to_commit.keys()))
 
-        logger.debug(f"Successfully merged {msg_branch} into {conv_branch}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to merge message {msg_branch} into conversation {conv_branch}: {str(e)}", exc_info=True)
-        return False
+    # Create commit
+    repo.index.commit(trace_commit_message(query, response, tracer))
+    logger.debug(f"Saved conversation trace to repo at {repo.working_tree_dir}")
+
+
+def merge_conversation_trace(repo, trace: dict):
+    "Merge the message branch into its parent conversation branch"
+    tracer = trace["tracer"]
+    msg_branch = f"m_{tracer['mid']}"
+    conv_branch = f"c_{tracer['cid']}"
+
+    # Checkout conversation branch
+    checkout_branch(repo, conv_branch)
+
+    # Merge message branch into conversation branch
+    repo.git.merge(msg_branch, no_ff=True, m=trace_commit_message(trace["query"], trace["response"], tracer))
+
+    # Delete message branch after merge
+    repo.delete_head(msg_branch, force=True)
+    logger.debug(f"Successfully merged {msg_branch} into {conv_branch}")
+
+
+prompt_trace_writer = PromptTraceWriter(
+    max_queue_size=int(os.getenv("PROMPTRACE_QUEUE_SIZE", 1000)),
+    spill=os.getenv("PROMPTRACE_OVERFLOW", "spill") == "spill",
+)
 
 
 def messages_to_print(messages: list[ChatMessage], max_length: int = 70) -> str:
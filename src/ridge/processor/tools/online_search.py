@@ -1,12 +1,17 @@
 import asyncio
+import codecs
+import copy
 import json
 import logging
 import os
+import re
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
-import aiohttp
+import lxml.html
 from bs4 import BeautifulSoup
+from lxml.etree import ParserError
 from markdownify import markdownify
 
 from ridge.database.adapters import ConversationAdapters
@@ -14,10 +19,12 @@ from ridge.database.models import Agent, RidgeUser, ServerChatSettings, WebScrap
 from ridge.processor.conversation import prompts
 from ridge.routers.helpers import (
     ChatEvent,
+    ChatRequestContext,
     extract_relevant_info,
     generate_online_subqueries,
     infer_webpage_urls,
 )
+from ridge.utils import state
 from ridge.utils.helpers import (
     is_env_var_true,
     is_internal_url,
@@ -41,6 +48,19 @@ JINA_API_KEY = os.getenv("JINA_API_KEY")
 FIRECRAWL_API_KEY = os.getenv("FIRECRAWL_API_KEY")
 FIRECRAWL_USE_LLM_EXTRACT = is_env_var_true("FIRECRAWL_USE_LLM_EXTRACT")
 
+# Limit size of web pages to read and the text to extract from them
+WEBPAGE_MAX_BYTES = int(os.getenv("RIDGE_WEBPAGE_MAX_BYTES", 5 * 1024 * 1024))
+WEBPAGE_MAX_CHARS = int(os.getenv("RIDGE_WEBPAGE_MAX_CHARS", 100000))
+HTML_META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+# HTML elements with page boilerplate rather than content.
+# Forms and headers are kept as some pages wrap their content or article titles in them
+BOILERPLATE_TAGS = ["script", "style", "noscript", "template", "svg", "iframe", "nav", "aside"]
+
+# Extract text from web pages in worker threads to not block the event loop
+webpage_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RIDGE_WEBPAGE_WORKERS", 4)), thread_name_prefix="webpage_extractor"
+)
+
 OLOSTEP_QUERY_PARAMS = {
     "timeout": 35,  # seconds
     "waitBeforeScraping": 0,  # seconds
@@ -69,6 +89,7 @@ async def search_online(
     previous_subqueries: Set = set(),
     agent: Agent = None,
     query_files: str = None,
+    request_context: ChatRequestContext = None,
     tracer: dict = {},
 ):
     query += " ".join(custom_filters)
@@ -87,6 +108,7 @@ async def search_online(
         agent=agent,
         tracer=tracer,
         query_files=query_files,
+        request_context=request_context,
     )
     subqueries = list(new_subqueries - previous_subqueries)
     response_dict: Dict[str, Dict[str, List[Dict] | Dict]] = {}
@@ -120,9 +142,11 @@ async def search_online(
     response_dict = {}
     for search_engine, search_func in search_engines:
         logger.info(f"🌐 Searching the Internet with {search_engine} for {subqueries}")
-        with timer(f"Internet searches with {search_engine} for {subqueries} took", logger):
+        with timer(f"Internet searches with {search_engine} for {subqueries} took", logger, span="online_search"):
             try:
-                search_tasks = [search_func(subquery, location) for subquery in subqueries]
+                search_tasks = [
+                    search_with_cache(search_engine, search_func, subquery, location) for subquery in subqueries
+                ]
                 search_results = await asyncio.gather(*search_tasks)
                 response_dict = {subquery: search_result for subquery, search_result in search_results if search_result}
                 if not is_none_or_empty(response_dict):
@@ -161,7 +185,13 @@ async def search_online(
                 yield {ChatEvent.STATUS: event}
     tasks = [
         read_webpage_and_extract_content(
-            data["queries"], link, data.get("content"), user=user, agent=agent, tracer=tracer
+            data["queries"],
+            link,
+            data.get("content"),
+            user=user,
+            agent=agent,
+            request_context=request_context,
+            tracer=tracer,
         )
         for link, data in webpages.items()
     ]
@@ -175,6 +205,23 @@ async def search_online(
     yield response_dict
 
 
+async def search_with_cache(
+    search_engine: str, search_func: Callable, query: str, location: LocationData
+) -> Tuple[str, Dict[str, List[Dict]]]:
+    "Search online with the search engine. Reuse recent results of the same search"
+    cache_key = (search_engine, query, location.model_dump_json() if location else None)
+    cached_result = state.online_search_cache.get(cache_key)
+    if cached_result is not None:
+        logger.debug(f"Use cached {search_engine} search results for {query}")
+        # Return a copy as the search results are updated with the web pages read
+        return query, copy.deepcopy(cached_result)
+
+    query, search_result = await search_func(query, location)
+    if not is_none_or_empty(search_result):
+        state.online_search_cache.set(cache_key, copy.deepcopy(search_result))
+    return query, search_result
+
+
 async def search_with_firecrawl(query: str, location: LocationData) -> Tuple[str, Dict[str, List[Dict]]]:
     """
     Search using Firecrawl API.
@@ -205,7 +252,7 @@ async def search_with_firecrawl(query: str, location: LocationData) -> Tuple[str
     if location and location.city:
         payload["location"] = f"{location.city}, {location.region}, {location.country}"
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         try:
             async with session.post(firecrawl_api_url, headers=headers, json=payload) as response:
                 if response.status != 200:
@@ -247,7 +294,7 @@ async def search_with_searxng(query: str, location: LocationData) -> Tuple[str,
 
     params = {"q": query, "format": "html", "language": "en", "country": country_code, "categories": "general"}
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         try:
             async with session.get(search_url, params=params) as response:
                 if response.status != 200:
@@ -290,7 +337,7 @@ async def search_with_google(query: str, location: LocationData) -> Tuple[str, D
         "gl": country_code,  # Geolocation parameter
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         async with session.get(base_url, params=params) as response:
             if response.status != 200:
                 logger.error(await response.text())
@@ -341,7 +388,7 @@ async def search_with_serper(query: str, location: LocationData) -> Tuple[str, D
 
     payload = json.dumps({"q": query, "gl": country_code})
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         async with session.post(SERPER_DEV_URL, headers=headers, data=payload) as response:
             if response.status != 200:
                 logger.error(await response.text())
@@ -367,9 +414,15 @@ async def read_webpages(
     agent: Agent = None,
     max_webpages_to_read: int = 1,
     query_files: str = None,
+    request_context: ChatRequestContext = None,
     tracer: dict = {},
 ):
     "Infer web pages to read from the query and extract relevant information from them"
+    if not is_internet_connected():
+        logger.warning("Cannot read web pages as not connected to internet")
+        yield {}
+        return
+
     logger.info(f"Inferring web pages to read")
     urls = await infer_webpage_urls(
         query,
@@ -380,6 +433,7 @@ async def read_webpages(
         query_images,
         agent=agent,
         query_files=query_files,
+        request_context=request_context,
         tracer=tracer,
     )
 
@@ -388,7 +442,12 @@ async def read_webpages(
         webpage_links_str = "\n- " + "\n- ".join(list(urls))
         async for event in send_status_func(f"**Reading web pages**: {webpage_links_str}"):
             yield {ChatEvent.STATUS: event}
-    tasks = [read_webpage_and_extract_content({query}, url, user=user, agent=agent, tracer=tracer) for url in urls]
+    tasks = [
+        read_webpage_and_extract_content(
+            {query}, url, user=user, agent=agent, request_context=request_context, tracer=tracer
+        )
+        for url in urls
+    ]
     results = await asyncio.gather(*tasks)
 
     response: Dict[str, Dict] = defaultdict(dict)
@@ -419,6 +478,7 @@ async def read_webpage_and_extract_content(
     content: str = None,
     user: RidgeUser = None,
     agent: Agent = None,
+    request_context: ChatRequestContext = None,
     tracer: dict = {},
 ) -> Tuple[set[str], str, Union[None, str]]:
     # Select the web scrapers to use for reading the web page
@@ -433,16 +493,28 @@ async def read_webpage_and_extract_content(
         try:
             # Read the web page
             if is_none_or_empty(content):
-                with timer(f"Reading web page with {scraper.type} at '{url}' took", logger, log_level=logging.INFO):
+                content = state.webpage_cache.get((scraper.type, url))
+            if is_none_or_empty(content):
+                with timer(
+                    f"Reading web page with {scraper.type} at '{url}' took",
+                    logger,
+                    log_level=logging.INFO,
+                    span="webpage_read",
+                ):
                     content, extracted_info = await read_webpage(
                         url, scraper.type, scraper.api_key, scraper.api_url, subqueries, agent
                     )
+                if not is_none_or_empty(content):
+                    state.webpage_cache.set((scraper.type, url), content)
 
             # Extract relevant information from the web page
             if is_none_or_empty(extracted_info):
-                with timer(f"Extracting relevant information from web page at '{url}' took", logger):
+                content = content[:WEBPAGE_MAX_CHARS] if content else content
+                with timer(
+                    f"Extracting relevant information from web page at '{url}' took", logger, span="webpage_extract"
+                ):
                     extracted_info = await extract_relevant_info(
-                        subqueries, content, user=user, agent=agent, tracer=tracer
+                        subqueries, content, user=user, agent=agent, request_context=request_context, tracer=tracer
                     )
 
             # If we successfully extracted information, break the loop
@@ -462,13 +534,62 @@ async def read_webpage_at_url(web_url: str) -> str:
         "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36",
     }
 
-    async with aiohttp.ClientSession() as session:
+    # Revalidate previously read web page to avoid downloading it again, if it hasn't changed
+    cached_webpage = state.webpage_revalidation_cache.get(web_url)
+    if cached_webpage:
+        if cached_webpage["etag"]:
+            headers["If-None-Match"] = cached_webpage["etag"]
+        if cached_webpage["last_modified"]:
+            headers["If-Modified-Since"] = cached_webpage["last_modified"]
+
+    async with state.http_client_pool.session() as session:
         async with session.get(web_url, headers=headers, timeout=30) as response:
+            if response.status == 304 and cached_webpage:
+                return cached_webpage["content"]
             response.raise_for_status()
-            html = await response.text()
-            parsed_html = BeautifulSoup(html, "html.parser")
-            body = parsed_html.body.get_text(separator="\n", strip=True)
-            return markdownify(body)
+
+            # Stop downloading web page once it exceeds the size limit
+            html_bytes = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                html_bytes.extend(chunk)
+                if len(html_bytes) >= WEBPAGE_MAX_BYTES:
+                    logger.debug(f"Truncated web page at '{web_url}' to {WEBPAGE_MAX_BYTES} bytes")
+                    break
+            html_bytes = html_bytes[:WEBPAGE_MAX_BYTES]
+            html = html_bytes.decode(get_html_encoding(html_bytes, response.charset), errors="replace")
+
+            loop = asyncio.get_running_loop()
+            content = await loop.run_in_executor(webpage_executor, html_to_markdown, html, WEBPAGE_MAX_CHARS)
+
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            if etag or last_modified:
+                state.webpage_revalidation_cache.set(
+                    web_url, {"etag": etag, "last_modified": last_modified, "content": content}
+                )
+            return content
+
+
+def get_html_encoding(html_bytes: bytes | bytearray, charset: Optional[str] = None) -> str:
+    "Get encoding of the web page from its Content-Type charset, else from its meta charset tag. Defaults to utf-8"
+    if not charset and (match := HTML_META_CHARSET.search(html_bytes[:4096])):
+        charset = match.group(1).decode("ascii")
+    try:
+        return codecs.lookup(charset).name if charset else "utf-8"
+    except LookupError:
+        return "utf-8"
+
+
+def html_to_markdown(html: str, max_chars: int = WEBPAGE_MAX_CHARS) -> str:
+    "Extract the text content of the web page body as markdown, without page boilerplate like navigation, scripts"
+    try:
+        document = lxml.html.document_fromstring(html)
+    except (ParserError, ValueError):
+        return ""
+    for element in list(document.iter(*BOILERPLATE_TAGS)):
+        element.drop_tree()
+
+    body = document.body if document.find("body") is not None else document
+    return markdownify(lxml.html.tostring(body, encoding="unicode")).strip()[:max_chars]
 
 
 async def read_webpage_with_olostep(web_url: str, api_key: str, api_url: str) -> str:
@@ -476,7 +597,7 @@ async def read_webpage_with_olostep(web_url: str, api_key: str, api_url: str) ->
     web_scraping_params: Dict[str, Union[str, int, bool]] = OLOSTEP_QUERY_PARAMS.copy()  # type: ignore
     web_scraping_params["url"] = web_url
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         async with session.get(api_url, params=web_scraping_params, headers=headers) as response:
             response.raise_for_status()
             response_json = await response.json()
@@ -489,7 +610,7 @@ async def read_webpage_with_jina(web_url: str, api_key: str, api_url: str) -> st
     if api_key:
         headers["Authorization"] = f"Bearer {api_key}"
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         async with session.post(api_url, json=data, headers=headers) as response:
             response.raise_for_status()
             content = await response.text()
@@ -501,7 +622,7 @@ async def read_webpage_with_firecrawl(web_url: str, api_key: str, api_url: str)
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
     params = {"url": web_url, "formats": ["markdown"], "excludeTags": ["script", ".ad"]}
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         async with session.post(firecrawl_api_url, json=params, headers=headers) as response:
             response.raise_for_status()
             response_json = await response.json()
@@ -537,7 +658,7 @@ Collate only relevant information from the website to answer the target query an
 
     params = {"url": web_url, "formats": ["extract"], "extract": {"systemPrompt": system_prompt, "schema": schema}}
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         async with session.post(firecrawl_api_url, json=params, headers=headers) as response:
             response.raise_for_status()
             response_json = await response.json()
@@ -566,7 +687,7 @@ async def search_with_jina(query: str, location: LocationData) -> Tuple[str, Dic
     if api_key:
         headers["Authorization"] = f"Bearer {api_key}"
 
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         async with session.post(JINA_SEARCH_API_URL, json=data, headers=headers) as response:
             if response.status != 200:
                 error_text = await response.text()
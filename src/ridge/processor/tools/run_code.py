@@ -27,7 +27,8 @@ from ridge.processor.conversation.utils import (
     clean_code_python,
     construct_chat_history,
 )
-from ridge.routers.helpers import send_message_to_model_wrapper
+from ridge.routers.helpers import ChatRequestContext, send_message_to_model_wrapper
+from ridge.utils import state
 from ridge.utils.helpers import (
     is_e2b_code_sandbox_enabled,
     is_none_or_empty,
@@ -59,6 +60,7 @@ async def run_code(
     agent: Agent = None,
     sandbox_url: str = SANDBOX_URL,
     query_files: str = None,
+    request_context: ChatRequestContext = None,
     tracer: dict = {},
 ):
     # Generate Code
@@ -66,7 +68,7 @@ async def run_code(
         async for event in send_status_func(f"**Generate code snippet** for {query}"):
             yield {ChatEvent.STATUS: event}
     try:
-        with timer("Chat actor: Generate programs to execute", logger):
+        with timer("Chat actor: Generate programs to execute", logger, span="code_generate"):
             generated_code = await generate_python_code(
                 query,
                 conversation_history,
@@ -77,6 +79,7 @@ async def run_code(
                 agent,
                 tracer,
                 query_files,
+                request_context=request_context,
             )
     except Exception as e:
         raise ValueError(f"Failed to generate code for {query} with error: {e}")
@@ -96,7 +99,7 @@ async def run_code(
         async for event in send_status_func(f"**Running code snippet**"):
             yield {ChatEvent.STATUS: event}
     try:
-        with timer("Chat actor: Execute generated program", logger, log_level=logging.INFO):
+        with timer("Chat actor: Execute generated program", logger, log_level=logging.INFO, span="code_run"):
             result = await execute_sandboxed_python(generated_code.code, input_data, sandbox_url)
             code = result.pop("code")
             cleaned_result = truncate_code_context({"cleaned": {"results": result}})["cleaned"]["results"]
@@ -106,7 +109,9 @@ async def run_code(
         # Call the sandbox_url/stop GET API endpoint to stop the code sandbox
         error = f"Failed to run code for {query} with Timeout error: {e}"
         try:
-            await aiohttp.ClientSession().get(f"{sandbox_url}/stop", timeout=5)
+            async with state.http_client_pool.session() as session:
+                async with session.get(f"{sandbox_url}/stop", timeout=5):
+                    pass
         except Exception as e:
             error += f"\n\nFailed to stop code sandbox with error: {e}"
         raise ValueError(error)
@@ -124,6 +129,7 @@ async def generate_python_code(
     agent: Agent = None,
     tracer: dict = {},
     query_files: str = None,
+    request_context: ChatRequestContext = None,
 ) -> GeneratedCode:
     location = f"{location_data}" if location_data else "Unknown"
     username = prompts.user_name.format(name=user.get_full_name()) if user.get_full_name() else ""
@@ -158,6 +164,7 @@ async def generate_python_code(
         user=user,
         tracer=tracer,
         query_files=query_files,
+        request_context=request_context,
     )
 
     # Extract python code wrapped in markdown code blocks from the response
@@ -305,7 +312,7 @@ async def execute_terrarium(
     """Execute code using Terrarium sandbox"""
     headers = {"Content-Type": "application/json"}
     data = {"code": code, "files": input_data}
-    async with aiohttp.ClientSession() as session:
+    async with state.http_client_pool.session() as session:
         async with session.post(sandbox_url, json=data, headers=headers, timeout=30) as response:
             if response.status == 200:
                 result: dict[str, Any] = await response.json()
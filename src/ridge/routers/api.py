@@ -1,3 +1,4 @@
+import asyncio
 import concurrent.futures
 import json
 import logging
@@ -6,7 +7,7 @@ import os
 import threading
 import time
 import uuid
-from typing import Any, Callable, List, Optional, Set, Union
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Set, Union
 
 import cron_descriptor
 import openai
@@ -16,7 +17,7 @@ from apscheduler.triggers.cron import CronTrigger
 from asgiref.sync import sync_to_async
 from fastapi import APIRouter, Depends, File, HTTPException, Request, UploadFile
 from fastapi.requests import Request
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from starlette.authentication import has_required_scope, requires
 
 from ridge.configure import initialize_content
@@ -36,13 +37,19 @@ from ridge.processor.conversation.anthropic.anthropic_chat import (
 )
 from ridge.processor.conversation.google.gemini_chat import extract_questions_gemini
 from ridge.processor.conversation.offline.chat_model import extract_questions_offline
-from ridge.processor.conversation.offline.whisper import transcribe_audio_offline
+from ridge.processor.conversation.offline.scheduler import get_offline_chat_scheduler
+from ridge.processor.conversation.offline.whisper import (
+    load_audio,
+    transcribe_audio_offline,
+    transcribe_audio_offline_stream,
+)
 from ridge.processor.conversation.openai.gpt import extract_questions
 from ridge.processor.conversation.openai.whisper import transcribe_audio
 from ridge.processor.conversation.utils import clean_json, defilter_query
 from ridge.routers.helpers import (
     ApiUserRateLimiter,
     ChatEvent,
+    ChatRequestContext,
     CommonQueryParams,
     ConversationCommandRateLimiter,
     get_user_config,
@@ -56,7 +63,12 @@ from ridge.search_filter.word_filter import WordFilter
 from ridge.search_type import text_search
 from ridge.utils import state
 from ridge.utils.config import OfflineChatProcessorModel
-from ridge.utils.helpers import ConversationCommand, is_none_or_empty, timer
+from ridge.utils.helpers import (
+    ConversationCommand,
+    is_env_var_true,
+    is_none_or_empty,
+    timer,
+)
 from ridge.utils.rawconfig import LocationData, SearchResponse
 from ridge.utils.state import SearchType
 
@@ -66,6 +78,7 @@ logger = logging.getLogger(__name__)
 conversation_command_rate_limiter = ConversationCommandRateLimiter(
     trial_rate_limit=2, subscribed_rate_limit=100, slug="command"
 )
+SPECULATIVE_DOCUMENT_SEARCH = is_env_var_true("RIDGE_SPECULATIVE_DOCUMENT_SEARCH")
 
 
 @api.delete("/self")
@@ -119,6 +132,8 @@ async def execute_search(
     max_distance: Optional[Union[float, None]] = None,
     dedupe: Optional[bool] = True,
     agent: Optional[Agent] = None,
+    request_context: Optional[ChatRequestContext] = None,
+    cancelled: Optional[Callable[[], bool]] = None,
 ):
     # Run validation checks
     results: List[SearchResponse] = []
@@ -151,12 +166,22 @@ async def execute_search(
     for filter in [DateFilter(), WordFilter(), FileFilter()]:
         defiltered_query = filter.defilter(defiltered_query)
 
+    # Stop early if the search results are no longer needed
+    if cancelled and cancelled():
+        return results
+
     encoded_asymmetric_query = None
     if t != SearchType.Image:
-        with timer("Encoding query took", logger=logger):
-            search_model = await sync_to_async(get_default_search_model)()
+        with timer("Encoding query took", logger=logger, span="embedding"):
+            if request_context:
+                search_model = request_context.search_model
+            else:
+                search_model = await sync_to_async(get_default_search_model)()
             encoded_asymmetric_query = state.embeddings_model[search_model.name].embed_query(defiltered_query)
 
+    if cancelled and cancelled():
+        return results
+
     with concurrent.futures.ThreadPoolExecutor() as executor:
         if t in [
             SearchType.All,
@@ -181,7 +206,7 @@ async def execute_search(
             ]
 
         # Query across each requested content types in parallel
-        with timer("Query took", logger):
+        with timer("Query took", logger, span="search"):
             for search_future in concurrent.futures.as_completed(search_futures):
                 hits = await search_future.result()
                 # Collate results
@@ -202,6 +227,53 @@ async def execute_search(
     return results
 
 
+async def speculative_document_search(
+    user: RidgeUser,
+    q: str,
+    n: int,
+    d: float,
+    file_filters: List[str] = [],
+    agent: Agent = None,
+) -> Optional[List[SearchResponse]]:
+    """
+    Search the user's documents with the raw user message, before the chat tools are selected.
+
+    The search runs on a separate event loop in a worker thread to overlap with the tool selection call.
+    Cancelling the search stops the worker thread at the next search step.
+    Returns None if the search fails, so the caller falls back to the regular document search.
+    """
+    defiltered_query = defilter_query(q)
+    filters_in_query = q.replace(defiltered_query, "").strip()
+    filters_in_query += " ".join([f'file:"{filter}"' for filter in file_filters])
+
+    search_cancelled = threading.Event()
+
+    def search_documents():
+        return asyncio.run(
+            execute_search(
+                user,
+                f"{defiltered_query} {filters_in_query}",
+                n=n,
+                t=SearchType.All,
+                r=True,
+                max_distance=d,
+                dedupe=False,
+                agent=agent,
+                cancelled=search_cancelled.is_set,
+            )
+        )
+
+    try:
+        with timer("Speculative document search took", logger, span="speculative_search"):
+            return await asyncio.to_thread(search_documents)
+    except asyncio.CancelledError:
+        search_cancelled.set()
+        raise
+    except Exception as e:
+        logger.warning(f"Speculative document search failed: {e}", exc_info=True)
+        return None
+
+
 @api.get("/update")
 @requires(["authenticated"])
 def update(
@@ -244,6 +316,7 @@ async def transcribe(
     request: Request,
     common: CommonQueryParams,
     file: UploadFile = File(...),
+    stream: Optional[bool] = False,
     rate_limiter_per_minute=Depends(
         ApiUserRateLimiter(requests=20, subscribed_requests=20, window=60, slug="transcribe_minute")
     ),
@@ -254,6 +327,8 @@ async def transcribe(
     user: RidgeUser = request.user.object
     audio_filename = f"{user.uuid}-{str(uuid.uuid4())}.webm"
     user_message: str = None
+    transcription_stream: AsyncGenerator[str, None] = None
+    status_code: int = None
 
     # If the file is too large, return an unprocessable entity error
     if file.size > 10 * 1024 * 1024:
@@ -275,7 +350,12 @@ async def transcribe(
             status_code = 501
         elif speech_to_text_config.model_type == SpeechToTextModelOptions.ModelType.OFFLINE:
             speech2text_model = speech_to_text_config.model_name
-            user_message = await transcribe_audio_offline(audio_filename, speech2text_model)
+            if stream:
+                # Decode audio before the temporary audio file is deleted to transcribe it while streaming
+                audio = await load_audio(audio_filename)
+                transcription_stream = transcribe_audio_offline_stream(audio, speech2text_model)
+            else:
+                user_message = await transcribe_audio_offline(audio_filename, speech2text_model)
         elif speech_to_text_config.model_type == SpeechToTextModelOptions.ModelType.OPENAI:
             speech2text_model = speech_to_text_config.model_name
             if speech_to_text_config.ai_model_api:
@@ -293,7 +373,7 @@ async def transcribe(
         audio_file.close()
         os.remove(audio_filename)
 
-    if user_message is None:
+    if user_message is None and transcription_stream is None:
         return Response(status_code=status_code or 500)
 
     update_telemetry_state(
@@ -303,6 +383,15 @@ async def transcribe(
         **common.__dict__,
     )
 
+    # Stream the spoken text of each speech segment as it is transcribed
+    if transcription_stream is not None:
+
+        async def stream_transcription():
+            async for text in transcription_stream:
+                yield json.dumps({"text": text}) + "\n"
+
+        return StreamingResponse(stream_transcription(), media_type="application/x-ndjson")
+
     # Return the spoken text
     content = json.dumps({"text": user_message})
     return Response(content=content, media_type="application/json", status_code=200)
@@ -365,6 +454,8 @@ async def extract_references_and_questions(
     previous_inferred_queries: Set = set(),
     agent: Agent = None,
     query_files: str = None,
+    speculative_results: Optional[List[SearchResponse]] = None,
+    request_context: Optional[ChatRequestContext] = None,
     tracer: dict = {},
 ):
     # Initialize Variables
@@ -413,10 +504,26 @@ async def extract_references_and_questions(
 
     personality_context = prompts.personality_context.format(personality=agent.personality) if agent else ""
 
+    if request_context:
+        chat_model = request_context.chat_model
+    else:
+        chat_model = await ConversationAdapters.aget_default_chat_model(user)
+
+    # Use the documents found by searching with the raw user message while the chat tools were being selected
+    if speculative_results is not None and not should_limit_to_agent_knowledge:
+        n_items = min(n, 3) if chat_model.model_type == ChatModel.ModelType.OFFLINE else n
+        inferred_queries = [defiltered_query]
+        search_results = list(text_search.deduplicated_search_responses(speculative_results))[:n_items]
+        compiled_references = [
+            {"query": defiltered_query, "compiled": item.additional["compiled"], "file": item.additional["file"]}
+            for item in search_results
+        ]
+        yield compiled_references, inferred_queries, defiltered_query
+        return
+
     # Infer search queries from user message
-    with timer("Extracting search queries took", logger):
+    with timer("Extracting search queries took", logger, span="query_extraction"):
         # If we've reached here, either the user has enabled offline chat or the openai model is enabled.
-        chat_model = await ConversationAdapters.aget_default_chat_model(user)
         vision_enabled = chat_model.vision_enabled
 
         if chat_model.model_type == ChatModel.ModelType.OFFLINE:
@@ -499,8 +606,9 @@ async def extract_references_and_questions(
 
     # Collate search results as context for GPT
     inferred_queries = list(set(inferred_queries) - previous_inferred_queries)
-    with timer("Searching knowledge base took", logger):
+    with timer("Searching knowledge base took", logger, span="document_search"):
         search_results = []
+        search_result_queries: Dict[str, str] = {}
         logger.info(f"🔍 Searching knowledge base with queries: {inferred_queries}")
         if send_status_func:
             inferred_queries_str = "\n- " + "\n- ".join(inferred_queries)
@@ -508,22 +616,31 @@ async def extract_references_and_questions(
                 yield {ChatEvent.STATUS: event}
         for query in inferred_queries:
             n_items = min(n, 3) if using_offline_chat else n
-            search_results.extend(
-                await execute_search(
-                    user if not should_limit_to_agent_knowledge else None,
-                    f"{query} {filters_in_query}",
-                    n=n_items,
-                    t=SearchType.All,
-                    r=True,
-                    max_distance=d,
-                    dedupe=False,
-                    agent=agent,
-                )
+            query_search_results = await execute_search(
+                user if not should_limit_to_agent_knowledge else None,
+                f"{query} {filters_in_query}",
+                n=n_items,
+                t=SearchType.All,
+                r=True,
+                max_distance=d,
+                dedupe=False,
+                agent=agent,
+                request_context=request_context,
             )
-        search_results = text_search.deduplicated_search_responses(search_results)
+            for item in query_search_results:
+                search_result_queries.setdefault(item.corpus_id, query)
+            search_results.extend(query_search_results)
+        # Order the distinct search results of all queries by relevance
+        search_results = list(text_search.deduplicated_search_responses(search_results))
+        rank_results = all(item.cross_score is not None for item in search_results)
+        search_results = text_search.sort_results(rank_results=rank_results, hits=search_results)
         compiled_references = [
-            {"query": q, "compiled": item.additional["compiled"], "file": item.additional["file"]}
-            for q, item in zip(inferred_queries, search_results)
+            {
+                "query": search_result_queries[item.corpus_id],
+                "compiled": item.additional["compiled"],
+                "file": item.additional["file"],
+            }
+            for item in search_results
         ]
 
     yield compiled_references, inferred_queries, defiltered_query
@@ -533,6 +650,13 @@ async def extract_references_and_questions(
 @requires(["authenticated"], status_code=200)
 def health_check(request: Request) -> Response:
     response_obj = {"email": request.user.object.email}
+    # Report offline chat model load progress
+    if state.offline_chat_load_status.get("model"):
+        response_obj["offline_chat"] = state.offline_chat_load_status
+    # Report offline chat request scheduling stats
+    if state.offline_chat_processor_config and state.offline_chat_processor_config.loaded_model:
+        scheduler = get_offline_chat_scheduler(state.offline_chat_processor_config.loaded_model)
+        response_obj["offline_chat_scheduler"] = scheduler.stats()
     return Response(content=json.dumps(response_obj), media_type="application/json", status_code=200)
 
 
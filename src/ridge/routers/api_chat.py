@@ -2,17 +2,19 @@ import asyncio
 import base64
 import json
 import logging
+import os
 import time
 import uuid
 from datetime import datetime
 from functools import partial
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncGenerator, Dict, List, Optional
 from urllib.parse import unquote
 
 from asgiref.sync import sync_to_async
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from starlette.authentication import has_required_scope, requires
+from starlette.background import BackgroundTask
 
 from ridge.app.settings import ALLOWED_HOSTS
 from ridge.database.adapters import (
@@ -34,13 +36,19 @@ from ridge.processor.tools.online_search import (
     search_online,
 )
 from ridge.processor.tools.run_code import run_code
-from ridge.routers.api import extract_references_and_questions
+from ridge.routers.api import (
+    SPECULATIVE_DOCUMENT_SEARCH,
+    extract_references_and_questions,
+    speculative_document_search,
+)
 from ridge.routers.email import send_query_feedback
 from ridge.routers.helpers import (
     ApiImageRateLimiter,
     ApiUserRateLimiter,
     ChatEvent,
     ChatRequestBody,
+    ChatRequestContext,
+    ClientDisconnectMonitor,
     CommonQueryParams,
     ConversationCommandRateLimiter,
     DeleteMessageRequestBody,
@@ -68,12 +76,14 @@ from ridge.routers.storage import upload_user_image_to_bucket
 from ridge.utils import state
 from ridge.utils.helpers import (
     ConversationCommand,
+    coalesce_chunks,
     command_descriptions,
     convert_image_to_webp,
     get_country_code_from_timezone,
     get_country_name_from_timezone,
     get_device,
     is_none_or_empty,
+    run_tools_concurrently,
 )
 from ridge.utils.rawconfig import (
     ChatRequestBody,
@@ -82,12 +92,16 @@ from ridge.utils.rawconfig import (
     FilesFilterRequest,
     LocationData,
 )
+from ridge.utils.tracing import Span, set_trace_attributes
 
 # Initialize Router
 logger = logging.getLogger(__name__)
 conversation_command_rate_limiter = ConversationCommandRateLimiter(
     trial_rate_limit=20, subscribed_rate_limit=75, slug="command"
 )
+# Flush streamed chat response chunks to the client every few milliseconds or bytes
+STREAM_FLUSH_INTERVAL = float(os.getenv("RIDGE_STREAM_FLUSH_INTERVAL", 0.03))
+STREAM_FLUSH_SIZE = int(os.getenv("RIDGE_STREAM_FLUSH_SIZE", 512))
 
 
 api_chat = APIRouter()
@@ -248,7 +262,8 @@ def chat_history(
                 "is_hidden": conversation.agent.is_hidden,
             }
 
-    meta_log = conversation.conversation_log
+    # Get latest N messages if N > 0. Else return all messages except latest N
+    meta_log = ConversationAdapters.get_conversation_log(conversation, n=n)
     meta_log.update(
         {
             "conversation_id": conversation.id,
@@ -258,14 +273,6 @@ def chat_history(
         }
     )
 
-    if n:
-        # Get latest N messages if N > 0
-        if n > 0 and meta_log.get("chat"):
-            meta_log["chat"] = meta_log["chat"][-n:]
-        # Else return all messages except latest N
-        elif n < 0 and meta_log.get("chat"):
-            meta_log["chat"] = meta_log["chat"][:n]
-
     update_telemetry_state(
         request=request,
         telemetry_type="api",
@@ -321,7 +328,8 @@ def get_shared_chat(
                 "is_hidden": conversation.agent.is_hidden,
             }
 
-    meta_log = conversation.conversation_log
+    # Get latest N messages if N > 0. Else return all messages except latest N
+    meta_log = PublicConversationAdapters.get_public_conversation_log(conversation, n=n)
     scrubbed_title = conversation.title if conversation.title else conversation.slug
 
     if scrubbed_title:
@@ -336,14 +344,6 @@ def get_shared_chat(
         }
     )
 
-    if n:
-        # Get latest N messages if N > 0
-        if n > 0 and meta_log.get("chat"):
-            meta_log["chat"] = meta_log["chat"][-n:]
-        # Else return all messages except latest N
-        elif n < 0 and meta_log.get("chat"):
-            meta_log["chat"] = meta_log["chat"][:n]
-
     update_telemetry_state(
         request=request,
         telemetry_type="api",
@@ -675,6 +675,9 @@ async def chat(
     raw_images = body.images
     raw_query_files = body.files
 
+    # Speculative tasks started by the chat request. Cancelled once the response ends, if still running
+    speculative_tasks: List[asyncio.Task] = []
+
     async def event_generator(q: str, images: list[str]):
         start_time = time.perf_counter()
         ttft = None
@@ -684,7 +687,7 @@ async def chat(
         is_subscribed = has_required_scope(request, ["premium"])
         event_delimiter = "␃🔚␗"
         q = unquote(q)
-        train_of_thought = []
+        train_of_thought: List[Dict[str, Any]] = []
         nonlocal conversation_id
         nonlocal raw_query_files
 
@@ -715,7 +718,7 @@ async def chat(
 
         async def send_event(event_type: ChatEvent, data: str | dict):
             nonlocal connection_alive, ttft, train_of_thought
-            if not connection_alive or await request.is_disconnected():
+            if not connection_alive or disconnect_monitor.disconnected:
                 connection_alive = False
                 logger.warning(f"User {user} disconnected from {common.client} client")
                 return
@@ -727,10 +730,13 @@ async def chat(
                 elif event_type == ChatEvent.STATUS:
                     train_of_thought.append({"type": event_type.value, "data": data})
 
+                event: str | dict = ""
                 if event_type == ChatEvent.MESSAGE:
-                    yield data
+                    event = data
                 elif event_type == ChatEvent.REFERENCES or ChatEvent.METADATA or stream:
-                    yield json.dumps({"type": event_type.value, "data": data}, ensure_ascii=False)
+                    event = json.dumps({"type": event_type.value, "data": data}, ensure_ascii=False)
+                # Send the event and its delimiter in a single write
+                yield f"{event}{event_delimiter}"
             except asyncio.CancelledError as e:
                 connection_alive = False
                 logger.warn(f"User {user} disconnected from {common.client} client: {e}")
@@ -739,8 +745,6 @@ async def chat(
                 connection_alive = False
                 logger.error(f"Failed to stream chat API response to {user} on {common.client}: {e}", exc_info=True)
                 return
-            finally:
-                yield event_delimiter
 
         async def send_llm_response(response: str, usage: dict = None):
             # Send Chat Response
@@ -811,12 +815,16 @@ async def chat(
                 yield result
             return
         conversation_id = conversation.id
+        set_trace_attributes(conversation_id=str(conversation_id), turn_id=turn_id)
 
         async for event in send_event(ChatEvent.METADATA, {"conversationId": str(conversation_id), "turnId": turn_id}):
             yield event
 
+        # Resolve chat configuration once to share across the chat actors used to respond
+        request_context = await ChatRequestContext.acreate(user, is_subscribed)
+
         agent: Agent | None = None
-        default_agent = await AgentAdapters.aget_default_agent()
+        default_agent = request_context.default_agent
         if conversation.agent and conversation.agent != default_agent:
             agent = conversation.agent
 
@@ -831,7 +839,7 @@ async def chat(
         if city or region or country or country_code:
             location = LocationData(city=city, region=region, country=country, country_code=country_code)
         user_message_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        meta_log = conversation.conversation_log
+        meta_log = await ConversationAdapters.aget_conversation_log(conversation)
 
         researched_results = ""
         online_results: Dict = dict()
@@ -848,7 +856,14 @@ async def chat(
         generated_mermaidjs_diagram: str = None
         program_execution_context: List[str] = []
 
+        speculative_search: Optional[asyncio.Task] = None
         if conversation_commands == [ConversationCommand.Default]:
+            # Start searching documents with the raw query while the tools to use are being selected
+            if SPECULATIVE_DOCUMENT_SEARCH:
+                speculative_search = asyncio.create_task(
+                    speculative_document_search(user, q, (n or 7), d, file_filters, agent)
+                )
+                speculative_tasks.append(speculative_search)
             try:
                 chosen_io = await aget_data_sources_and_output_format(
                     q,
@@ -858,6 +873,7 @@ async def chat(
                     query_images=uploaded_images,
                     agent=agent,
                     query_files=attached_file_context,
+                    request_context=request_context,
                     tracer=tracer,
                 )
             except ValueError as e:
@@ -870,6 +886,11 @@ async def chat(
             if ConversationCommand.Research in conversation_commands:
                 conversation_commands = [ConversationCommand.Research]
 
+            # Discard the speculative document search if notes were not selected as a data source
+            if speculative_search and ConversationCommand.Notes not in conversation_commands:
+                speculative_search.cancel()
+                speculative_search = None
+
             conversation_commands_str = ", ".join([cmd.value for cmd in conversation_commands])
             async for result in send_event(ChatEvent.STATUS, f"**Selected Tools:** {conversation_commands_str}"):
                 yield result
@@ -900,6 +921,7 @@ async def chat(
                 file_filters=conversation.file_filters if conversation else [],
                 query_files=attached_file_context,
                 tracer=tracer,
+                request_context=request_context,
             ):
                 if isinstance(research_result, InformationCollectionIteration):
                     if research_result.summarizedResult:
@@ -1004,7 +1026,6 @@ async def chat(
                     q,
                     llm_response,
                     user,
-                    meta_log,
                     user_message_time,
                     intent_type="automation",
                     client_application=request.user.client_app,
@@ -1023,9 +1044,14 @@ async def chat(
             return
 
         # Gather Context
+        # Independent data sources are gathered concurrently. Tools that use the gathered context wait for it.
+        direct_web_pages: Dict[str, Dict] = dict()
+
         ## Extract Document References
-        if not ConversationCommand.Research in conversation_commands:
+        async def gather_document_references():
+            nonlocal defiltered_query
             try:
+                speculative_results = await speculative_search if speculative_search else None
                 async for result in extract_references_and_questions(
                     user,
                     meta_log,
@@ -1039,6 +1065,8 @@ async def chat(
                     query_images=uploaded_images,
                     agent=agent,
                     query_files=attached_file_context,
+                    speculative_results=speculative_results,
+                    request_context=request_context,
                     tracer=tracer,
                 ):
                     if isinstance(result, dict) and ChatEvent.STATUS in result:
@@ -1064,16 +1092,9 @@ async def chat(
                 async for result in send_event(ChatEvent.STATUS, f"**Found Relevant Notes**: {headings}"):
                     yield result
 
-            if conversation_commands == [ConversationCommand.Notes] and not await EntryAdapters.auser_has_entries(user):
-                async for result in send_llm_response(f"{no_entries_found.format()}", tracer.get("usage")):
-                    yield result
-                return
-
-        if ConversationCommand.Notes in conversation_commands and is_none_or_empty(compiled_references):
-            conversation_commands.remove(ConversationCommand.Notes)
-
         ## Gather Online References
-        if ConversationCommand.Online in conversation_commands:
+        async def gather_online_references():
+            nonlocal online_results
             try:
                 async for result in search_online(
                     defiltered_query,
@@ -1085,6 +1106,7 @@ async def chat(
                     query_images=uploaded_images,
                     agent=agent,
                     query_files=attached_file_context,
+                    request_context=request_context,
                     tracer=tracer,
                 ):
                     if isinstance(result, dict) and ChatEvent.STATUS in result:
@@ -1100,7 +1122,7 @@ async def chat(
                     yield result
 
         ## Gather Webpage References
-        if ConversationCommand.Webpage in conversation_commands:
+        async def gather_webpage_references():
             try:
                 async for result in read_webpages(
                     defiltered_query,
@@ -1112,19 +1134,15 @@ async def chat(
                     query_images=uploaded_images,
                     agent=agent,
                     query_files=attached_file_context,
+                    request_context=request_context,
                     tracer=tracer,
                 ):
                     if isinstance(result, dict) and ChatEvent.STATUS in result:
                         yield result[ChatEvent.STATUS]
                     else:
-                        direct_web_pages = result
+                        direct_web_pages.update(result)
                 webpages = []
                 for query in direct_web_pages:
-                    if online_results.get(query):
-                        online_results[query]["webpages"] = direct_web_pages[query]["webpages"]
-                    else:
-                        online_results[query] = {"webpages": direct_web_pages[query]["webpages"]}
-
                     for webpage in direct_web_pages[query]["webpages"]:
                         webpages.append(webpage["link"])
                 async for result in send_event(ChatEvent.STATUS, f"**Read web pages**: {webpages}"):
@@ -1139,8 +1157,19 @@ async def chat(
                 ):
                     yield result
 
+        def merge_webpage_references():
+            # Merge directly read webpages into online results once both tools are done
+            for query in list(direct_web_pages):
+                webpages = direct_web_pages.pop(query)["webpages"]
+                if online_results.get(query):
+                    online_results[query]["webpages"] = webpages
+                else:
+                    online_results[query] = {"webpages": webpages}
+
         ## Gather Code Results
-        if ConversationCommand.Code in conversation_commands:
+        async def gather_code_results():
+            nonlocal code_results
+            merge_webpage_references()
             try:
                 context = f"# Iteration 1:\n#---\nNotes:\n{compiled_references}\n\nOnline Results:{online_results}"
                 async for result in run_code(
@@ -1153,6 +1182,7 @@ async def chat(
                     query_images=uploaded_images,
                     agent=agent,
                     query_files=attached_file_context,
+                    request_context=request_context,
                     tracer=tracer,
                 ):
                     if isinstance(result, dict) and ChatEvent.STATUS in result:
@@ -1168,6 +1198,35 @@ async def chat(
                     exc_info=True,
                 )
 
+        tools_to_run = {}
+        if not ConversationCommand.Research in conversation_commands:
+            tools_to_run[ConversationCommand.Notes] = gather_document_references
+        if ConversationCommand.Online in conversation_commands:
+            tools_to_run[ConversationCommand.Online] = gather_online_references
+        if ConversationCommand.Webpage in conversation_commands:
+            tools_to_run[ConversationCommand.Webpage] = gather_webpage_references
+        if ConversationCommand.Code in conversation_commands:
+            tools_to_run[ConversationCommand.Code] = gather_code_results
+        tool_dependencies = {
+            ConversationCommand.Code: {
+                ConversationCommand.Notes,
+                ConversationCommand.Online,
+                ConversationCommand.Webpage,
+            }
+        }
+
+        async for result in run_tools_concurrently(tools_to_run, tool_dependencies):
+            yield result
+        merge_webpage_references()
+
+        if conversation_commands == [ConversationCommand.Notes] and not await EntryAdapters.auser_has_entries(user):
+            async for result in send_llm_response(f"{no_entries_found.format()}", tracer.get("usage")):
+                yield result
+            return
+
+        if ConversationCommand.Notes in conversation_commands and is_none_or_empty(compiled_references):
+            conversation_commands.remove(ConversationCommand.Notes)
+
         ## Send Gathered References
         unique_online_results = deduplicate_organic_results(online_results)
         async for result in send_event(
@@ -1304,6 +1363,8 @@ async def chat(
             generated_asset_results,
             is_subscribed,
             tracer,
+            cancelled=lambda: disconnect_monitor.disconnected,
+            request_context=request_context,
         )
 
         # Send Response
@@ -1311,19 +1372,21 @@ async def chat(
             yield result
 
         continue_stream = True
-        async for item in llm_response:
-            # Should not happen with async generator, end is signaled by loop exit. Skip.
-            if item is None:
-                continue
-            if not connection_alive or not continue_stream:
-                # Drain the generator if disconnected but keep processing internally
-                continue
-            try:
-                async for result in send_event(ChatEvent.MESSAGE, f"{item}"):
-                    yield result
-            except Exception as e:
-                continue_stream = False
-                logger.info(f"User {user} disconnected or error during streaming. Stopping send: {e}")
+        with Span("llm_stream", chat_model=chat_metadata.get("chat_model")) as llm_span:
+            llm_start_time = time.perf_counter()
+            # Coalesce streamed response chunks to send fewer, larger chunks to the client
+            async for item in coalesce_chunks(llm_response, STREAM_FLUSH_INTERVAL, STREAM_FLUSH_SIZE):
+                if "llm_ttft" not in llm_span.attributes:
+                    llm_span.set_attributes(llm_ttft=time.perf_counter() - llm_start_time)
+                if not connection_alive or not continue_stream:
+                    # Drain the generator if disconnected but keep processing internally
+                    continue
+                try:
+                    async for result in send_event(ChatEvent.MESSAGE, f"{item}"):
+                        yield result
+                except Exception as e:
+                    continue_stream = False
+                    logger.info(f"User {user} disconnected or error during streaming. Stopping send: {e}")
 
         # Signal end of LLM response after the loop finishes
         if connection_alive:
@@ -1337,11 +1400,31 @@ async def chat(
                 yield result
             logger.debug("Finished streaming response")
 
+    async def cancel_speculative_tasks_on_exit(response_iterator: AsyncGenerator):
+        "Stop unused speculative work when the response ends early, errors out or the client goes away"
+        try:
+            async for event in response_iterator:
+                yield event
+        finally:
+            for task in speculative_tasks:
+                task.cancel()
+
+    # Detect client disconnects in the background instead of checking the connection for each chunk sent
+    disconnect_monitor = ClientDisconnectMonitor(request)
+    disconnect_monitor.start()
+
     ## Stream Text Response
     if stream:
-        return StreamingResponse(event_generator(q, images=raw_images), media_type="text/plain")
+        return StreamingResponse(
+            cancel_speculative_tasks_on_exit(event_generator(q, images=raw_images)),
+            media_type="text/plain",
+            background=BackgroundTask(disconnect_monitor.stop),
+        )
     ## Non-Streaming Text Response
     else:
-        response_iterator = event_generator(q, images=raw_images)
-        response_data = await read_chat_stream(response_iterator)
+        response_iterator = cancel_speculative_tasks_on_exit(event_generator(q, images=raw_images))
+        try:
+            response_data = await read_chat_stream(response_iterator)
+        finally:
+            await disconnect_monitor.stop()
         return Response(content=json.dumps(response_data), media_type="application/json", status_code=200)
@@ -49,6 +49,7 @@ from ridge.routers.helpers import (
 )
 from ridge.utils import constants, state
 from ridge.utils.config import SearchModels
+from ridge.utils.helpers import clean_connections
 from ridge.utils.rawconfig import (
     ContentConfig,
     FullConfig,
@@ -86,7 +87,7 @@ class IndexerInput(BaseModel):
 
 async def run_in_executor(func, *args):
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, func, *args)
+    return await loop.run_in_executor(executor, clean_connections(func), *args)
 
 
 @api_content.put("")
@@ -307,7 +308,7 @@ async def delete_content_file(
 @requires(["authenticated"])
 async def get_content_size(request: Request, common: CommonQueryParams, client: Optional[str] = None):
     user = request.user.object
-    indexed_data_size_in_mb = await sync_to_async(EntryAdapters.get_size_of_indexed_data_in_mb)(user)
+    indexed_data_size_in_mb = await EntryAdapters.aget_size_of_indexed_data_in_mb(user)
     return Response(
         content=json.dumps({"indexed_data_size_in_mb": math.ceil(indexed_data_size_in_mb)}),
         media_type="application/json",
@@ -631,7 +632,7 @@ async def indexer(
         loop = asyncio.get_event_loop()
         success = await loop.run_in_executor(
             None,
-            configure_content,
+            clean_connections(configure_content),
             user,
             indexer_input.model_dump(),
             regenerate,
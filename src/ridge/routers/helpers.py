@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import hashlib
 import json
@@ -5,6 +6,7 @@ import logging
 import math
 import os
 import re
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
 from functools import partial
 from random import random
@@ -49,6 +51,7 @@ from ridge.database.adapters import (
     get_ridge_tokens,
     get_user_name,
     get_user_notion_config,
+    get_default_search_model,
     get_user_subscription_state,
     run_with_process_lock,
 )
@@ -62,6 +65,7 @@ from ridge.database.models import (
     NotionConfig,
     ProcessLock,
     RateLimitRecord,
+    SearchModelConfig,
     Subscription,
     TextToImageModelConfig,
     UserRequests,
@@ -96,8 +100,12 @@ from ridge.processor.conversation.utils import (
     clean_json,
     clean_mermaidjs,
     construct_chat_history,
+    count_tokens,
     generate_chatml_messages_with_context,
+    get_max_prompt_size,
+    pack_context,
     save_to_conversation_log,
+    tokenizer_registry,
 )
 from ridge.processor.speech.text_to_speech import is_eleven_labs_enabled
 from ridge.routers.email import is_resend_enabled, send_task_email
@@ -126,6 +134,52 @@ NOTION_OAUTH_CLIENT_ID = os.getenv("NOTION_OAUTH_CLIENT_ID")
 NOTION_OAUTH_CLIENT_SECRET = os.getenv("NOTION_OAUTH_CLIENT_SECRET")
 NOTION_REDIRECT_URI = os.getenv("NOTION_REDIRECT_URI")
 
+# Chat actors to cache responses of. Set to a comma separated list of chat actors or "all"
+LLM_RESPONSE_CACHE_ACTORS = {actor.strip() for actor in os.getenv("RIDGE_LLM_RESPONSE_CACHE", "").split(",") if actor}
+# Max tokens per document chunk to summarize. Defaults to half the max prompt size of the chat model
+SUMMARY_CHUNK_TOKENS = int(os.getenv("RIDGE_SUMMARY_CHUNK_TOKENS", 0))
+# Max document chunks to summarize concurrently per summary
+SUMMARY_CONCURRENCY = int(os.getenv("RIDGE_SUMMARY_CONCURRENCY", 4))
+
+
+@dataclass
+class ChatRequestContext:
+    """
+    Chat configuration of a user, resolved once per chat request and shared by the chat actors.
+    Avoids repeating the same configuration lookups in each chat actor and research iteration.
+    """
+
+    user: RidgeUser
+    is_subscribed: bool
+    chat_model: ChatModel
+    vision_enabled_config: Optional[ChatModel]
+    default_agent: Optional[Agent]
+    search_model: SearchModelConfig
+    agent_chat_models: Dict[int, ChatModel] = field(default_factory=dict)
+
+    @classmethod
+    async def acreate(cls, user: RidgeUser, is_subscribed: Optional[bool] = None) -> "ChatRequestContext":
+        if is_subscribed is None:
+            is_subscribed = await ais_user_subscribed(user) if user else False
+        return cls(
+            user=user,
+            is_subscribed=is_subscribed,
+            chat_model=await ConversationAdapters.aget_default_chat_model(user, is_subscribed=is_subscribed),
+            vision_enabled_config=await ConversationAdapters.aget_vision_enabled_config(),
+            default_agent=await AgentAdapters.aget_default_agent(),
+            search_model=await sync_to_async(get_default_search_model)(),
+        )
+
+    async def aget_chat_model(self, agent_chat_model: ChatModel = None) -> ChatModel:
+        "Get chat model to use for the user, falling back to the agent chat model if the server default isn't set"
+        if agent_chat_model is None:
+            return self.chat_model
+        if agent_chat_model.id not in self.agent_chat_models:
+            self.agent_chat_models[agent_chat_model.id] = await ConversationAdapters.aget_default_chat_model(
+                self.user, agent_chat_model, is_subscribed=self.is_subscribed
+            )
+        return self.agent_chat_models[agent_chat_model.id]
+
 
 def is_query_empty(query: str) -> bool:
     return is_none_or_empty(query.strip())
@@ -278,7 +332,8 @@ async def acreate_title_from_history(
     """
     Create a title from the given conversation history
     """
-    chat_history = construct_chat_history(conversation.conversation_log)
+    conversation_log = await ConversationAdapters.aget_conversation_log(conversation)
+    chat_history = construct_chat_history(conversation_log)
 
     title_generation_prompt = prompts.conversation_title_generation.format(chat_history=chat_history)
 
@@ -295,7 +350,7 @@ async def acreate_title_from_query(query: str, user: RidgeUser = None) -> str:
     title_generation_prompt = prompts.subject_generation.format(query=query)
 
     with timer("Chat actor: Generate title from query", logger):
-        response = await send_message_to_model_wrapper(title_generation_prompt, user=user)
+        response = await send_message_to_model_wrapper(title_generation_prompt, user=user, actor="title_from_query")
 
     return response.strip()
 
@@ -318,7 +373,11 @@ async def acheck_if_safe_prompt(system_prompt: str, user: RidgeUser = None, lax:
 
     with timer("Chat actor: Check if safe prompt", logger):
         response = await send_message_to_model_wrapper(
-            safe_prompt_check, user=user, response_type="json_object", response_schema=SafetyCheck
+            safe_prompt_check,
+            user=user,
+            response_type="json_object",
+            response_schema=SafetyCheck,
+            actor="safe_prompt",
         )
 
         response = response.strip()
@@ -344,6 +403,7 @@ async def aget_data_sources_and_output_format(
     query_images: List[str] = None,
     agent: Agent = None,
     query_files: str = None,
+    request_context: ChatRequestContext = None,
     tracer: dict = {},
 ) -> Dict[str, Any]:
     """
@@ -400,7 +460,7 @@ async def aget_data_sources_and_output_format(
         source: List[str] = Field(..., min_items=1)
         output: str
 
-    with timer("Chat actor: Infer information sources to refer", logger):
+    with timer("Chat actor: Infer information sources to refer", logger, span="tool_selection"):
         response = await send_message_to_model_wrapper(
             relevant_tools_prompt,
             response_type="json_object",
@@ -408,6 +468,8 @@ async def aget_data_sources_and_output_format(
             user=user,
             query_files=query_files,
             agent_chat_model=agent_chat_model,
+            actor="data_sources",
+            request_context=request_context,
             tracer=tracer,
         )
 
@@ -459,6 +521,7 @@ async def infer_webpage_urls(
     query_images: List[str] = None,
     agent: Agent = None,
     query_files: str = None,
+    request_context: ChatRequestContext = None,
     tracer: dict = {},
 ) -> List[str]:
     """
@@ -497,6 +560,8 @@ async def infer_webpage_urls(
             user=user,
             query_files=query_files,
             agent_chat_model=agent_chat_model,
+            actor="webpage_urls",
+            request_context=request_context,
             tracer=tracer,
         )
 
@@ -523,6 +588,7 @@ async def generate_online_subqueries(
     query_images: List[str] = None,
     agent: Agent = None,
     query_files: str = None,
+    request_context: ChatRequestContext = None,
     tracer: dict = {},
 ) -> Set[str]:
     """
@@ -562,6 +628,8 @@ async def generate_online_subqueries(
             user=user,
             query_files=query_files,
             agent_chat_model=agent_chat_model,
+            actor="online_subqueries",
+            request_context=request_context,
             tracer=tracer,
         )
 
@@ -638,7 +706,12 @@ async def aschedule_query(
 
 
 async def extract_relevant_info(
-    qs: set[str], corpus: str, user: RidgeUser = None, agent: Agent = None, tracer: dict = {}
+    qs: set[str],
+    corpus: str,
+    user: RidgeUser = None,
+    agent: Agent = None,
+    request_context: ChatRequestContext = None,
+    tracer: dict = {},
 ) -> Union[str, None]:
     """
     Extract relevant information for a given query from the target corpus
@@ -664,6 +737,7 @@ async def extract_relevant_info(
         prompts.system_prompt_extract_relevant_information,
         user=user,
         agent_chat_model=agent_chat_model,
+        request_context=request_context,
         tracer=tracer,
     )
     return response.strip()
@@ -712,6 +786,131 @@ async def extract_relevant_summary(
     return response.strip()
 
 
+@dataclass
+class DocumentChunk:
+    file_name: str
+    text_hash: str
+    index: int
+    total: int
+    text: str
+    tokens: int
+
+
+def split_documents_into_chunks(
+    documents: Dict[str, str], chat_model: ChatModel, max_tokens: int
+) -> List[DocumentChunk]:
+    "Split each document into chunks of up to max_tokens tokens of the chat model"
+    encoder, _ = tokenizer_registry.get(chat_model.name, chat_model.tokenizer)
+    chunks: List[DocumentChunk] = []
+    for file_name, text in documents.items():
+        tokens = encoder.encode(text)
+        total = max(math.ceil(len(tokens) / max_tokens), 1)
+        for index in range(total):
+            chunk_tokens = tokens[index * max_tokens : (index + 1) * max_tokens]
+            chunk_text = encoder.decode(chunk_tokens)
+            text_hash = hashlib.md5(chunk_text.encode("utf-8", "surrogatepass")).hexdigest()
+            chunks.append(DocumentChunk(file_name, text_hash, index, total, chunk_text, len(chunk_tokens)))
+    return chunks
+
+
+async def summarize_document_chunk(
+    chunk: DocumentChunk,
+    chat_model: ChatModel,
+    semaphore: asyncio.Semaphore,
+    user: RidgeUser,
+    agent_chat_model: ChatModel = None,
+    tracer: dict = {},
+) -> str:
+    "Summarize part of a document. Reuse the summary of the same text by the same chat model"
+    cache_key = (chunk.text_hash, chat_model.name)
+    summary = state.document_summary_cache.get(cache_key)
+    if summary is not None:
+        return summary
+
+    summarize_chunk = prompts.summarize_document_chunk.format(
+        file_name=chunk.file_name, part=chunk.index + 1, total_parts=chunk.total, chunk=chunk.text.strip()
+    )
+    async with semaphore:
+        response = await send_message_to_model_wrapper(
+            summarize_chunk,
+            prompts.system_prompt_summarize_document_chunk,
+            user=user,
+            agent_chat_model=agent_chat_model,
+            tracer=tracer,
+        )
+    summary = response.strip()
+    state.document_summary_cache.set(cache_key, summary)
+    return summary
+
+
+def group_summaries_by_tokens(tokens: List[int], max_tokens: int) -> List[Tuple[int, int]]:
+    """
+    Group consecutive summaries into (start, end) index ranges of up to max_tokens tokens.
+    Each group has at least two summaries, so every round of combining the groups reduces the number of summaries.
+    """
+    groups: List[Tuple[int, int]] = []
+    start, group_tokens = 0, 0
+    for index, summary_tokens in enumerate(tokens):
+        if index - start >= 2 and group_tokens + summary_tokens > max_tokens:
+            groups.append((start, index))
+            start, group_tokens = index, 0
+        group_tokens += summary_tokens
+    if groups and len(tokens) - start < 2:
+        # Merge a trailing single summary into the previous group
+        groups[-1] = (groups[-1][0], len(tokens))
+    else:
+        groups.append((start, len(tokens)))
+    return groups
+
+
+async def reduce_document_summaries(
+    summaries: List[Tuple[str, str, str]],
+    max_tokens: int,
+    chat_model: ChatModel,
+    semaphore: asyncio.Semaphore,
+    user: RidgeUser,
+    agent_chat_model: ChatModel = None,
+    tracer: dict = {},
+) -> str:
+    """
+    Combine summaries of consecutive document parts in groups of up to max_tokens tokens.
+    Repeat until all the summaries fit within max_tokens tokens. Summaries are (first part, last part, summary) tuples.
+    """
+
+    def format_summary(first_part: str, last_part: str, summary: str) -> str:
+        parts = first_part if first_part == last_part else f"{first_part} to {last_part}"
+        return f"{parts}\n\n{summary}"
+
+    async def combine_summaries(formatted_summaries: List[str]) -> str:
+        combine_prompt = prompts.combine_document_summaries.format(summaries="\n\n".join(formatted_summaries))
+        async with semaphore:
+            response = await send_message_to_model_wrapper(
+                combine_prompt,
+                prompts.system_prompt_combine_document_summaries,
+                user=user,
+                agent_chat_model=agent_chat_model,
+                tracer=tracer,
+            )
+        return response.strip()
+
+    encoder, tokenizer_key = tokenizer_registry.get(chat_model.name, chat_model.tokenizer)
+    formatted_summaries = [format_summary(*summary) for summary in summaries]
+    while len(formatted_summaries) > 1:
+        tokens = [count_tokens(summary, encoder, tokenizer_key) for summary in formatted_summaries]
+        if sum(tokens) <= max_tokens:
+            break
+        groups = group_summaries_by_tokens(tokens, max_tokens)
+        combined_summaries = await asyncio.gather(
+            *[combine_summaries(formatted_summaries[start:end]) for start, end in groups]
+        )
+        summaries = [
+            (summaries[start][0], summaries[end - 1][1], combined_summary)
+            for (start, end), combined_summary in zip(groups, combined_summaries)
+        ]
+        formatted_summaries = [format_summary(*summary) for summary in summaries]
+    return "\n\n".join(formatted_summaries)
+
+
 async def generate_summary_from_files(
     q: str,
     user: RidgeUser,
@@ -730,20 +929,19 @@ async def generate_summary_from_files(
             if len(file_names) > 0:
                 file_objects = await FileObjectAdapters.aget_file_objects_by_name(None, file_names.pop(), agent)
 
-        if (file_objects and len(file_objects) == 0 and not query_files) or (not file_objects and not query_files):
+        if not file_objects and not query_files:
             response_log = "Sorry, I couldn't find anything to summarize."
             yield response_log
             return
 
-        contextual_data = " ".join([f"File: {file.file_name}\n\n{file.raw_text}" for file in file_objects])
-
+        documents = {file.file_name: file.raw_text for file in file_objects or []}
         if query_files:
-            contextual_data += f"\n\n{query_files}"
+            documents["Attached Files"] = query_files
 
         if not q:
             q = "Create a general summary of the file"
 
-        file_names = [file.file_name for file in file_objects]
+        file_names = [file.file_name for file in file_objects or []]
         file_names.extend(file_filters)
 
         all_file_names = ""
@@ -754,6 +952,38 @@ async def generate_summary_from_files(
         async for result in send_status_func(f"**Constructing Summary Using:**\n{all_file_names}"):
             yield {ChatEvent.STATUS: result}
 
+        # Split documents into chunks that fit comfortably within the context window of the chat model
+        agent_chat_model = await AgentAdapters.aget_agent_chat_model(agent, user) if agent else None
+        chat_model = await ConversationAdapters.aget_default_chat_model(user, agent_chat_model)
+        max_chunk_tokens = SUMMARY_CHUNK_TOKENS or get_max_prompt_size(chat_model.name, chat_model.max_prompt_size) // 2
+        chunks = await asyncio.to_thread(split_documents_into_chunks, documents, chat_model, max_chunk_tokens)
+
+        if sum(chunk.tokens for chunk in chunks) <= max_chunk_tokens:
+            contextual_data = " ".join([f"File: {file.file_name}\n\n{file.raw_text}" for file in file_objects or []])
+            if query_files:
+                contextual_data += f"\n\n{query_files}"
+        else:
+            # Summarize document chunks concurrently, then summarize the chunk summaries in response to the query
+            async for result in send_status_func(f"**Summarizing {len(chunks)} Parts of the Documents**"):
+                yield {ChatEvent.STATUS: result}
+            semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+            with timer(f"Chat actor: Summarize {len(chunks)} document chunks", logger):
+                chunk_summaries = await asyncio.gather(
+                    *[
+                        summarize_document_chunk(chunk, chat_model, semaphore, user, agent_chat_model, tracer)
+                        for chunk in chunks
+                    ]
+                )
+            # Combine the chunk summaries in rounds until they fit within a single prompt
+            summaries = []
+            for chunk, summary in zip(chunks, chunk_summaries):
+                part = f"File: {chunk.file_name}, Part {chunk.index + 1} of {chunk.total}"
+                summaries.append((part, part, summary))
+            with timer(f"Chat actor: Reduce {len(chunks)} document chunk summaries", logger):
+                contextual_data = await reduce_document_summaries(
+                    summaries, max_chunk_tokens, chat_model, semaphore, user, agent_chat_model, tracer
+                )
+
         response = await extract_relevant_summary(
             q,
             contextual_data,
@@ -768,7 +998,7 @@ async def generate_summary_from_files(
     except Exception as e:
         response_log = "Error summarizing file. Please try again, or contact support."
         logger.error(f"Error summarizing file for {user.email}: {e}", exc_info=True)
-        yield result
+        yield response_log
 
 
 async def generate_excalidraw_diagram(
@@ -1152,20 +1382,58 @@ async def send_message_to_model_wrapper(
     context: str = "",
     query_files: str = None,
     agent_chat_model: ChatModel = None,
+    actor: str = None,
+    request_context: ChatRequestContext = None,
     tracer: dict = {},
 ):
-    chat_model: ChatModel = await ConversationAdapters.aget_default_chat_model(user, agent_chat_model)
+    chat_model: ChatModel
+    if request_context:
+        chat_model = await request_context.aget_chat_model(agent_chat_model)
+    else:
+        chat_model = await ConversationAdapters.aget_default_chat_model(user, agent_chat_model)
     vision_available = chat_model.vision_enabled
     if not vision_available and query_images:
         logger.warning(f"Vision is not enabled for default model: {chat_model.name}.")
-        vision_enabled_config = await ConversationAdapters.aget_vision_enabled_config()
+        if request_context:
+            vision_enabled_config = request_context.vision_enabled_config
+        else:
+            vision_enabled_config = await ConversationAdapters.aget_vision_enabled_config()
         if vision_enabled_config:
             chat_model = vision_enabled_config
             vision_available = True
     if vision_available and query_images:
         logger.info(f"Using {chat_model.name} model to understand {len(query_images)} images.")
 
-    subscribed = await ais_user_subscribed(user)
+    # Return cached response to identical request by chat actor, if response caching enabled for chat actor
+    cache_key = None
+    if actor and (actor in LLM_RESPONSE_CACHE_ACTORS or "all" in LLM_RESPONSE_CACHE_ACTORS):
+        request = [
+            chat_model.name,
+            system_message,
+            query,
+            context,
+            query_images,
+            query_files,
+            response_type,
+            response_schema.model_json_schema() if response_schema else None,
+            deepthought,
+        ]
+        cache_key = hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+        cache_stats = state.llm_response_cache_stats[actor]
+        cached_response = state.llm_response_cache.get(cache_key)
+        if cached_response is not None:
+            response, cost = cached_response
+            cache_stats["hits"] += 1
+            cache_stats["saved_cost"] += cost
+            hit_rate = cache_stats["hits"] / (cache_stats["hits"] + cache_stats["misses"])
+            logger.debug(
+                f"Use cached {actor} chat actor response. Hit rate: {hit_rate:.0%}. Saved cost: ${cache_stats['saved_cost']:.4f}"
+            )
+            return response
+        cache_stats["misses"] += 1
+    prev_cost = tracer.get("usage", {}).get("cost", 0)
+
+    subscribed = request_context.is_subscribed if request_context else await ais_user_subscribed(user)
     chat_model_name = chat_model.name
     max_tokens = (
         chat_model.subscribed_max_prompt_size
@@ -1194,7 +1462,7 @@ async def send_message_to_model_wrapper(
             query_files=query_files,
         )
 
-        return send_message_to_model_offline(
+        response = send_message_to_model_offline(
             messages=truncated_messages,
             loaded_model=loaded_model,
             model_name=chat_model_name,
@@ -1221,7 +1489,7 @@ async def send_message_to_model_wrapper(
             query_files=query_files,
         )
 
-        return send_message_to_model(
+        response = send_message_to_model(
             messages=truncated_messages,
             api_key=api_key,
             model=chat_model_name,
@@ -1247,7 +1515,7 @@ async def send_message_to_model_wrapper(
             query_files=query_files,
         )
 
-        return anthropic_send_message_to_model(
+        response = anthropic_send_message_to_model(
             messages=truncated_messages,
             api_key=api_key,
             model=chat_model_name,
@@ -1272,7 +1540,7 @@ async def send_message_to_model_wrapper(
             query_files=query_files,
         )
 
-        return gemini_send_message_to_model(
+        response = gemini_send_message_to_model(
             messages=truncated_messages,
             api_key=api_key,
             model=chat_model_name,
@@ -1285,6 +1553,12 @@ async def send_message_to_model_wrapper(
     else:
         raise HTTPException(status_code=500, detail="Invalid conversation config")
 
+    if cache_key and response:
+        cost = tracer.get("usage", {}).get("cost", 0) - prev_cost
+        state.llm_response_cache.set(cache_key, (response, cost))
+
+    return response
+
 
 def send_message_to_model_wrapper_sync(
     message: str,
@@ -1432,7 +1706,9 @@ async def agenerate_chat_response(
     generated_asset_results: Dict[str, Dict] = {},
     is_subscribed: bool = False,
     tracer: dict = {},
-) -> Tuple[AsyncGenerator[str, None], Dict[str, str]]:
+    cancelled: Optional[Callable[[], bool]] = None,
+    request_context: ChatRequestContext = None,
+) -> Tuple[AsyncGenerator[str, None], Dict[str, Any]]:
     # Initialize Variables
     chat_response_generator = None
     logger.debug(f"Conversation Types: {conversation_commands}")
@@ -1445,7 +1721,6 @@ async def agenerate_chat_response(
             save_to_conversation_log,
             q,
             user=user,
-            meta_log=meta_log,
             compiled_references=compiled_references,
             online_results=online_results,
             code_results=code_results,
@@ -1473,13 +1748,31 @@ async def agenerate_chat_response(
         chat_model = await ConversationAdapters.aget_valid_chat_model(user, conversation, is_subscribed)
         vision_available = chat_model.vision_enabled
         if not vision_available and query_images:
-            vision_enabled_config = await ConversationAdapters.aget_vision_enabled_config()
+            if request_context:
+                vision_enabled_config = request_context.vision_enabled_config
+            else:
+                vision_enabled_config = await ConversationAdapters.aget_vision_enabled_config()
             if vision_enabled_config:
                 chat_model = vision_enabled_config
                 vision_available = True
 
+        # Pack the most relevant, distinct context for the chat model within the context budget of each source
+        loaded_model = state.offline_chat_processor_config.loaded_model if chat_model.model_type == "offline" else None
+        packed_context = pack_context(
+            compiled_references,
+            online_results,
+            code_results,
+            chat_model.name,
+            max_prompt_size=chat_model.max_prompt_size,
+            tokenizer_name=chat_model.tokenizer,
+            loaded_model=loaded_model,
+        )
+        compiled_references = packed_context.references
+        online_results = packed_context.online_results
+        code_results = packed_context.code_results
+        metadata["context_tokens"] = packed_context.tokens
+
         if chat_model.model_type == "offline":
-            loaded_model = state.offline_chat_processor_config.loaded_model
             chat_response_generator = converse_offline(
                 user_query=query_to_run,
                 references=compiled_references,
@@ -1497,6 +1790,7 @@ async def agenerate_chat_response(
                 query_files=query_files,
                 generated_files=raw_generated_files,
                 generated_asset_results=generated_asset_results,
+                cancelled=cancelled,
                 tracer=tracer,
             )
 
@@ -1682,7 +1976,7 @@ class ApiUserRateLimiter:
         self.window = window
         self.slug = slug
 
-    def __call__(self, request: Request):
+    async def __call__(self, request: Request):
         # Rate limiting disabled if billing is disabled
         if state.billing_enabled is False:
             return
@@ -1695,9 +1989,11 @@ class ApiUserRateLimiter:
         user: RidgeUser = request.user.object
         subscribed = has_required_scope(request, ["premium"])
 
-        # Remove requests outside of the time window
-        cutoff = django_timezone.now() - timedelta(seconds=self.window)
-        count_requests = UserRequests.objects.filter(user=user, created_at__gte=cutoff, slug=self.slug).count()
+        # Count requests in the time window and record the current request if within the rate limit
+        limit = self.subscribed_requests if subscribed else self.requests
+        allowed, count_requests = await state.rate_limiter.acheck_and_record(user.id, self.slug, self.window, limit)
+        if allowed:
+            return
 
         # Check if the user has exceeded the rate limit
         if subscribed and count_requests >= self.subscribed_requests:
@@ -1726,9 +2022,6 @@ class ApiUserRateLimiter:
                 detail="I'm glad you're enjoying interacting with me! You've unfortunately exceeded your usage limit for today. You can subscribe to increase your usage limit via [your settings](https://app.ridge.dev/settings) or we can continue our conversation tomorrow?",
             )
 
-        # Add the current request to the cache
-        UserRequests.objects.create(user=user, slug=self.slug)
-
 
 class ApiImageRateLimiter:
     def __init__(self, max_images: int = 10, max_combined_size_mb: float = 10):
@@ -1797,12 +2090,12 @@ class ConversationCommandRateLimiter:
         user: RidgeUser = request.user.object
         subscribed = has_required_scope(request, ["premium"])
 
-        # Remove requests outside of the 24-hr time window
-        cutoff = django_timezone.now() - timedelta(seconds=60 * 60 * 24)
+        # Count requests in the 24-hr time window and record the current request if within the rate limit
         command_slug = f"{self.slug}_{conversation_command.value}"
-        count_requests = await UserRequests.objects.filter(
-            user=user, created_at__gte=cutoff, slug=command_slug
-        ).acount()
+        limit = self.subscribed_rate_limit if subscribed else self.trial_rate_limit
+        allowed, count_requests = await state.rate_limiter.acheck_and_record(user.id, command_slug, 60 * 60 * 24, limit)
+        if allowed:
+            return
 
         if subscribed and count_requests >= self.subscribed_rate_limit:
             logger.info(
@@ -1820,8 +2113,6 @@ class ConversationCommandRateLimiter:
                 status_code=429,
                 detail=f"I'm glad you're enjoying interacting with me! You've unfortunately exceeded your `/{conversation_command.value}` command usage limit for today. You can subscribe to increase your usage limit via [your settings](https://app.ridge.dev/settings) or we can talk about something else for today?",
             )
-        await UserRequests.objects.acreate(user=user, slug=command_slug)
-        return
 
 
 class ApiIndexedDataLimiter:
@@ -2270,6 +2561,31 @@ class MessageProcessor:
         return json_data
 
 
+class ClientDisconnectMonitor:
+    """
+    Watch for the client disconnecting from a request in a background task.
+    Lets response streams check the connection state without polling the connection for each chunk sent.
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.disconnected = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while not self.disconnected:
+            message = await self.request.receive()
+            self.disconnected = message.get("type") == "http.disconnect"
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
 async def read_chat_stream(response_iterator: AsyncGenerator[str, None]) -> Dict[str, Any]:
     processor = MessageProcessor()
     event_delimiter = "␃🔚␗"
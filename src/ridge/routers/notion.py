@@ -12,6 +12,7 @@ from starlette.responses import RedirectResponse
 from ridge.database.adapters import aget_user_by_uuid
 from ridge.database.models import RidgeUser, NotionConfig
 from ridge.routers.helpers import configure_content
+from ridge.utils.helpers import clean_connections
 from ridge.utils.state import SearchType
 
 NOTION_OAUTH_CLIENT_ID = os.getenv("NOTION_OAUTH_CLIENT_ID")
@@ -27,7 +28,7 @@ logger = logging.getLogger(__name__)
 
 async def run_in_executor(func, *args):
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, func, *args)
+    return await loop.run_in_executor(executor, clean_connections(func), *args)
 
 
 @notion_router.get("/auth/callback")
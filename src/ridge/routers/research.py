@@ -2,7 +2,8 @@ import logging
 import os
 from datetime import datetime
 from enum import Enum
-from typing import Callable, Dict, List, Optional, Type
+from functools import partial
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Type
 
 import yaml
 from fastapi import Request
@@ -23,6 +24,7 @@ from ridge.processor.tools.run_code import run_code
 from ridge.routers.api import extract_references_and_questions
 from ridge.routers.helpers import (
     ChatEvent,
+    ChatRequestContext,
     generate_summary_from_files,
     send_message_to_model_wrapper,
 )
@@ -30,6 +32,7 @@ from ridge.utils.helpers import (
     ConversationCommand,
     function_calling_description_for_llm,
     is_none_or_empty,
+    run_tools_concurrently,
     timer,
     truncate_code_context,
 )
@@ -73,6 +76,27 @@ class PlanningResponse(BaseModel):
 
         return PlanningResponseWithTool
 
+    @classmethod
+    def create_parallel_model_with_enum(
+        cls: Type["PlanningResponse"], tool_options: dict, max_tool_calls: int
+    ) -> Type["PlanningResponse"]:
+        """
+        Factory method that creates a customized PlanningResponse model
+        to pick up to max_tool_calls tools to run in parallel, with the available tools as the tool field type.
+        """
+        tool_enum = Enum("ToolEnum", tool_options)  # type: ignore
+
+        class ToolCall(BaseModel):
+            tool: tool_enum = Field(..., description="Name of the tool to use")
+            query: str = Field(..., description="Detailed query for the selected tool")
+
+        class PlanningResponseWithTools(PlanningResponse):
+            tool_calls: List[ToolCall] = Field(
+                ..., description=f"Up to {max_tool_calls} independent tool calls to run in parallel"
+            )
+
+        return PlanningResponseWithTools
+
 
 async def apick_next_tool(
     query: str,
@@ -87,8 +111,13 @@ async def apick_next_tool(
     send_status_func: Optional[Callable] = None,
     tracer: dict = {},
     query_files: str = None,
+    request_context: ChatRequestContext = None,
+    max_tool_calls: int = 1,
 ):
-    """Given a query, determine which of the available tools the agent should use in order to answer appropriately."""
+    """
+    Given a query, determine which of the available tools the agent should use in order to answer appropriately.
+    Yields an information collection iteration for each tool to run next. Up to max_tool_calls tools can be picked to run in parallel.
+    """
 
     # Construct tool options for the agent to choose from
     tool_options = dict()
@@ -105,7 +134,16 @@ async def apick_next_tool(
             tool_options_str += f'- "{tool.value}": "{description}"\n'
 
     # Create planning reponse model with dynamically populated tool enum class
-    planning_response_model = PlanningResponse.create_model_with_enum(tool_options)
+    if max_tool_calls > 1:
+        planning_response_model = PlanningResponse.create_parallel_model_with_enum(tool_options, max_tool_calls)
+        tool_calls_instructions = prompts.plan_parallel_tool_calls_instructions.format(max_tool_calls=max_tool_calls)
+        stop_response = prompts.plan_parallel_tool_calls_stop_response
+        response_format = prompts.plan_parallel_tool_calls_response_format
+    else:
+        planning_response_model = PlanningResponse.create_model_with_enum(tool_options)
+        tool_calls_instructions = prompts.plan_single_tool_call_instructions
+        stop_response = prompts.plan_single_tool_call_stop_response
+        response_format = prompts.plan_single_tool_call_response_format
 
     # Construct chat history with user and iteration history with researcher agent for context
     chat_history = construct_chat_history(conversation_history, agent_name=agent.name if agent else "Ridge")
@@ -122,6 +160,9 @@ async def apick_next_tool(
     )
 
     function_planning_prompt = prompts.plan_function_execution.format(
+        tool_calls_instructions=tool_calls_instructions,
+        stop_response=stop_response,
+        response_format=response_format,
         tools=tool_options_str,
         chat_history=chat_history,
         personality_context=personality_context,
@@ -134,7 +175,7 @@ async def apick_next_tool(
     )
 
     try:
-        with timer("Chat actor: Infer information sources to refer", logger):
+        with timer("Chat actor: Infer information sources to refer", logger, span="tool_selection"):
             response = await send_message_to_model_wrapper(
                 query=query,
                 context=function_planning_prompt,
@@ -145,6 +186,7 @@ async def apick_next_tool(
                 query_images=query_images,
                 query_files=query_files,
                 agent_chat_model=agent_chat_model,
+                request_context=request_context,
                 tracer=tracer,
             )
     except Exception as e:
@@ -158,31 +200,38 @@ async def apick_next_tool(
 
     try:
         response = load_complex_json(response)
-        selected_tool = response.get("tool", None)
-        generated_query = response.get("query", None)
         scratchpad = response.get("scratchpad", None)
-        warning = None
+        if max_tool_calls > 1:
+            tool_calls = (response.get("tool_calls") or [])[:max_tool_calls]
+        else:
+            tool_calls = [{"tool": response.get("tool", None), "query": response.get("query", None)}]
         logger.info(f"Response for determining relevant tools: {response}")
 
+        # An empty list of tool calls signals that enough information has been collected
+        if not tool_calls:
+            yield InformationCollectionIteration(tool=None, query=None)
+            return
+
         # Detect selection of previously used query, tool combination.
         previous_tool_query_combinations = {(i.tool, i.query) for i in previous_iterations if i.warning is None}
-        if (selected_tool, generated_query) in previous_tool_query_combinations:
-            warning = f"Repeated tool, query combination detected. Skipping iteration. Try something different."
-        # Only send client status updates if we'll execute this iteration
-        elif send_status_func:
-            determined_tool_message = "**Determined Tool**: "
-            determined_tool_message += (
-                f"{selected_tool}({generated_query})." if selected_tool != ConversationCommand.Text else "respond."
+        next_iterations: List[InformationCollectionIteration] = []
+        for tool_call in tool_calls:
+            selected_tool, generated_query = tool_call.get("tool", None), tool_call.get("query", None)
+            warning = None
+            if (selected_tool, generated_query) in previous_tool_query_combinations:
+                warning = f"Repeated tool, query combination detected. Skipping iteration. Try something different."
+            previous_tool_query_combinations.add((selected_tool, generated_query))
+            next_iterations.append(
+                InformationCollectionIteration(tool=selected_tool, query=generated_query, warning=warning)
             )
-            determined_tool_message += f"\nReason: {scratchpad}" if scratchpad else ""
+
+        # Only send client status updates if we'll execute an iteration
+        if send_status_func and any(iteration.warning is None for iteration in next_iterations):
             async for event in send_status_func(f"{scratchpad}"):
                 yield {ChatEvent.STATUS: event}
 
-        yield InformationCollectionIteration(
-            tool=selected_tool,
-            query=generated_query,
-            warning=warning,
-        )
+        for iteration in next_iterations:
+            yield iteration
     except Exception as e:
         logger.error(f"Invalid response for determining relevant tools: {response}. {e}", exc_info=True)
         yield InformationCollectionIteration(
@@ -192,6 +241,18 @@ async def apick_next_tool(
         )
 
 
+def is_research_complete(iteration: InformationCollectionIteration) -> bool:
+    "Check if the planner signalled to stop research. That is, it picked the text tool or no valid tool, query to run next"
+    runnable_tools = [
+        ConversationCommand.Notes,
+        ConversationCommand.Online,
+        ConversationCommand.Webpage,
+        ConversationCommand.Code,
+        ConversationCommand.Summarize,
+    ]
+    return not iteration.warning and (not iteration.query or not iteration.tool or iteration.tool not in runnable_tools)
+
+
 async def execute_information_collection(
     user: RidgeUser,
     query: str,
@@ -205,17 +266,17 @@ async def execute_information_collection(
     file_filters: List[str] = [],
     tracer: dict = {},
     query_files: str = None,
+    request_context: ChatRequestContext = None,
 ):
+    # Resolve chat configuration once for all research iterations
+    request_context = request_context or await ChatRequestContext.acreate(user)
     current_iteration = 0
     MAX_ITERATIONS = int(os.getenv("RIDGE_RESEARCH_ITERATIONS", 5))
+    # Number of independent tools the planner can pick to run in parallel in each research step
+    MAX_TOOL_CALLS = int(os.getenv("RIDGE_RESEARCH_PARALLEL_TOOL_CALLS", 1))
     previous_iterations: List[InformationCollectionIteration] = []
     while current_iteration < MAX_ITERATIONS:
-        online_results: Dict = dict()
-        code_results: Dict = dict()
-        document_results: List[Dict[str, str]] = []
-        summarize_files: str = ""
-        this_iteration = InformationCollectionIteration(tool=None, query=query)
-
+        next_iterations: List[InformationCollectionIteration] = []
         async for result in apick_next_tool(
             query,
             conversation_history,
@@ -229,194 +290,254 @@ async def execute_information_collection(
             send_status_func,
             tracer=tracer,
             query_files=query_files,
+            request_context=request_context,
+            max_tool_calls=min(MAX_TOOL_CALLS, MAX_ITERATIONS - current_iteration),
         ):
             if isinstance(result, dict) and ChatEvent.STATUS in result:
                 yield result[ChatEvent.STATUS]
             elif isinstance(result, InformationCollectionIteration):
-                this_iteration = result
+                next_iterations.append(result)
+        next_iterations = next_iterations or [InformationCollectionIteration(tool=None, query=query)]
+
+        # Terminate research after this step if the planner signalled it has enough information
+        research_complete = any(is_research_complete(iteration) for iteration in next_iterations)
+
+        # Run the tools picked for this step concurrently
+        tools: Dict[int, Callable[[], AsyncGenerator]] = {
+            index: partial(
+                execute_iteration,
+                iteration,
+                current_iteration + index + 1,
+                previous_iterations,
+                user=user,
+                conversation_id=conversation_id,
+                query_images=query_images,
+                agent=agent,
+                send_status_func=send_status_func,
+                location=location,
+                file_filters=file_filters,
+                tracer=tracer,
+                query_files=query_files,
+                request_context=request_context,
+            )
+            for index, iteration in enumerate(next_iterations)
+        }
+        async for result in run_tools_concurrently(tools):
+            if not isinstance(result, InformationCollectionIteration):
+                yield result
+        current_iteration += len(next_iterations)
+
+        # Keep iterations in the order they were planned
+        for iteration in next_iterations:
+            previous_iterations.append(iteration)
+            yield iteration
+
+        if research_complete:
+            break
+
+
+async def execute_iteration(
+    this_iteration: InformationCollectionIteration,
+    iteration_number: int,
+    previous_iterations: List[InformationCollectionIteration],
+    user: RidgeUser,
+    conversation_id: str,
+    query_images: List[str],
+    agent: Agent = None,
+    send_status_func: Optional[Callable] = None,
+    location: LocationData = None,
+    file_filters: List[str] = [],
+    tracer: dict = {},
+    query_files: str = None,
+    request_context: ChatRequestContext = None,
+):
+    "Run the tool of the research iteration. Yields status updates and the iteration with its results once done"
+    online_results: Dict = dict()
+    code_results: Dict = dict()
+    document_results: List[Dict[str, str]] = []
+    summarize_files: str = ""
+
+    # Skip running iteration if warning present in iteration
+    if this_iteration.warning:
+        logger.warning(f"Research mode: {this_iteration.warning}.")
+
+    # Research is terminated by the caller if text tool or query, tool not set for next iteration
+    elif is_research_complete(this_iteration):
+        pass
+
+    elif this_iteration.tool == ConversationCommand.Notes:
+        this_iteration.context = []
+        document_results = []
+        previous_inferred_queries = {
+            c["query"] for iteration in previous_iterations if iteration.context for c in iteration.context
+        }
+        async for result in extract_references_and_questions(
+            user,
+            construct_tool_chat_history(previous_iterations, ConversationCommand.Notes),
+            this_iteration.query,
+            7,
+            None,
+            conversation_id,
+            [ConversationCommand.Default],
+            location,
+            send_status_func,
+            query_images,
+            previous_inferred_queries=previous_inferred_queries,
+            agent=agent,
+            tracer=tracer,
+            query_files=query_files,
+            request_context=request_context,
+        ):
+            if isinstance(result, dict) and ChatEvent.STATUS in result:
+                yield result[ChatEvent.STATUS]
+            elif isinstance(result, tuple):
+                document_results = result[0]
+                this_iteration.context += document_results
 
-        # Skip running iteration if warning present in iteration
-        if this_iteration.warning:
-            logger.warning(f"Research mode: {this_iteration.warning}.")
-
-        # Terminate research if selected text tool or query, tool not set for next iteration
-        elif not this_iteration.query or not this_iteration.tool or this_iteration.tool == ConversationCommand.Text:
-            current_iteration = MAX_ITERATIONS
-
-        elif this_iteration.tool == ConversationCommand.Notes:
-            this_iteration.context = []
-            document_results = []
-            previous_inferred_queries = {
-                c["query"] for iteration in previous_iterations if iteration.context for c in iteration.context
-            }
-            async for result in extract_references_and_questions(
+        if not is_none_or_empty(document_results):
+            try:
+                distinct_files = {d["file"] for d in document_results}
+                distinct_headings = set([d["compiled"].split("\n")[0] for d in document_results if "compiled" in d])
+                # Strip only leading # from headings
+                headings_str = "\n- " + "\n- ".join(distinct_headings).replace("#", "")
+                async for result in send_status_func(
+                    f"**Found {len(distinct_headings)} Notes Across {len(distinct_files)} Files**: {headings_str}"
+                ):
+                    yield result
+            except Exception as e:
+                this_iteration.warning = f"Error extracting document references: {e}"
+                logger.error(this_iteration.warning, exc_info=True)
+
+    elif this_iteration.tool == ConversationCommand.Online:
+        previous_subqueries = {
+            subquery
+            for iteration in previous_iterations
+            if iteration.onlineContext
+            for subquery in iteration.onlineContext.keys()
+        }
+        try:
+            async for result in search_online(
+                this_iteration.query,
+                construct_tool_chat_history(previous_iterations, ConversationCommand.Online),
+                location,
                 user,
-                construct_tool_chat_history(previous_iterations, ConversationCommand.Notes),
+                send_status_func,
+                [],
+                max_webpages_to_read=0,
+                query_images=query_images,
+                previous_subqueries=previous_subqueries,
+                agent=agent,
+                request_context=request_context,
+                tracer=tracer,
+            ):
+                if isinstance(result, dict) and ChatEvent.STATUS in result:
+                    yield result[ChatEvent.STATUS]
+                elif is_none_or_empty(result):
+                    this_iteration.warning = (
+                        "Detected previously run online search queries. Skipping iteration. Try something different."
+                    )
+                else:
+                    online_results: Dict[str, Dict] = result  # type: ignore
+                    this_iteration.onlineContext = online_results
+        except Exception as e:
+            this_iteration.warning = f"Error searching online: {e}"
+            logger.error(this_iteration.warning, exc_info=True)
+
+    elif this_iteration.tool == ConversationCommand.Webpage:
+        try:
+            async for result in read_webpages(
                 this_iteration.query,
-                7,
-                None,
-                conversation_id,
-                [ConversationCommand.Default],
+                construct_tool_chat_history(previous_iterations, ConversationCommand.Webpage),
                 location,
+                user,
                 send_status_func,
-                query_images,
-                previous_inferred_queries=previous_inferred_queries,
+                max_webpages_to_read=1,
+                query_images=query_images,
                 agent=agent,
+                request_context=request_context,
                 tracer=tracer,
                 query_files=query_files,
             ):
                 if isinstance(result, dict) and ChatEvent.STATUS in result:
                     yield result[ChatEvent.STATUS]
-                elif isinstance(result, tuple):
-                    document_results = result[0]
-                    this_iteration.context += document_results
-
-            if not is_none_or_empty(document_results):
-                try:
-                    distinct_files = {d["file"] for d in document_results}
-                    distinct_headings = set([d["compiled"].split("\n")[0] for d in document_results if "compiled" in d])
-                    # Strip only leading # from headings
-                    headings_str = "\n- " + "\n- ".join(distinct_headings).replace("#", "")
-                    async for result in send_status_func(
-                        f"**Found {len(distinct_headings)} Notes Across {len(distinct_files)} Files**: {headings_str}"
-                    ):
-                        yield result
-                except Exception as e:
-                    this_iteration.warning = f"Error extracting document references: {e}"
-                    logger.error(this_iteration.warning, exc_info=True)
-
-        elif this_iteration.tool == ConversationCommand.Online:
-            previous_subqueries = {
-                subquery
-                for iteration in previous_iterations
-                if iteration.onlineContext
-                for subquery in iteration.onlineContext.keys()
-            }
-            try:
-                async for result in search_online(
-                    this_iteration.query,
-                    construct_tool_chat_history(previous_iterations, ConversationCommand.Online),
-                    location,
-                    user,
-                    send_status_func,
-                    [],
-                    max_webpages_to_read=0,
-                    query_images=query_images,
-                    previous_subqueries=previous_subqueries,
-                    agent=agent,
-                    tracer=tracer,
-                ):
-                    if isinstance(result, dict) and ChatEvent.STATUS in result:
-                        yield result[ChatEvent.STATUS]
-                    elif is_none_or_empty(result):
-                        this_iteration.warning = "Detected previously run online search queries. Skipping iteration. Try something different."
-                    else:
-                        online_results: Dict[str, Dict] = result  # type: ignore
-                        this_iteration.onlineContext = online_results
-            except Exception as e:
-                this_iteration.warning = f"Error searching online: {e}"
-                logger.error(this_iteration.warning, exc_info=True)
-
-        elif this_iteration.tool == ConversationCommand.Webpage:
-            try:
-                async for result in read_webpages(
-                    this_iteration.query,
-                    construct_tool_chat_history(previous_iterations, ConversationCommand.Webpage),
-                    location,
-                    user,
-                    send_status_func,
-                    max_webpages_to_read=1,
-                    query_images=query_images,
-                    agent=agent,
-                    tracer=tracer,
-                    query_files=query_files,
-                ):
-                    if isinstance(result, dict) and ChatEvent.STATUS in result:
-                        yield result[ChatEvent.STATUS]
-                    else:
-                        direct_web_pages: Dict[str, Dict] = result  # type: ignore
-
-                        webpages = []
-                        for web_query in direct_web_pages:
-                            if online_results.get(web_query):
-                                online_results[web_query]["webpages"] = direct_web_pages[web_query]["webpages"]
-                            else:
-                                online_results[web_query] = {"webpages": direct_web_pages[web_query]["webpages"]}
-
-                            for webpage in direct_web_pages[web_query]["webpages"]:
-                                webpages.append(webpage["link"])
-                        this_iteration.onlineContext = online_results
-            except Exception as e:
-                this_iteration.warning = f"Error reading webpages: {e}"
-                logger.error(this_iteration.warning, exc_info=True)
-
-        elif this_iteration.tool == ConversationCommand.Code:
-            try:
-                async for result in run_code(
-                    this_iteration.query,
-                    construct_tool_chat_history(previous_iterations, ConversationCommand.Webpage),
-                    "",
-                    location,
-                    user,
-                    send_status_func,
-                    query_images=query_images,
-                    agent=agent,
-                    query_files=query_files,
-                    tracer=tracer,
-                ):
-                    if isinstance(result, dict) and ChatEvent.STATUS in result:
-                        yield result[ChatEvent.STATUS]
-                    else:
-                        code_results: Dict[str, Dict] = result  # type: ignore
-                        this_iteration.codeContext = code_results
-                async for result in send_status_func(f"**Ran code snippets**: {len(this_iteration.codeContext)}"):
-                    yield result
-            except ValueError as e:
-                this_iteration.warning = f"Error running code: {e}"
-                logger.warning(this_iteration.warning, exc_info=True)
+                else:
+                    direct_web_pages: Dict[str, Dict] = result  # type: ignore
+
+                    webpages = []
+                    for web_query in direct_web_pages:
+                        if online_results.get(web_query):
+                            online_results[web_query]["webpages"] = direct_web_pages[web_query]["webpages"]
+                        else:
+                            online_results[web_query] = {"webpages": direct_web_pages[web_query]["webpages"]}
+
+                        for webpage in direct_web_pages[web_query]["webpages"]:
+                            webpages.append(webpage["link"])
+                    this_iteration.onlineContext = online_results
+        except Exception as e:
+            this_iteration.warning = f"Error reading webpages: {e}"
+            logger.error(this_iteration.warning, exc_info=True)
+
+    elif this_iteration.tool == ConversationCommand.Code:
+        try:
+            async for result in run_code(
+                this_iteration.query,
+                construct_tool_chat_history(previous_iterations, ConversationCommand.Webpage),
+                "",
+                location,
+                user,
+                send_status_func,
+                query_images=query_images,
+                agent=agent,
+                query_files=query_files,
+                request_context=request_context,
+                tracer=tracer,
+            ):
+                if isinstance(result, dict) and ChatEvent.STATUS in result:
+                    yield result[ChatEvent.STATUS]
+                else:
+                    code_results: Dict[str, Dict] = result  # type: ignore
+                    this_iteration.codeContext = code_results
+            async for result in send_status_func(f"**Ran code snippets**: {len(this_iteration.codeContext)}"):
+                yield result
+        except ValueError as e:
+            this_iteration.warning = f"Error running code: {e}"
+            logger.warning(this_iteration.warning, exc_info=True)
+
+    elif this_iteration.tool == ConversationCommand.Summarize:
+        try:
+            async for result in generate_summary_from_files(
+                this_iteration.query,
+                user,
+                file_filters,
+                construct_tool_chat_history(previous_iterations),
+                query_images=query_images,
+                agent=agent,
+                send_status_func=send_status_func,
+                query_files=query_files,
+            ):
+                if isinstance(result, dict) and ChatEvent.STATUS in result:
+                    yield result[ChatEvent.STATUS]
+                else:
+                    summarize_files = result  # type: ignore
+        except Exception as e:
+            this_iteration.warning = f"Error summarizing files: {e}"
+            logger.error(this_iteration.warning, exc_info=True)
+
+    if document_results or online_results or code_results or summarize_files or this_iteration.warning:
+        results_data = f"\n<iteration>{iteration_number}\n<tool>{this_iteration.tool}</tool>\n<query>{this_iteration.query}</query>\n<results>"
+        if document_results:
+            results_data += f"\n<document_references>\n{yaml.dump(document_results, allow_unicode=True, sort_keys=False, default_flow_style=False)}\n</document_references>"
+        if online_results:
+            results_data += f"\n<online_results>\n{yaml.dump(online_results, allow_unicode=True, sort_keys=False, default_flow_style=False)}\n</online_results>"
+        if code_results:
+            results_data += f"\n<code_results>\n{yaml.dump(truncate_code_context(code_results), allow_unicode=True, sort_keys=False, default_flow_style=False)}\n</code_results>"
+        if summarize_files:
+            results_data += f"\n<summarized_files>\n{yaml.dump(summarize_files, allow_unicode=True, sort_keys=False, default_flow_style=False)}\n</summarized_files>"
+        if this_iteration.warning:
+            results_data += f"\n<warning>\n{this_iteration.warning}\n</warning>"
+        results_data += "\n</results>\n</iteration>"
 
-        elif this_iteration.tool == ConversationCommand.Summarize:
-            try:
-                async for result in generate_summary_from_files(
-                    this_iteration.query,
-                    user,
-                    file_filters,
-                    construct_tool_chat_history(previous_iterations),
-                    query_images=query_images,
-                    agent=agent,
-                    send_status_func=send_status_func,
-                    query_files=query_files,
-                ):
-                    if isinstance(result, dict) and ChatEvent.STATUS in result:
-                        yield result[ChatEvent.STATUS]
-                    else:
-                        summarize_files = result  # type: ignore
-            except Exception as e:
-                this_iteration.warning = f"Error summarizing files: {e}"
-                logger.error(this_iteration.warning, exc_info=True)
+        # intermediate_result = await extract_relevant_info(this_iteration.query, results_data, agent)
+        this_iteration.summarizedResult = results_data
 
-        else:
-            # No valid tools. This is our exit condition.
-            current_iteration = MAX_ITERATIONS
-
-        current_iteration += 1
-
-        if document_results or online_results or code_results or summarize_files or this_iteration.warning:
-            results_data = f"\n<iteration>{current_iteration}\n<tool>{this_iteration.tool}</tool>\n<query>{this_iteration.query}</query>\n<results>"
-            if document_results:
-                results_data += f"\n<document_references>\n{yaml.dump(document_results, allow_unicode=True, sort_keys=False, default_flow_style=False)}\n</document_references>"
-            if online_results:
-                results_data += f"\n<online_results>\n{yaml.dump(online_results, allow_unicode=True, sort_keys=False, default_flow_style=False)}\n</online_results>"
-            if code_results:
-                results_data += f"\n<code_results>\n{yaml.dump(truncate_code_context(code_results), allow_unicode=True, sort_keys=False, default_flow_style=False)}\n</code_results>"
-            if summarize_files:
-                results_data += f"\n<summarized_files>\n{yaml.dump(summarize_files, allow_unicode=True, sort_keys=False, default_flow_style=False)}\n</summarized_files>"
-            if this_iteration.warning:
-                results_data += f"\n<warning>\n{this_iteration.warning}\n</warning>"
-            results_data += "\n</results>\n</iteration>"
-
-            # intermediate_result = await extract_relevant_info(this_iteration.query, results_data, agent)
-            this_iteration.summarizedResult = results_data
-
-        previous_iterations.append(this_iteration)
-        yield this_iteration
+    yield this_iteration
@@ -119,12 +119,12 @@ async def query(
 
     # Encode the query using the bi-encoder
     if question_embedding is None:
-        with timer("Query Encode Time", logger, state.device):
+        with timer("Query Encode Time", logger, state.device, span="embedding"):
             question_embedding = state.embeddings_model[search_model.name].embed_query(query)
 
     # Find relevant entries for the query
     top_k = 10
-    with timer("Search Time", logger, state.device):
+    with timer("Search Time", logger, state.device, span="sql_search"):
         hits = EntryAdapters.search_with_embeddings(
             raw_query=raw_query,
             embeddings=question_embedding,
@@ -176,6 +176,7 @@ def deduplicated_search_responses(hits: List[SearchResponse]):
                 {
                     "entry": hit.entry,
                     "score": hit.score,
+                    "cross_score": hit.cross_score,
                     "corpus_id": hit.corpus_id,
                     "additional": {
                         "source": hit.additional["source"],
@@ -233,7 +234,7 @@ def setup(
 def cross_encoder_score(query: str, hits: List[SearchResponse], search_model_name: str) -> List[SearchResponse]:
     """Score all retrieved entries using the cross-encoder"""
     try:
-        with timer("Cross-Encoder Predict Time", logger, state.device):
+        with timer("Cross-Encoder Predict Time", logger, state.device, span="rerank"):
             cross_scores = state.cross_encoder_model[search_model_name].predict(query, hits)
     except requests.exceptions.HTTPError as e:
         logger.error(f"Failed to rerank documents using the inference endpoint. Error: {e}.", exc_info=True)
@@ -246,9 +247,9 @@ def cross_encoder_score(query: str, hits: List[SearchResponse], search_model_nam
     return hits
 
 
-def sort_results(rank_results: bool, hits: List[dict]) -> List[dict]:
+def sort_results(rank_results: bool, hits: List[SearchResponse]) -> List[SearchResponse]:
     """Order results by cross-encoder score followed by bi-encoder score"""
-    with timer("Rank Time", logger, state.device):
+    with timer("Rank Time", logger, state.device, span="sort_results"):
         hits.sort(key=lambda x: x["score"])  # sort by bi-encoder score
         if rank_results:
             hits.sort(key=lambda x: x["cross_score"])  # sort by cross-encoder score
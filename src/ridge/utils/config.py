@@ -2,12 +2,17 @@
 from __future__ import annotations  # to avoid quoting type hints
 
 import logging
+import os
 from dataclasses import dataclass
 from enum import Enum
 from typing import TYPE_CHECKING, Any, List, Optional, Union
 
 import torch
 
+from ridge.processor.conversation.offline.scheduler import (
+    OfflineChatScheduler,
+    set_offline_chat_scheduler,
+)
 from ridge.processor.conversation.offline.utils import download_model
 
 logger = logging.getLogger(__name__)
@@ -70,12 +75,29 @@ class OfflineChatProcessorConfig:
 
 
 class OfflineChatProcessorModel:
-    def __init__(self, chat_model: str = "bartowski/Meta-Llama-3.1-8B-Instruct-GGUF", max_tokens: int = None):
+    def __init__(
+        self,
+        chat_model: str = "bartowski/Meta-Llama-3.1-8B-Instruct-GGUF",
+        max_tokens: int = None,
+        instances: int = None,
+    ):
+        from ridge.utils import state
+
         self.chat_model = chat_model
         self.loaded_model = None
+        self.scheduler: OfflineChatScheduler = None
+        # Load multiple instances of the chat model to serve concurrent chat requests
+        instances = instances or int(os.getenv("RIDGE_OFFLINE_CHAT_INSTANCES", 1))
+        state.offline_chat_load_status.update({"instances": instances, "instances_loaded": 0})
         try:
-            self.loaded_model = download_model(self.chat_model, max_tokens=max_tokens)
+            models = []
+            for _ in range(instances):
+                models.append(download_model(self.chat_model, max_tokens=max_tokens))
+                state.offline_chat_load_status["instances_loaded"] = len(models)
+            self.loaded_model = models[0]
         except ValueError as e:
             self.loaded_model = None
             logger.error(f"Error while loading offline chat model: {e}", exc_info=True)
             raise e
+        self.scheduler = OfflineChatScheduler(models)
+        set_offline_chat_scheduler(self.loaded_model, self.scheduler)
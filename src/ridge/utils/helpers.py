@@ -1,5 +1,6 @@
 from __future__ import annotations  # to avoid quoting type hints
 
+import asyncio
 import base64
 import copy
 import datetime
@@ -9,20 +10,35 @@ import logging
 import os
 import platform
 import random
+import threading
 import urllib.parse
 import uuid
 from collections import OrderedDict
+from contextlib import asynccontextmanager
 from enum import Enum
-from functools import lru_cache
+from functools import lru_cache, wraps
 from importlib import import_module
 from importlib.metadata import version
 from itertools import islice
 from os import path
 from pathlib import Path
-from time import perf_counter
-from typing import TYPE_CHECKING, Any, NamedTuple, Optional, Tuple, Union
+from time import monotonic, perf_counter
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    Callable,
+    Dict,
+    Iterable,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 from urllib.parse import ParseResult, urlparse
 
+import aiohttp
 import anthropic
 import openai
 import psutil
@@ -30,6 +46,7 @@ import pyjson5
 import requests
 import torch
 from asgiref.sync import sync_to_async
+from django.db import close_old_connections
 from email_validator import EmailNotValidError, EmailUndeliverableError, validate_email
 from google import genai
 from google.auth.credentials import Credentials
@@ -39,6 +56,7 @@ from PIL import Image
 from pytz import country_names, country_timezones
 
 from ridge.utils import constants
+from ridge.utils.tracing import Span
 
 if TYPE_CHECKING:
     from sentence_transformers import CrossEncoder, SentenceTransformer
@@ -46,6 +64,7 @@ if TYPE_CHECKING:
     from ridge.utils.models import BaseEncoder
     from ridge.utils.rawconfig import AppConfig
 
+logger = logging.getLogger(__name__)
 
 # Initialize Magika for file type identification
 magika = Magika()
@@ -73,6 +92,107 @@ class AsyncIteratorWrapper:
             raise StopAsyncIteration
 
 
+async def run_tools_concurrently(
+    tools: Dict[Any, Callable[[], AsyncGenerator[Any, None]]],
+    dependencies: Mapping[Any, Iterable[Any]] = None,
+) -> AsyncGenerator[Any, None]:
+    """
+    Run async generator tools concurrently and yield their items as they arrive.
+    A tool is only started once all the tools it depends on have finished. Dependencies on tools not being run are ignored.
+    Exceptions raised by a tool are re-raised to the caller and the remaining tools are cancelled.
+    """
+    dependencies = {tool: set(deps) & set(tools) for tool, deps in (dependencies or {}).items() if tool in tools}
+    pending = dict(tools)
+    running: Dict[Any, asyncio.Task] = {}
+    completed: set = set()
+    queue: asyncio.Queue = asyncio.Queue()
+    tool_done = object()
+
+    async def drain(tool, tool_generator_func):
+        try:
+            async for item in tool_generator_func():
+                await queue.put((tool, item, None))
+        except Exception as e:
+            await queue.put((tool, None, e))
+        finally:
+            await queue.put((tool, tool_done, None))
+
+    def start_ready_tools():
+        for tool in list(pending):
+            if dependencies.get(tool, set()) <= completed:
+                running[tool] = asyncio.create_task(drain(tool, pending.pop(tool)))
+
+    try:
+        start_ready_tools()
+        while running:
+            tool, item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is tool_done:
+                running.pop(tool)
+                completed.add(tool)
+                start_ready_tools()
+                continue
+            yield item
+
+        if pending:
+            raise ValueError(f"Could not run tools with unmet dependencies: {list(pending)}")
+    finally:
+        for task in running.values():
+            task.cancel()
+
+
+async def coalesce_chunks(
+    chunks: AsyncGenerator[Any, None], flush_interval: float = 0.03, flush_size: int = 512
+) -> AsyncGenerator[str, None]:
+    """
+    Merge streamed text chunks into larger chunks to reduce the number of writes to the client.
+    Buffered text is yielded once it reaches flush_size bytes or flush_interval seconds after its first chunk arrived.
+    The chunks are read in a separate task, so the stream is drained even when the caller stops consuming it.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    end_of_stream = object()
+    loop = asyncio.get_running_loop()
+
+    async def read_chunks():
+        try:
+            async for chunk in chunks:
+                if chunk is not None:
+                    queue.put_nowait(f"{chunk}")
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(end_of_stream)
+
+    reader = asyncio.create_task(read_chunks())
+    buffer: list[str] = []
+    buffer_size = 0
+    flush_at: Optional[float] = None
+    while True:
+        try:
+            timeout = None if flush_at is None else max(flush_at - loop.time(), 0)
+            item = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            item = None
+
+        if item is end_of_stream or isinstance(item, Exception):
+            break
+        if item is not None:
+            buffer.append(item)
+            buffer_size += len(item.encode("utf-8"))
+            flush_at = flush_at or loop.time() + flush_interval
+
+        if buffer and (item is None or buffer_size >= flush_size or loop.time() >= flush_at):
+            yield "".join(buffer)
+            buffer, buffer_size, flush_at = [], 0, None
+
+    if buffer:
+        yield "".join(buffer)
+    if isinstance(item, Exception):
+        raise item
+    await reader
+
+
 def is_none_or_empty(item):
     return item == None or (hasattr(item, "__iter__") and len(item) == 0) or item == ""
 
@@ -183,20 +303,50 @@ def get_class_by_name(name: str) -> object:
     return getattr(import_module(module_name), class_name)
 
 
-class timer:
-    """Context manager to log time taken for a block of code to run"""
+def clean_connections(func):
+    """
+    A decorator that ensures that Django database connections that have become unusable, or are obsolete, are closed
+    before and after a method is executed (see: https://docs.djangoproject.com/en/dev/ref/databases/#general-notes
+    for background).
+    """
+
+    @wraps(func)
+    def func_wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+        return result
 
-    def __init__(self, message: str, logger: logging.Logger, device: torch.device = None, log_level=logging.DEBUG):
+    return func_wrapper
+
+
+class timer:
+    """Context manager to log and trace time taken for a block of code to run"""
+
+    def __init__(
+        self,
+        message: str,
+        logger: logging.Logger,
+        device: torch.device = None,
+        log_level=logging.DEBUG,
+        span: str = None,
+    ):
         self.message = message
         self.logger = logger.debug if log_level == logging.DEBUG else logger.info
         self.device = device
+        self.span = Span(span or message)
 
     def __enter__(self):
+        self.span.__enter__()
         self.start = perf_counter()
         return self
 
-    def __exit__(self, *_):
+    def __exit__(self, *exc_info):
         elapsed = perf_counter() - self.start
+        self.span.__exit__(*exc_info)
         if self.device is None:
             self.logger(f"{self.message}: {elapsed:.3f} seconds")
         else:
@@ -220,6 +370,100 @@ class LRU(OrderedDict):
             del self[oldest]
 
 
+class TTLCache:
+    """
+    Thread-safe LRU cache with entries that expire after their time to live (in seconds).
+    Tracks cache hits and misses to measure its effectiveness.
+    """
+
+    def __init__(self, capacity=128, ttl: float = 3600):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = LRU(capacity=capacity)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                value, expires_at = self._entries[key]
+                if monotonic() < expires_at:
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._entries[key] = (value, monotonic() + (ttl if ttl is not None else self.ttl))
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class HttpClientPool:
+    """
+    Share a pooled HTTP client session across requests to external services.
+    Reuses connections, TLS sessions and DNS lookups to the same hosts, with a limit on connections per host.
+
+    The shared session is bound to the server event loop it is opened on.
+    Code running on other event loops, e.g in worker threads, gets a temporary session closed after use.
+    """
+
+    def __init__(
+        self, limit: int = 100, limit_per_host: int = 10, dns_cache_ttl: int = 300, keepalive_timeout: float = 30
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    async def open(self):
+        "Open the shared session on the running event loop. Call on server startup"
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+            self._loop = asyncio.get_running_loop()
+
+    async def close(self):
+        "Close the shared session and its connections. Call on server shutdown"
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session, self._loop = None, None
+
+    @asynccontextmanager
+    async def session(self) -> AsyncGenerator[aiohttp.ClientSession, None]:
+        if self._session is not None and not self._session.closed and self._loop is asyncio.get_running_loop():
+            yield self._session
+        else:
+            async with self._create_session() as session:
+                yield session
+
+
 def get_server_id():
     """Get, Generate Persistent, Random ID per server install.
     Helps count distinct ridge servers deployed.
@@ -494,12 +738,65 @@ def is_valid_url(url: str) -> bool:
         return False
 
 
+class ConnectivityMonitor:
+    """
+    Check internet connectivity periodically in a background thread.
+    Callers read the last known connectivity state without waiting on the network.
+    Assumes the server is connected until the first check completes. A stopped monitor is not restarted.
+    """
+
+    def __init__(self, url: str = "https://www.google.com", interval: float = 60, timeout: float = 5, offline=False):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.offline = offline
+        self.connected = not offline
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def probe(self) -> bool:
+        try:
+            response = requests.head(self.url, timeout=self.timeout)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            connected = self.probe()
+            if connected != self.connected:
+                logger.info(f"Internet connectivity changed. Connected: {connected}")
+            self.connected = connected
+            self._stop.wait(self.interval)
+
+    def start(self):
+        with self._lock:
+            if self.offline or self._stop.is_set() or (self._thread and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._run, name="connectivity-monitor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_connected(self) -> bool:
+        if self.offline:
+            return False
+        self.start()
+        return self.connected
+
+
+# Set RIDGE_OFFLINE to disable all internet access by the server, e.g online search, web page reading
+connectivity_monitor = ConnectivityMonitor(
+    url=os.getenv("RIDGE_CONNECTIVITY_CHECK_URL", "https://www.google.com"),
+    interval=float(os.getenv("RIDGE_CONNECTIVITY_CHECK_INTERVAL", 60)),
+    offline=is_env_var_true("RIDGE_OFFLINE"),
+)
+
+
 def is_internet_connected():
-    try:
-        response = requests.head("https://www.google.com")
-        return response.status_code == 200
-    except:
-        return False
+    return connectivity_monitor.is_connected()
 
 
 def is_internal_url(url: str) -> bool:
@@ -562,6 +859,9 @@ def truncate_code_context(original_code_results: dict[str, Any], max_chars=10000
     # Create a deep copy of the code results to avoid modifying the original data
     code_results = copy.deepcopy(original_code_results)
     for code_result in code_results.values():
+        # Skip code results already truncated to text
+        if not isinstance(code_result, dict):
+            continue
         for idx, output_file in enumerate(code_result["results"]["output_files"]):
             # Drop image files from code results
             if Path(output_file["filename"]).suffix in {".png", ".jpg", ".jpeg", ".webp"}:
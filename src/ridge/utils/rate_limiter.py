@@ -0,0 +1,207 @@
+"""
+Rate limit requests by user in process with sliding windows.
+
+Requests are counted in memory and saved to the UserRequests table in the background.
+Workers sync the request counts of a user from the database periodically.
+Configure a shared Redis cache via RIDGE_RATE_LIMIT_CACHE_URL to share request counts across workers immediately.
+The Redis cache requires the redis extra, i.e pip install 'ridge[redis]'.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+
+from ridge.database.models import UserRequests
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_FLUSH_INTERVAL = float(os.getenv("RIDGE_RATE_LIMIT_FLUSH_INTERVAL", 10))
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("RIDGE_RATE_LIMIT_SYNC_INTERVAL", 60))
+RATE_LIMIT_CACHE_ALIAS = "ratelimit"
+
+
+@dataclass
+class RequestWindow:
+    "Timestamps of recent requests by a user for a rate limit and when they were last synced with the database"
+
+    timestamps: Deque[float] = field(default_factory=deque)
+    synced_at: float = -math.inf
+
+
+class SlidingWindowRateLimiter:
+    """
+    Count requests by user and rate limit slug over sliding time windows.
+    Counts are checked and updated in memory. New requests are saved to the database in batches.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = RATE_LIMIT_FLUSH_INTERVAL,
+        sync_interval: float = RATE_LIMIT_SYNC_INTERVAL,
+        cache_alias: Optional[str] = None,
+    ):
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self.cache_alias = cache_alias
+        self._windows: Dict[Tuple[int, str], RequestWindow] = {}
+        self._window_durations: Dict[Tuple[int, str], float] = {}
+        self._pending: List[Tuple[int, str, float]] = []
+        self._flushing: List[Tuple[int, str, float]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def check_and_record(self, user_id: int, slug: str, window: float, limit: int) -> Tuple[bool, int]:
+        """
+        Record request if the user made less than limit requests for the slug in the last window seconds.
+        Return whether the request is allowed and the number of requests made in the window before it.
+        """
+        if self.cache_alias:
+            return self._check_and_record_in_cache(user_id, slug, window, limit)
+        if self._needs_sync(user_id, slug):
+            self._sync(user_id, slug, window, limit)
+        return self._check_and_record(user_id, slug, window, limit)
+
+    async def acheck_and_record(self, user_id: int, slug: str, window: float, limit: int) -> Tuple[bool, int]:
+        if self.cache_alias:
+            return await sync_to_async(self._check_and_record_in_cache)(user_id, slug, window, limit)
+        if self._needs_sync(user_id, slug):
+            await sync_to_async(self._sync)(user_id, slug, window, limit)
+        return self._check_and_record(user_id, slug, window, limit)
+
+    def _needs_sync(self, user_id: int, slug: str) -> bool:
+        request_window = self._windows.get((user_id, slug))
+        return request_window is None or time.monotonic() - request_window.synced_at > self.sync_interval
+
+    def _sync(self, user_id: int, slug: str, window: float, limit: int):
+        "Load recent requests by the user from the database to count requests handled by other workers"
+        cutoff = datetime.fromtimestamp(time.time() - window, tz=timezone.utc)
+        saved_timestamps = [
+            created_at.timestamp()
+            for created_at in UserRequests.objects.filter(user_id=user_id, slug=slug, created_at__gte=cutoff)
+            .order_by("-created_at")
+            .values_list("created_at", flat=True)[:limit]
+        ]
+        with self._lock:
+            # Add requests recorded by this worker that are not saved to the database yet
+            unsaved_timestamps = [
+                timestamp
+                for request_user_id, request_slug, timestamp in self._flushing + self._pending
+                if (request_user_id, request_slug) == (user_id, slug)
+            ]
+            timestamps = sorted(saved_timestamps + unsaved_timestamps)
+            self._windows[(user_id, slug)] = RequestWindow(deque(timestamps), synced_at=time.monotonic())
+
+    def _check_and_record(self, user_id: int, slug: str, window: float, limit: int) -> Tuple[bool, int]:
+        now = time.time()
+        with self._lock:
+            request_window = self._windows.setdefault((user_id, slug), RequestWindow(synced_at=time.monotonic()))
+            self._window_durations[(user_id, slug)] = window
+            timestamps = request_window.timestamps
+            # Forget requests outside of the time window
+            while timestamps and timestamps[0] <= now - window:
+                timestamps.popleft()
+
+            count = len(timestamps)
+            if count >= limit:
+                return False, count
+            timestamps.append(now)
+            self._pending.append((user_id, slug, now))
+
+        self._start()
+        return True, count
+
+    def _check_and_record_in_cache(self, user_id: int, slug: str, window: float, limit: int) -> Tuple[bool, int]:
+        """
+        Count requests in a cache shared by workers. Approximates the sliding window count by weighing the
+        request count of the previous fixed window by its overlap with the sliding window.
+        """
+        cache = caches[self.cache_alias]
+        now = time.time()
+        current_window = int(now // window)
+        current_key = f"ratelimit:{user_id}:{slug}:{current_window}"
+        previous_key = f"ratelimit:{user_id}:{slug}:{current_window - 1}"
+        counts = cache.get_many([current_key, previous_key])
+        elapsed = (now % window) / window
+        count = math.floor(counts.get(previous_key, 0) * (1 - elapsed) + counts.get(current_key, 0))
+        if count >= limit:
+            return False, count
+
+        cache.add(current_key, 0, timeout=math.ceil(2 * window))
+        cache.incr(current_key)
+        with self._lock:
+            self._pending.append((user_id, slug, now))
+        self._start()
+        return True, count
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rate-limit-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to save rate limited requests: {e}", exc_info=True)
+
+    def flush(self):
+        "Save requests recorded since the last flush to the database and forget request windows that are idle"
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, []
+                self._forget_idle_windows()
+            if not self._flushing:
+                return
+
+            close_old_connections()
+            try:
+                # Requests are saved with the time of the flush, at most a flush interval after they were made
+                UserRequests.objects.bulk_create(
+                    [UserRequests(user_id=user_id, slug=slug) for user_id, slug, _ in self._flushing]
+                )
+            except Exception:
+                # Retry saving the requests on the next flush
+                with self._lock:
+                    self._pending = self._flushing + self._pending
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = []
+                close_old_connections()
+
+    async def aflush(self):
+        await sync_to_async(self.flush)()
+
+    def _forget_idle_windows(self):
+        now = time.time()
+        idle_keys = [
+            key
+            for key, request_window in self._windows.items()
+            if not request_window.timestamps
+            or request_window.timestamps[-1] <= now - self._window_durations.get(key, 0)
+        ]
+        for key in idle_keys:
+            del self._windows[key]
+            self._window_durations.pop(key, None)
+
+
+def create_rate_limiter() -> SlidingWindowRateLimiter:
+    cache_alias = RATE_LIMIT_CACHE_ALIAS if RATE_LIMIT_CACHE_ALIAS in settings.CACHES else None
+    return SlidingWindowRateLimiter(cache_alias=cache_alias)
@@ -1,18 +1,23 @@
 import os
-import threading
 from collections import defaultdict
 from pathlib import Path
 from typing import Any, Dict, List
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from openai import OpenAI
-from whisper import Whisper
 
 from ridge.database.models import ProcessLock
 from ridge.processor.embeddings import CrossEncoderModel, EmbeddingsModel
 from ridge.utils import config as utils_config
 from ridge.utils.config import OfflineChatProcessorModel, SearchModels
-from ridge.utils.helpers import LRU, get_device, is_env_var_true
+from ridge.utils.helpers import (
+    LRU,
+    HttpClientPool,
+    TTLCache,
+    get_device,
+    is_env_var_true,
+)
+from ridge.utils.rate_limiter import SlidingWindowRateLimiter, create_rate_limiter
 from ridge.utils.rawconfig import FullConfig
 
 # Application Global State
@@ -22,7 +27,7 @@ embeddings_model: Dict[str, EmbeddingsModel] = None
 cross_encoder_model: Dict[str, CrossEncoderModel] = None
 openai_client: OpenAI = None
 offline_chat_processor_config: OfflineChatProcessorModel = None
-whisper_model: Whisper = None
+offline_chat_load_status: Dict[str, Any] = {"status": "not_loaded"}
 config_file: Path = None
 verbose: int = 0
 host: str = None
@@ -30,7 +35,29 @@ port: int = None
 ssl_config: Dict[str, str] = None
 cli_args: List[str] = None
 query_cache: Dict[str, LRU] = defaultdict(LRU)
-chat_lock = threading.Lock()
+llm_response_cache = TTLCache(capacity=1000, ttl=int(os.getenv("RIDGE_LLM_RESPONSE_CACHE_TTL", 60 * 60)))
+llm_response_cache_stats: Dict[str, Dict[str, float]] = defaultdict(lambda: {"hits": 0, "misses": 0, "saved_cost": 0.0})
+server_config_cache = TTLCache(capacity=16, ttl=int(os.getenv("RIDGE_SERVER_CONFIG_CACHE_TTL", 60)))
+auth_cache = TTLCache(
+    capacity=int(os.getenv("RIDGE_AUTH_CACHE_SIZE", 10000)), ttl=int(os.getenv("RIDGE_AUTH_CACHE_TTL", 60))
+)
+online_search_cache = TTLCache(
+    capacity=int(os.getenv("RIDGE_ONLINE_SEARCH_CACHE_SIZE", 1000)),
+    ttl=int(os.getenv("RIDGE_ONLINE_SEARCH_CACHE_TTL", 15 * 60)),
+)
+webpage_cache = TTLCache(
+    capacity=int(os.getenv("RIDGE_WEBPAGE_CACHE_SIZE", 500)), ttl=int(os.getenv("RIDGE_WEBPAGE_CACHE_TTL", 60 * 60))
+)
+webpage_revalidation_cache = TTLCache(capacity=int(os.getenv("RIDGE_WEBPAGE_CACHE_SIZE", 500)), ttl=24 * 60 * 60)
+document_summary_cache = TTLCache(
+    capacity=int(os.getenv("RIDGE_DOCUMENT_SUMMARY_CACHE_SIZE", 1000)),
+    ttl=int(os.getenv("RIDGE_DOCUMENT_SUMMARY_CACHE_TTL", 24 * 60 * 60)),
+)
+http_client_pool = HttpClientPool(
+    limit=int(os.getenv("RIDGE_HTTP_POOL_SIZE", 100)),
+    limit_per_host=int(os.getenv("RIDGE_HTTP_POOL_SIZE_PER_HOST", 10)),
+)
+rate_limiter: SlidingWindowRateLimiter = create_rate_limiter()
 SearchType = utils_config.SearchType
 scheduler: BackgroundScheduler = None
 schedule_leader_process_lock: ProcessLock = None
@@ -40,7 +67,6 @@ ridge_version: str = None
 device = get_device()
 chat_on_gpu: bool = True
 anonymous_mode: bool = False
-pretrained_tokenizers: Dict[str, Any] = dict()
 billing_enabled: bool = (
     os.getenv("STRIPE_API_KEY") is not None
     and os.getenv("STRIPE_SIGNING_SECRET") is not None
@@ -0,0 +1,258 @@
+"""
+Trace time spent in each stage of handling a request.
+
+Spans are exported in the background to a JSON lines file at RIDGE_TRACE_FILE
+and/or to an OpenTelemetry collector accepting OTLP over HTTP at RIDGE_OTLP_ENDPOINT.
+Tracing is disabled when neither is set.
+"""
+
+import inspect
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Dict, List, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE = os.getenv("RIDGE_TRACE_FILE")
+OTLP_ENDPOINT = os.getenv("RIDGE_OTLP_ENDPOINT")
+TRACE_EXPORT_QUEUE_SIZE = int(os.getenv("RIDGE_TRACE_EXPORT_QUEUE_SIZE", 10000))
+
+
+class Trace:
+    "Spans of a request and the request, user, conversation ids shared by them"
+
+    def __init__(self, **attributes):
+        self.trace_id = secrets.token_hex(16)
+        self.attributes: Dict[str, Any] = attributes
+        self.spans: List["Span"] = []
+        self.finished = False
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    Context manager to trace time taken for a stage of a request to run.
+    The first span of a request starts its trace. Spans of a trace are exported once its first span ends.
+    """
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes: Dict[str, Any] = attributes
+        self.span_id = secrets.token_hex(8)
+        self.parent_id: Optional[str] = None
+        self.trace: Optional[Trace] = None
+        self.start_time_ns = 0
+        self.end_time_ns = 0
+        self.error: Optional[str] = None
+
+    def __enter__(self):
+        if not span_exporter.enabled:
+            return self
+
+        self.trace = current_trace.get()
+        if self.trace is None or self.trace.finished:
+            self.trace = Trace()
+            self._trace_token = current_trace.set(self.trace)
+        else:
+            self._trace_token = None
+        parent = current_span.get()
+        self.parent_id = parent.span_id if parent and parent.trace is self.trace else None
+        self._span_token = current_span.set(self)
+        self.start_time_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, _):
+        if self.trace is None:
+            return
+        self.end_time_ns = time.time_ns()
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+
+        reset_context_var(current_span, self._span_token)
+        if self._trace_token is not None:
+            reset_context_var(current_trace, self._trace_token)
+            self.trace.finished = True
+            span_exporter.export(self.trace.spans + [self])
+        elif self.trace.finished:
+            span_exporter.export([self])
+        else:
+            self.trace.spans.append(self)
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self) -> float:
+        "Duration of the span in seconds"
+        return (self.end_time_ns - self.start_time_ns) / 1e9
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time_ns / 1e9,
+            "duration": self.duration,
+            "attributes": {**self.trace.attributes, **self.attributes},
+            "error": self.error,
+        }
+
+
+def reset_context_var(context_var: ContextVar, token):
+    # Generators can exit a span in a different context than they entered it
+    try:
+        context_var.reset(token)
+    except ValueError:
+        context_var.set(token.old_value if token.old_value is not token.MISSING else None)
+
+
+def set_trace_attributes(**attributes):
+    "Set attributes, like the user or conversation id, on all spans of the current request"
+    trace = current_trace.get()
+    if trace is not None:
+        trace.attributes.update({key: value for key, value in attributes.items() if value is not None})
+
+
+def traced(name: str):
+    "Decorator to trace time taken by a function to run"
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with Span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class SpanExporter:
+    """
+    Export spans in the background to a JSON lines file and/or an OTLP collector.
+    Spans are dropped when the export queue is full to never slow down requests.
+    """
+
+    def __init__(
+        self,
+        trace_file: Optional[str] = None,
+        otlp_endpoint: Optional[str] = None,
+        max_queue_size: int = 10000,
+        batch_size: int = 512,
+        flush_interval: float = 1.0,
+    ):
+        self.trace_file = trace_file
+        self.otlp_endpoint = f"{otlp_endpoint.rstrip('/')}/v1/traces" if otlp_endpoint else None
+        self.enabled = bool(trace_file or otlp_endpoint)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped_spans = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self, spans: List[Span]):
+        self._start()
+        for span in spans:
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                self.dropped_spans += 1
+                if self.dropped_spans % 1000 == 1:
+                    logger.warning(f"Dropped {self.dropped_spans} trace spans as the export queue is full")
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            spans = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(spans) < self.batch_size and (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    spans.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.flush([span.to_dict() for span in spans])
+
+    def flush(self, spans: List[Dict[str, Any]]):
+        if self.trace_file:
+            try:
+                with open(self.trace_file, "a", encoding="utf-8") as trace_file:
+                    trace_file.writelines(json.dumps(span, default=str) + "\n" for span in spans)
+            except Exception as e:
+                logger.warning(f"Failed to write trace spans to {self.trace_file}: {e}")
+        if self.otlp_endpoint:
+            try:
+                requests.post(self.otlp_endpoint, json=to_otlp(spans), timeout=10).raise_for_status()
+            except Exception as e:
+                logger.warning(f"Failed to export trace spans to {self.otlp_endpoint}: {e}")
+
+
+def to_otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    elif isinstance(value, int):
+        return {"intValue": str(value)}
+    elif isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    "Convert spans to the OTLP JSON format"
+    otlp_spans = []
+    for span in spans:
+        start_time_ns = int(span["start_time"] * 1e9)
+        otlp_span = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(start_time_ns),
+            "endTimeUnixNano": str(start_time_ns + int(span["duration"] * 1e9)),
+            "attributes": [{"key": key, "value": to_otlp_value(value)} for key, value in span["attributes"].items()],
+            "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = span["parent_id"]
+        otlp_spans.append(otlp_span)
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "ridge"}}]},
+                "scopeSpans": [{"scope": {"name": "ridge"}, "spans": otlp_spans}],
+            }
+        ]
+    }
+
+
+span_exporter = SpanExporter(TRACE_FILE, OTLP_ENDPOINT, max_queue_size=TRACE_EXPORT_QUEUE_SIZE)
@@ -50,6 +50,16 @@ def enable_db_access_for_all_tests(db):
     pass
 
 
+@pytest.fixture(autouse=True)
+def clear_server_config_cache():
+    # Cached server configuration rows and authenticated users do not outlive the test database transaction
+    state.server_config_cache.clear()
+    state.auth_cache.clear()
+    yield
+    state.server_config_cache.clear()
+    state.auth_cache.clear()
+
+
 @pytest.fixture(scope="session")
 def search_config() -> SearchConfig:
     state.embeddings_model = dict()
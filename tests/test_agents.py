@@ -22,6 +22,20 @@ def test_create_default_agent(default_user: RidgeUser):
     assert agent.managed_by_admin == True
 
 
+def test_default_agent_cache_cleared_on_save(default_user: RidgeUser):
+    # Arrange
+    ChatModelFactory()
+    agent = AgentAdapters.create_default_agent(default_user)
+    assert AgentAdapters.get_default_agent() == agent
+
+    # Act
+    agent.personality = "Updated personality"
+    agent.save()
+
+    # Assert
+    assert AgentAdapters.get_default_agent().personality == "Updated personality"
+
+
 @pytest.mark.anyio
 @pytest.mark.django_db(transaction=True)
 async def test_create_or_update_agent(default_user: RidgeUser, default_openai_chat_model_option: ChatModel):
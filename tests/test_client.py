@@ -1,5 +1,6 @@
 # Standard Modules
 import os
+from types import SimpleNamespace
 from urllib.parse import quote
 
 import pytest
@@ -8,12 +9,18 @@ from fastapi.testclient import TestClient
 from PIL import Image
 
 from ridge.configure import configure_routes, configure_search_types
-from ridge.database.adapters import EntryAdapters
+from ridge.database.adapters import ConversationAdapters, EntryAdapters
 from ridge.database.models import RidgeApiUser, RidgeUser
 from ridge.processor.content.org_mode.org_to_entries import OrgToEntries
+from ridge.processor.conversation.offline.scheduler import (
+    OfflineChatScheduler,
+    set_offline_chat_scheduler,
+)
+from ridge.processor.conversation.utils import message_to_log
 from ridge.search_type import text_search
 from ridge.utils import state
 from ridge.utils.rawconfig import ContentConfig, SearchConfig
+from tests.helpers import ConversationFactory
 
 
 # Test
@@ -471,6 +478,60 @@ async def test_chat_with_unauthenticated_user(chat_client_with_auth, api_user2:
     assert no_auth_response.status_code == 403
 
 
+# ----------------------------------------------------------------------------------------------------
+@pytest.mark.django_db(transaction=True)
+def test_chat_history_returns_latest_legacy_and_appended_messages(client, api_user: RidgeApiUser):
+    # Arrange
+    headers = {"Authorization": "Bearer kk-secret"}
+    conversation = ConversationFactory(
+        user=api_user.user,
+        conversation_log={
+            "chat": message_to_log("Hello", "Hi there", {"created": "2025-04-28 10:00:00"}, conversation_log=[])
+        },
+    )
+    ConversationAdapters.append_conversation_messages(
+        conversation, message_to_log("How are you?", "Doing well", conversation_log=[])
+    )
+
+    # Act
+    response = client.get(f"/api/chat/history?conversation_id={conversation.id}&n=3", headers=headers)
+    all_messages_response = client.get(f"/api/chat/history?conversation_id={conversation.id}", headers=headers)
+
+    # Assert
+    assert response.status_code == 200
+    assert [chat["message"] for chat in response.json()["response"]["chat"]] == [
+        "Hi there",
+        "How are you?",
+        "Doing well",
+    ]
+    assert len(all_messages_response.json()["response"]["chat"]) == 4
+
+
+# ----------------------------------------------------------------------------------------------------
+class OfflineChatModelStub:
+    "Stand in for a loaded offline chat model"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_health_check_reports_offline_chat_scheduler_stats(client, monkeypatch):
+    # Arrange
+    headers = {"Authorization": "Bearer kk-secret"}
+    offline_chat_model = OfflineChatModelStub()
+    monkeypatch.setattr(state, "offline_chat_processor_config", SimpleNamespace(loaded_model=offline_chat_model))
+    scheduler = OfflineChatScheduler([offline_chat_model])
+    set_offline_chat_scheduler(offline_chat_model, scheduler)
+    with scheduler.acquire():
+        pass
+
+    # Act
+    response = client.get("/api/health", headers=headers)
+
+    # Assert
+    assert response.status_code == 200
+    assert response.json()["offline_chat_scheduler"] == scheduler.stats()
+    assert response.json()["offline_chat_scheduler"]["requests"] == 1
+
+
 def get_sample_files_data():
     return [
         ("files", ("path/to/filename.org", "* practicing piano", "text/org")),
@@ -1,4 +1,7 @@
+import time
+
 import tiktoken
+from git import Repo
 from langchain.schema import ChatMessage
 
 from ridge.processor.conversation import utils
@@ -104,6 +107,147 @@ class TestTruncateMessage:
         assert truncated_chat_history[0] != copy_big_chat_message
 
 
+def test_chat_history_keeps_latest_turns_within_max_prompt_size():
+    # Arrange
+    conversation_log = {"chat": []}
+    for index in range(100):
+        utils.message_to_log(
+            f"Question {index}",
+            f"Answer {index}",
+            {"created": "2025-04-28 10:00:00"},
+            conversation_log=conversation_log["chat"],
+        )
+
+    # Act
+    messages = utils.generate_chatml_messages_with_context(
+        "Latest question", "System message", conversation_log, model_name="gpt-4o-mini", max_prompt_size=50
+    )
+
+    # Assert
+    assert messages[0].role == "system"
+    assert messages[-1].content == "Latest question"
+    assert messages[-2].content == "Answer 99"
+    assert "Answer 0" not in [message.content for message in messages]
+
+
+def test_tokenizer_registry_resolves_tokenizer_once():
+    # Arrange
+    registry = utils.TokenizerRegistry()
+
+    # Act
+    encoder, tokenizer_key = registry.get("gpt-4o-mini")
+    cached_encoder, cached_tokenizer_key = registry.get("gpt-4o-mini")
+    fallback_encoder, _ = registry.get("unknown-chat-model")
+
+    # Assert
+    assert encoder is cached_encoder
+    assert tokenizer_key == cached_tokenizer_key == f"tiktoken:{encoder.name}"
+    assert fallback_encoder.name == tiktoken.encoding_for_model(registry.default_tokenizer).name
+
+
+def test_pack_context_collapses_near_duplicates_within_budget():
+    # Arrange
+    note = "The Great Chicago Fire burned from October 8 to 10, 1871 and destroyed much of the city."
+    references = [
+        {"query": "fire", "compiled": note, "file": "fire.md"},
+        {"query": "chicago", "compiled": f"# {note}", "file": "chicago.md"},
+        {"query": "fire", "compiled": "Fire trucks were pulled by horses. " * 200, "file": "trucks.md"},
+    ]
+    online_results = {
+        "fire": {"organic": [{"title": "Fire", "link": "https://example.com/1", "snippet": note}]},
+        "chicago": {"organic": [{"title": "Chicago", "link": "https://example.com/2", "snippet": note}]},
+    }
+
+    # Act
+    packed = utils.pack_context(references, online_results, {}, "gpt-4o-mini", max_prompt_size=1000)
+
+    # Assert
+    # Near-duplicate notes, online results are collapsed and notes truncated to fit within the notes budget
+    assert [reference["file"] for reference in packed.references] == ["fire.md", "trucks.md"]
+    assert list(packed.online_results.keys()) == ["fire"]
+    assert 0 < packed.tokens["notes"] <= 250
+    assert packed.tokens["code"] == 0
+
+
+def test_pack_context_keeps_truncated_oversized_top_code_result():
+    # Arrange
+    code_results = {
+        "plot fire spread": {
+            "code": "print('Fire spread across the city. ' * 500)",
+            "results": {"success": True, "std_out": "Fire spread across the city. " * 500, "output_files": []},
+        },
+        "count fire trucks": {
+            "code": "print(42)",
+            "results": {"success": True, "std_out": "42", "output_files": []},
+        },
+    }
+
+    # Act
+    packed = utils.pack_context([], {}, code_results, "gpt-4o-mini", max_prompt_size=1000)
+
+    # Assert
+    # Oversized top code result is truncated to fit within the code budget instead of being dropped
+    assert list(packed.code_results.keys()) == ["plot fire spread"]
+    assert packed.tokens["code"] == 100
+    assert packed.code_results["plot fire spread"].startswith("code: print('Fire spread across the city. ' * 500)")
+    assert utils.truncate_code_context(packed.code_results) == packed.code_results
+
+
+def test_prompt_trace_writer_saves_conversation_traces_in_background(tmp_path):
+    # Arrange
+    repo_path = str(tmp_path / "promptrace")
+    tracer = {"uid": 1, "cid": 2, "mid": 3}
+    session = [ChatMessage(role="user", content="What is the capital of France?")]
+
+    # Act
+    utils.commit_conversation_trace(session, "Query: capital of France", tracer, repo_path=repo_path)
+    tracer["usage"] = {"cost": 0.1}
+    utils.commit_conversation_trace(session, "Paris", tracer, repo_path=repo_path)
+    utils.merge_message_into_conversation_trace(session[0].content, "Paris", tracer, repo_path=repo_path)
+    utils.prompt_trace_writer.flush()
+
+    # Assert
+    # Each conversation step is committed to the message branch, which is then merged into the conversation branch
+    repo = Repo(repo_path)
+    assert {head.name for head in repo.heads} >= {"u_1", "c_2"}
+    assert "m_3" not in repo.heads
+    assert len(list(repo.iter_commits("c_2"))) == 4
+    assert len(repo.commit("c_2").parents) == 2
+    # Tracer updates after a step is queued are not saved with that step
+    assert "cost: 0.1" in repo.commit("c_2^2").message
+    assert "cost" not in repo.commit("c_2^2~1").message
+
+
+def test_prompt_trace_writer_saves_spilled_traces_in_order(tmp_path):
+    # Arrange
+    class RecordingTraceWriter(utils.PromptTraceWriter):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.saved_traces = []
+
+        def _write(self, traces):
+            time.sleep(0.01)
+            self.saved_traces += [trace["step"] for trace in traces]
+
+    writer = RecordingTraceWriter(max_queue_size=2, batch_size=1)
+    repo_path = str(tmp_path / "promptrace")
+
+    # Act
+    for step in range(20):
+        writer.put({"type": "commit", "repo_path": repo_path, "tracer": {}, "step": step})
+        if step == 9:
+            # Let the queue drain some traces before queuing more
+            time.sleep(0.05)
+    deadline = time.monotonic() + 10
+    while len(writer.saved_traces) < 20 and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    # Assert
+    # Traces queued after the queue is full are spilled and saved after the traces queued before them
+    assert writer.dropped_traces == 0
+    assert writer.saved_traces == list(range(20))
+
+
 def test_load_complex_raw_json_string():
     # Arrange
     raw_json = r"""{"key": "value with unescaped " and unescaped \' and escaped \" and escaped \\'"}"""
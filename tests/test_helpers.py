@@ -1,17 +1,64 @@
+import asyncio
+import json
+import logging
 import os
 import secrets
+import struct
+import threading
+import time
+from datetime import datetime, timezone
 
 import numpy as np
 import psutil
 import pytest
+from aiohttp import web
+from asgiref.sync import sync_to_async
+from django.db import connection, connections
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
 from scipy.stats import linregress
+from starlette.requests import Request
 
+from ridge.configure import (
+    AsyncCloseConnectionsMiddleware,
+    UserAuthenticationBackend,
+    configure_routes,
+)
+from ridge.database.models import (
+    ChatModel,
+    RidgeApiUser,
+    RidgeUser,
+    Subscription,
+    UserRequests,
+)
+from ridge.processor.conversation.offline.scheduler import (
+    OfflineChatCancelled,
+    OfflineChatScheduler,
+)
+from ridge.processor.conversation.offline.utils import (
+    download_model,
+    get_model_context_window,
+    get_prompt_cache,
+    read_gguf_metadata,
+)
+from ridge.processor.conversation.offline.whisper import detect_speech_segments
 from ridge.processor.embeddings import EmbeddingsModel
 from ridge.processor.tools.online_search import (
+    html_to_markdown,
     read_webpage_at_url,
     read_webpage_with_olostep,
+    search_with_cache,
 )
-from ridge.utils import helpers
+from ridge.routers import helpers as router_helpers
+from ridge.routers.api import execute_search
+from ridge.routers.helpers import (
+    group_summaries_by_tokens,
+    reduce_document_summaries,
+    split_documents_into_chunks,
+)
+from ridge.utils import helpers, state, tracing
+from ridge.utils.rate_limiter import SlidingWindowRateLimiter
+from ridge.utils.rawconfig import LocationData
 
 
 def test_get_from_null_dict():
@@ -59,6 +106,25 @@ def test_lru_cache():
     assert cache == {"b": 2, "d": 4}
 
 
+def test_ttl_cache():
+    # Test get cached item and track cache hits, misses
+    cache = helpers.TTLCache(capacity=2, ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.hit_rate == 0.5
+
+    # Test expired item is not returned
+    cache.set("b", 2, ttl=0)
+    assert cache.get("b") is None
+
+    # Test capacity overflow
+    cache.set("c", 3)
+    cache.set("d", 4)
+    assert len(cache) == 2
+    assert cache.get("a") is None
+
+
 @pytest.mark.skip(reason="Memory leak exists on GPU, MPS devices")
 def test_encode_docs_memory_leak():
     # Arrange
@@ -87,6 +153,131 @@ def test_encode_docs_memory_leak():
     assert slope < 2, f"Memory leak suspected on {device}. Memory usage increased at ~{slope:.2f} MB per iteration"
 
 
+@pytest.mark.asyncio
+async def test_run_tools_concurrently_respects_dependencies():
+    # Arrange
+    events = []
+
+    def make_tool(name: str, delay: float):
+        async def tool():
+            events.append(f"start {name}")
+            await asyncio.sleep(delay)
+            yield name
+            events.append(f"end {name}")
+
+        return tool
+
+    tools = {"notes": make_tool("notes", 0.05), "online": make_tool("online", 0.01), "code": make_tool("code", 0)}
+
+    # Act
+    results = [item async for item in helpers.run_tools_concurrently(tools, {"code": {"notes", "online", "webpage"}})]
+
+    # Assert
+    # Independent tools start together and yield results as they complete
+    assert events[:2] == ["start notes", "start online"]
+    assert results == ["online", "notes", "code"]
+    # Dependent tool only starts after its dependencies finish
+    assert events.index("start code") > events.index("end notes")
+
+
+@pytest.mark.asyncio
+async def test_coalesce_chunks_by_size_and_time():
+    # Arrange
+    async def stream():
+        for token in ["a", "b", None, "c", "dd"]:
+            yield token
+        await asyncio.sleep(0.1)
+        yield "e"
+
+    # Act
+    results = [chunk async for chunk in helpers.coalesce_chunks(stream(), flush_interval=0.05, flush_size=3)]
+
+    # Assert
+    # Chunks are merged until the size limit, flushed after the time limit and none are dropped
+    assert results == ["abc", "dd", "e"]
+
+
+@pytest.mark.asyncio
+async def test_search_with_cache_reuses_results_for_same_search():
+    # Arrange
+    state.online_search_cache.clear()
+    searches = []
+    location = LocationData(city="Paris", region=None, country="France", country_code="FR")
+
+    async def search(query, location):
+        searches.append(query)
+        return query, {"organic": [{"link": f"https://example.com/{len(searches)}"}]}
+
+    # Act
+    _, first_result = await search_with_cache("Test", search, "news", location)
+    first_result["organic"][0]["content"] = "updated by caller"
+    _, second_result = await search_with_cache("Test", search, "news", location)
+    await search_with_cache("Test", search, "news", None)
+
+    # Assert
+    # Same search is only run once per location and cached results are not changed by callers
+    assert searches == ["news", "news"]
+    assert second_result == {"organic": [{"link": "https://example.com/1"}]}
+
+
+def test_connectivity_monitor_reads_last_known_state():
+    # Arrange
+    probe_started = threading.Event()
+    release_probe = threading.Event()
+
+    def slow_failing_probe():
+        probe_started.set()
+        release_probe.wait(timeout=5)
+        return False
+
+    monitor = helpers.ConnectivityMonitor(interval=60)
+    monitor.probe = slow_failing_probe
+    offline_monitor = helpers.ConnectivityMonitor(offline=True)
+
+    # Act
+    connected_during_check = monitor.is_connected()
+    probe_started.wait(timeout=5)
+    release_probe.set()
+    monitor.stop()
+    monitor._thread.join(timeout=5)
+
+    # Assert
+    # Connectivity check does not block callers. Connectivity is assumed until the first check completes
+    assert connected_during_check
+    assert not monitor.is_connected()
+    # Stopped monitor is not restarted by reading its connectivity state
+    assert not monitor._thread.is_alive()
+    # Offline mode does not check connectivity
+    assert not offline_monitor.is_connected()
+    assert offline_monitor._thread is None
+
+
+def test_html_to_markdown_strips_boilerplate_within_budget():
+    # Arrange
+    html = """
+    <html><head><style>p { color: red; }</style></head>
+    <body><nav>Home | About</nav><h1>Great Fire</h1><p>The fire <b>burned</b> for days.</p>
+    <script>track()</script><footer>Copyright</footer></body></html>
+    """
+
+    form_html = '<body><form id="form1"><h1>Population report</h1><p>The city has 2.7M residents.</p></form></body>'
+    links_html = '<h2>Specs</h2><p>See <a href="https://x.org/spec">the spec</a>.</p><ul><li>RAM: 16GB</li></ul>'
+
+    # Act
+    content = html_to_markdown(html)
+    form_content = html_to_markdown(form_html)
+    links_content = html_to_markdown(links_html)
+    truncated_content = html_to_markdown(f"<p>{'word ' * 10000}</p>", max_chars=100)
+
+    # Assert
+    assert content == "Great Fire\n==========\n\nThe fire **burned** for days.\n\n\nCopyright"
+    # Content of pages wrapped in a form is kept
+    assert form_content == "Population report\n=================\n\nThe city has 2.7M residents."
+    # Links, headings and lists are converted to markdown
+    assert links_content == "Specs\n-----\n\nSee [the spec](https://x.org/spec).\n\n* RAM: 16GB"
+    assert len(truncated_content) == 100
+
+
 @pytest.mark.asyncio
 async def test_reading_webpage():
     # Arrange
@@ -102,6 +293,40 @@ async def test_reading_webpage():
     )
 
 
+@pytest.mark.asyncio
+async def test_reading_webpage_without_charset_in_content_type():
+    # Arrange
+    pages = {
+        "/utf8": "<html><body><p>Café in Zürich</p></body></html>".encode("utf-8"),
+        "/latin1": '<html><head><meta charset="iso-8859-1"></head><body><p>Café in Zürich</p></body></html>'.encode(
+            "latin-1"
+        ),
+    }
+
+    async def serve_page(request: web.Request) -> web.Response:
+        return web.Response(body=pages[request.path], headers={"Content-Type": "text/html"})
+
+    app = web.Application()
+    app.router.add_get("/{page}", serve_page)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    # Act
+    try:
+        utf8_content = await read_webpage_at_url(f"http://127.0.0.1:{port}/utf8")
+        latin1_content = await read_webpage_at_url(f"http://127.0.0.1:{port}/latin1")
+    finally:
+        await runner.cleanup()
+
+    # Assert
+    # Web pages are decoded with their meta charset, else as utf-8
+    assert utf8_content == "Café in Zürich"
+    assert latin1_content == "Café in Zürich"
+
+
 @pytest.mark.skipif(os.getenv("OLOSTEP_API_KEY") is None, reason="OLOSTEP_API_KEY is not set")
 @pytest.mark.asyncio
 async def test_reading_webpage_with_olostep():
@@ -116,3 +341,405 @@ async def test_reading_webpage_with_olostep():
         "An alarm sent from the area near the fire also failed to register at the courthouse where the fire watchmen were"
         in response
     )
+
+
+@pytest.mark.asyncio
+async def test_http_client_pool_shares_session_on_opened_event_loop():
+    # Arrange
+    pool = helpers.HttpClientPool(limit_per_host=2)
+    async with pool.session() as temporary_session:
+        pass
+
+    # Act
+    await pool.open()
+    async with pool.session() as first_session, pool.session() as second_session:
+        shared = first_session is second_session
+    await pool.close()
+
+    # Assert
+    # Sessions are only shared once opened on the event loop and closed on shutdown
+    assert temporary_session.closed
+    assert shared
+    assert first_session.closed
+
+
+def test_split_documents_into_chunks_by_tokens():
+    # Arrange
+    chat_model = ChatModel(name="gpt-4o-mini")
+    documents = {"fire.md": "The fire burned for days. " * 100, "short.md": "The fire is out."}
+
+    # Act
+    chunks = split_documents_into_chunks(documents, chat_model, max_tokens=200)
+
+    # Assert
+    # Each document is split into chunks within the token limit that together contain the whole document
+    fire_chunks = [chunk for chunk in chunks if chunk.file_name == "fire.md"]
+    assert len(fire_chunks) > 1
+    assert [chunk.index for chunk in fire_chunks] == list(range(fire_chunks[0].total))
+    assert [(chunk.file_name, chunk.index, chunk.total) for chunk in chunks[-1:]] == [("short.md", 0, 1)]
+    assert all(chunk.tokens <= 200 for chunk in chunks)
+    assert "".join(chunk.text for chunk in fire_chunks) == documents["fire.md"]
+    # Chunks are identified by the hash of their text to reuse their summaries
+    assert len({chunk.text_hash for chunk in chunks}) == len({chunk.text for chunk in chunks})
+
+
+def test_group_summaries_by_tokens():
+    # Act
+    groups = group_summaries_by_tokens([40, 40, 40, 40, 40, 40, 40], max_tokens=100)
+    oversized_groups = group_summaries_by_tokens([150, 150, 150], max_tokens=100)
+
+    # Assert
+    # Consecutive summaries are grouped within the token limit, with at least two summaries per group
+    assert groups == [(0, 2), (2, 4), (4, 7)]
+    assert oversized_groups == [(0, 3)]
+
+
+@pytest.mark.asyncio
+async def test_reduce_document_summaries_in_rounds_within_token_limit(monkeypatch):
+    # Arrange
+    class WordEncoder:
+        def encode(self, text):
+            return text.split()
+
+    prompts = []
+
+    async def combine_summaries(prompt, system_message, **kwargs):
+        prompts.append(prompt)
+        return "The fire burned for days. " * 6
+
+    monkeypatch.setattr(router_helpers.tokenizer_registry, "get", lambda *args, **kwargs: (WordEncoder(), "words"))
+    monkeypatch.setattr(router_helpers, "send_message_to_model_wrapper", combine_summaries)
+    summary = "The fire burned for days and destroyed much of the city. " * 5
+    summaries = [(f"File: fire.md, Part {index} of 20",) * 2 + (summary,) for index in range(1, 21)]
+
+    # Act
+    contextual_data = await reduce_document_summaries(
+        summaries, 200, ChatModel(name="gpt-4o-mini"), asyncio.Semaphore(4), user=None
+    )
+
+    # Assert
+    # Summaries are combined in groups within the token limit until they all fit in a single prompt
+    assert len(contextual_data.split()) <= 200
+    assert len(prompts) == 7 + 2
+    assert "to File: fire.md, Part 6 of 20" in prompts[-2]
+    assert contextual_data.startswith("File: fire.md, Part 1 of 20 to File: fire.md, Part 12 of 20")
+
+
+def test_timer_exports_nested_spans_with_trace_attributes(tmp_path, monkeypatch):
+    # Arrange
+    trace_file = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "span_exporter", tracing.SpanExporter(str(trace_file), flush_interval=0.01))
+    logger = logging.getLogger(__name__)
+
+    # Act
+    with helpers.timer("Handle request", logger, span="request"):
+        with helpers.timer("Search took", logger, span="search"):
+            tracing.set_trace_attributes(user_id="test-user")
+
+    # Wait for spans to be exported in the background
+    for _ in range(100):
+        if trace_file.exists() and len(trace_file.read_text().splitlines()) == 2:
+            break
+        time.sleep(0.05)
+    search_span, request_span = [json.loads(line) for line in trace_file.read_text().splitlines()]
+
+    # Assert
+    # Spans of a trace are linked and carry the trace attributes set while handling the request
+    assert (search_span["name"], request_span["name"]) == ("search", "request")
+    assert search_span["trace_id"] == request_span["trace_id"]
+    assert search_span["parent_id"] == request_span["span_id"]
+    assert request_span["parent_id"] is None
+    assert search_span["attributes"]["user_id"] == request_span["attributes"]["user_id"] == "test-user"
+    assert request_span["duration"] >= search_span["duration"]
+
+
+def test_offline_chat_scheduler_serves_requests_in_order():
+    # Arrange
+    scheduler = OfflineChatScheduler(["model-1", "model-2"])
+    served = []
+    threads = []
+
+    def request(name: str):
+        with scheduler.acquire() as model:
+            served.append((name, model))
+            time.sleep(0.05)
+
+    # Act
+    with scheduler.acquire() as first_model, scheduler.acquire() as second_model:
+        all_models_busy = scheduler.busy_instances == 2
+        for name in ["first", "second", "third"]:
+            threads.append(threading.Thread(target=request, args=(name,)))
+            threads[-1].start()
+            # Wait for request to be queued before sending the next one
+            while scheduler.queue_depth < len(threads):
+                time.sleep(0.01)
+        with pytest.raises(OfflineChatCancelled):
+            with scheduler.acquire(cancelled=lambda: True):
+                pass
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # Assert
+    # Requests wait for a free model instance and are served first come, first served
+    assert all_models_busy and {first_model, second_model} == {"model-1", "model-2"}
+    assert [name for name, _ in served] == ["first", "second", "third"]
+    # Cancelled requests stop waiting and queue metrics are tracked
+    stats = scheduler.stats()
+    assert (stats["requests"], stats["cancelled_requests"], stats["queue_depth"], stats["busy_instances"]) == (
+        5,
+        1,
+        0,
+        0,
+    )
+    assert stats["max_wait_time"] > 0
+
+
+def test_read_gguf_metadata_without_loading_model(tmp_path):
+    # Arrange
+    def gguf_string(value: str) -> bytes:
+        return struct.pack("<Q", len(value)) + value.encode()
+
+    metadata = [
+        gguf_string("general.architecture") + struct.pack("<I", 8) + gguf_string("llama"),
+        gguf_string("tokenizer.ggml.tokens") + struct.pack("<IIQ", 9, 8, 2) + gguf_string("<s>") + gguf_string("hi"),
+        gguf_string("tokenizer.ggml.token_type") + struct.pack("<IIQ", 9, 5, 2) + struct.pack("<ii", 3, 1),
+        gguf_string("llama.context_length") + struct.pack("<II", 4, 8192),
+        gguf_string("llama.rope.freq_base") + struct.pack("<If", 6, 0.5),
+    ]
+    model_path = tmp_path / "model.gguf"
+    model_path.write_bytes(b"GGUF" + struct.pack("<IQQ", 3, 0, len(metadata)) + b"".join(metadata))
+
+    # Act
+    model_metadata = read_gguf_metadata(str(model_path))
+
+    # Assert
+    # Scalar values are read and arrays, like the vocabulary, are skipped
+    assert model_metadata == {
+        "general.architecture": "llama",
+        "llama.context_length": 8192,
+        "llama.rope.freq_base": 0.5,
+    }
+    assert get_model_context_window(model_metadata) == 8192
+
+
+def test_prompt_cache_reuses_state_of_longest_prompt_prefix():
+    # Arrange
+    class ModelState:
+        def __init__(self, name: str, llama_state_size: int, scores_size: int):
+            self.name = name
+            self.llama_state_size = llama_state_size
+            self.scores = np.zeros(scores_size, dtype=np.uint8)
+
+    prompt_cache = get_prompt_cache("test/model-GGUF", n_ctx=512)
+    prompt_cache.cache.capacity_bytes = 10
+    system_prompt = [1, 2, 3]
+
+    # Act
+    prompt_cache[system_prompt] = ModelState("system", 2, 1)
+    prompt_cache[system_prompt + [4, 5]] = ModelState("turn 1", 3, 2)
+    matched_state = prompt_cache[system_prompt + [4, 5, 6, 7]]
+    prompt_cache[[8, 9]] = ModelState("other", 2, 2)
+
+    # Assert
+    # Prompt cache is shared by instances of a model and returns the state of the longest matching prompt prefix
+    assert get_prompt_cache("test/model-GGUF", n_ctx=512) is prompt_cache
+    assert matched_state.name == "turn 1"
+    # Least recently used states are evicted to keep the model states and their logits within the cache capacity
+    assert [state.name for state in prompt_cache.cache.cache_state.values()] == ["turn 1", "other"]
+    assert prompt_cache.cache_size == 9
+
+
+def test_download_model_caps_context_window_missing_from_metadata(monkeypatch):
+    # Arrange
+    class LlamaStub:
+        loaded_n_ctx: list = []
+
+        def __init__(self, model_path, n_ctx, **kwargs):
+            self.context_window = n_ctx or 32768
+            self.loaded_n_ctx.append(n_ctx)
+
+        def n_ctx(self):
+            return self.context_window
+
+        def close(self):
+            pass
+
+    offline_utils = "ridge.processor.conversation.offline.utils"
+    monkeypatch.setattr("llama_cpp.llama.Llama", LlamaStub)
+    monkeypatch.setattr(f"{offline_utils}.load_model_from_cache", lambda repo_id, filename: "model.gguf")
+    monkeypatch.setattr(f"{offline_utils}.read_gguf_metadata", lambda model_path: {})
+    monkeypatch.setattr(f"{offline_utils}.get_prompt_cache", lambda repo_id, n_ctx: None)
+    monkeypatch.setattr(state, "chat_on_gpu", False)
+    monkeypatch.setattr(state, "offline_chat_load_status", {})
+
+    # Act
+    chat_model = download_model("test/model-GGUF", max_tokens=2048)
+
+    # Assert
+    # Model without context window in its metadata is reloaded with the context size capped by the configured size
+    assert LlamaStub.loaded_n_ctx == [0, 2048]
+    assert chat_model.n_ctx() == 2048
+
+
+def test_detect_speech_segments_splits_audio_at_pauses():
+    # Arrange
+    sample_rate = 16000
+    rng = np.random.default_rng(0)
+
+    def sound(duration: float, volume: float) -> np.ndarray:
+        return (volume * rng.standard_normal(int(duration * sample_rate))).astype(np.float32)
+
+    # Speech with a short pause, a long pause and then a long monologue
+    audio = np.concatenate(
+        [sound(1, 0.001), sound(2, 0.1), sound(0.3, 0.001), sound(1, 0.1), sound(2, 0.001), sound(70, 0.1)]
+    )
+
+    # Act
+    segments = detect_speech_segments(audio, sample_rate=sample_rate)
+
+    # Assert
+    # Short pauses do not split speech, long pauses do
+    assert len(segments) >= 4
+    first_start, first_end = segments[0]
+    assert 0.7 < first_start / sample_rate < 1.0 and 4.3 < first_end / sample_rate < 4.6
+    # Long speech is split to fit whisper's 30 second window and no speech is dropped
+    assert all(end - start <= 30 * sample_rate for start, end in segments)
+    assert all(segments[i][1] <= segments[i + 1][0] + 0.4 * sample_rate for i in range(len(segments) - 1))
+    assert segments[-1][1] == len(audio)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sliding_window_rate_limiter_counts_requests_in_memory(default_user: RidgeUser):
+    # Arrange
+    UserRequests.objects.create(user=default_user, slug="chat_minute")
+    rate_limiter = SlidingWindowRateLimiter(flush_interval=60)
+    another_worker = SlidingWindowRateLimiter(flush_interval=60)
+
+    # Act
+    results = [rate_limiter.check_and_record(default_user.id, "chat_minute", window=60, limit=3) for _ in range(3)]
+    saved_before_flush = UserRequests.objects.filter(user=default_user, slug="chat_minute").count()
+    rate_limiter.flush()
+    saved_after_flush = UserRequests.objects.filter(user=default_user, slug="chat_minute").count()
+    other_worker_result = another_worker.check_and_record(default_user.id, "chat_minute", window=60, limit=3)
+    short_window_results = [
+        rate_limiter.check_and_record(default_user.id, "burst", window=0.1, limit=1) for _ in range(2)
+    ]
+    time.sleep(0.15)
+    after_window_result = rate_limiter.check_and_record(default_user.id, "burst", window=0.1, limit=1)
+
+    # Assert
+    # Requests saved earlier are counted and requests over the limit are not recorded
+    assert results == [(True, 1), (True, 2), (False, 3)]
+    # Requests are saved to the database in batches and counted by other workers
+    assert (saved_before_flush, saved_after_flush) == (1, 3)
+    assert other_worker_result == (False, 3)
+    # Requests outside of the sliding window are not counted
+    assert short_window_results == [(True, 0), (False, 1)]
+    assert after_window_result == (True, 0)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_authentication_caches_user_until_token_or_subscription_changes(api_user: RidgeApiUser, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(state, "billing_enabled", True)
+    monkeypatch.setattr(state, "anonymous_mode", False)
+    backend = await sync_to_async(UserAuthenticationBackend)()
+    token_request = Request(
+        {"type": "http", "headers": [(b"authorization", b"Bearer kk-secret")], "session": {}, "query_string": b""}
+    )
+
+    async def authenticate():
+        credentials, user = await backend.authenticate(token_request)
+        return credentials.scopes, user.is_authenticated, state.auth_cache.hits
+
+    # Act
+    first_auth = await authenticate()
+    cached_auth = await authenticate()
+    subscription = await Subscription.objects.aget(user=api_user.user_id)
+    subscription.is_recurring, subscription.renewal_date = False, datetime(2020, 1, 1, tzinfo=timezone.utc)
+    await subscription.asave()
+    auth_after_subscription_change = await authenticate()
+    await RidgeApiUser.objects.filter(token="kk-secret").adelete()
+    auth_after_token_delete = await authenticate()
+
+    # Assert
+    # Authenticated user is cached and reused
+    assert first_auth[:2] == cached_auth[:2] == (["authenticated", "premium"], True)
+    assert cached_auth[2] == first_auth[2] + 1
+    # Cached user is dropped when their subscription changes or their token is deleted
+    assert auth_after_subscription_change[:2] == (["authenticated"], True)
+    assert auth_after_token_delete[:2] == ([], False)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_close_connections_middleware_releases_connection_after_streamed_response(default_user: RidgeUser):
+    # Arrange
+    sent_messages = []
+    connection_open_during_request = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        for username in await sync_to_async(list)(RidgeUser.objects.values_list("username", flat=True)):
+            await send({"type": "http.response.body", "body": username.encode(), "more_body": True})
+        connection_open_during_request.append(await sync_to_async(lambda: connection.connection is not None)())
+        await send({"type": "http.response.body", "body": b""})
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent_messages.append(message)
+
+    # Act
+    await AsyncCloseConnectionsMiddleware(app)({"type": "http", "path": "/"}, receive, send)
+    connection_open_after_request = await sync_to_async(lambda: connection.connection is not None)()
+
+    # Assert
+    # Streamed response is passed through as is
+    assert [message.get("body") for message in sent_messages[1:]] == [default_user.username.encode(), b""]
+    # Database connection used by the request is released once the response is sent
+    assert connection_open_during_request == [True]
+    assert connection_open_after_request is False
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_endpoints_release_connection_on_their_threadpool_thread(default_user: RidgeUser):
+    # Arrange
+    app = FastAPI()
+    endpoint_connections = []
+
+    @app.get("/usernames")
+    def get_usernames():
+        endpoint_connections.append(connections["default"])
+        return list(RidgeUser.objects.values_list("username", flat=True))
+
+    configure_routes(app)
+
+    # Act
+    response = TestClient(app).get("/usernames")
+
+    # Assert
+    # Database connection used by the sync endpoint on its threadpool thread is released after the endpoint returns
+    assert response.json() == [default_user.username]
+    assert endpoint_connections[0].connection is None
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_cancelled_document_search_stops_before_encoding_query(default_user: RidgeUser):
+    # Arrange
+    search_checks = []
+
+    def cancelled():
+        search_checks.append(True)
+        return True
+
+    # Act
+    results = await execute_search(default_user, "speculative query", cancelled=cancelled)
+
+    # Assert
+    # Cancelled search returns no results without encoding the query or searching documents
+    assert results == []
+    assert search_checks == [True]
@@ -0,0 +1,193 @@
+import json
+
+import pytest
+
+from ridge.database.models import RidgeUser
+from ridge.processor.conversation.utils import InformationCollectionIteration
+from ridge.routers import research
+from ridge.routers.research import (
+    PlanningResponse,
+    apick_next_tool,
+    execute_information_collection,
+    is_research_complete,
+)
+from ridge.utils.helpers import ConversationCommand
+
+
+class PlannerStub:
+    "Respond to research planner calls with the given responses, in order. Records the response schema of each call"
+
+    def __init__(self, responses: list):
+        self.responses = [json.dumps(response) for response in responses]
+        self.response_schemas: list = []
+
+    async def __call__(self, query, response_schema=None, **kwargs):
+        self.response_schemas.append(response_schema)
+        return self.responses.pop(0)
+
+
+class ToolRunnerStub:
+    "Run research iterations without running their tools. Records the iteration number of each iteration run"
+
+    def __init__(self):
+        self.iteration_numbers: list = []
+
+    async def __call__(self, iteration, iteration_number, previous_iterations, **kwargs):
+        self.iteration_numbers.append(iteration_number)
+        iteration.summarizedResult = f"Results of {iteration.tool} for {iteration.query}"
+        yield iteration
+
+
+# Test
+# ----------------------------------------------------------------------------------------------------
+def test_parallel_planning_response_schema_limits_tool_calls_to_tool_options():
+    # Arrange
+    tool_options = {"Notes": "notes", "Online": "online"}
+
+    # Act
+    schema = PlanningResponse.create_parallel_model_with_enum(tool_options, max_tool_calls=3).model_json_schema()
+    tool_call_schema = schema["$defs"][schema["properties"]["tool_calls"]["items"]["$ref"].split("/")[-1]]
+    tool_enum_schema = schema["$defs"][tool_call_schema["properties"]["tool"]["$ref"].split("/")[-1]]
+
+    # Assert
+    assert set(schema["required"]) == {"scratchpad", "tool_calls"}
+    assert "Up to 3 independent tool calls" in schema["properties"]["tool_calls"]["description"]
+    assert set(tool_call_schema["required"]) == {"tool", "query"}
+    assert tool_enum_schema["enum"] == ["notes", "online"]
+
+
+# ----------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize(
+    "tool, query, warning, expected_complete",
+    [
+        (ConversationCommand.Online, "weather in Paris", None, False),
+        (ConversationCommand.Notes, "trip plans", None, False),
+        (ConversationCommand.Text, "final answer", None, True),
+        (None, "final answer", None, True),
+        (ConversationCommand.Online, None, None, True),
+        ("unknown tool", "weather in Paris", None, True),
+        (None, None, "Failed to infer information sources to refer", False),
+    ],
+)
+def test_is_research_complete(tool, query, warning, expected_complete):
+    # Arrange
+    iteration = InformationCollectionIteration(tool=tool, query=query, warning=warning)
+
+    # Act & Assert
+    assert is_research_complete(iteration) == expected_complete
+
+
+# ----------------------------------------------------------------------------------------------------
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_pick_next_tool_yields_iteration_per_parallel_tool_call(default_user: RidgeUser, monkeypatch):
+    # Arrange
+    planner = PlannerStub(
+        [
+            {
+                "scratchpad": "Search online and run code in parallel",
+                "tool_calls": [
+                    {"tool": "online", "query": "population of Paris"},
+                    {"tool": "code", "query": "plot population of Paris"},
+                    {"tool": "online", "query": "population of Paris"},
+                ],
+            }
+        ]
+    )
+    monkeypatch.setattr(research, "send_message_to_model_wrapper", planner)
+
+    # Act
+    iterations = [
+        result
+        async for result in apick_next_tool(
+            "How many people live in Paris?", {"chat": []}, default_user, max_tool_calls=3
+        )
+    ]
+
+    # Assert
+    # Planner picks tool calls from the parallel planning schema
+    assert "tool_calls" in planner.response_schemas[0].model_fields
+    # An iteration is yielded per tool call, in order. Repeated tool calls are flagged to be skipped
+    assert [(iteration.tool, iteration.query) for iteration in iterations] == [
+        ("online", "population of Paris"),
+        ("code", "plot population of Paris"),
+        ("online", "population of Paris"),
+    ]
+    assert [iteration.warning is None for iteration in iterations] == [True, True, False]
+
+
+# ----------------------------------------------------------------------------------------------------
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_research_runs_parallel_tool_calls_as_separate_iterations(default_user: RidgeUser, monkeypatch):
+    # Arrange
+    monkeypatch.setenv("RIDGE_RESEARCH_ITERATIONS", "4")
+    monkeypatch.setenv("RIDGE_RESEARCH_PARALLEL_TOOL_CALLS", "2")
+    planner = PlannerStub(
+        [
+            {
+                "scratchpad": "Search online and notes",
+                "tool_calls": [{"tool": "online", "query": "q1"}, {"tool": "notes", "query": "q2"}],
+            },
+            {
+                "scratchpad": "Read web page and run code",
+                "tool_calls": [{"tool": "webpage", "query": "q3"}, {"tool": "code", "query": "q4"}],
+            },
+        ]
+    )
+    tool_runner = ToolRunnerStub()
+    monkeypatch.setattr(research, "send_message_to_model_wrapper", planner)
+    monkeypatch.setattr(research, "execute_iteration", tool_runner)
+
+    # Act
+    results = [
+        result
+        async for result in execute_information_collection(default_user, "Research query", None, {"chat": []}, [])
+    ]
+    iterations = [result for result in results if isinstance(result, InformationCollectionIteration)]
+
+    # Assert
+    # Each research step plans up to two tool calls. Each tool call counts as an iteration
+    assert len(planner.response_schemas) == 2
+    assert all("tool_calls" in schema.model_fields for schema in planner.response_schemas)
+    assert sorted(tool_runner.iteration_numbers) == [1, 2, 3, 4]
+    # Iterations are returned in the order they were planned
+    assert [iteration.query for iteration in iterations] == ["q1", "q2", "q3", "q4"]
+
+
+# ----------------------------------------------------------------------------------------------------
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_research_picks_one_tool_per_iteration_by_default(default_user: RidgeUser, monkeypatch):
+    # Arrange
+    monkeypatch.delenv("RIDGE_RESEARCH_PARALLEL_TOOL_CALLS", raising=False)
+    planner = PlannerStub(
+        [
+            {"scratchpad": "Search online", "tool": "online", "query": "q1"},
+            {"scratchpad": "Run code", "tool": "code", "query": "q2"},
+            {"scratchpad": "Enough information collected", "tool": "text", "query": "Respond"},
+        ]
+    )
+    tool_runner = ToolRunnerStub()
+    monkeypatch.setattr(research, "send_message_to_model_wrapper", planner)
+    monkeypatch.setattr(research, "execute_iteration", tool_runner)
+
+    # Act
+    results = [
+        result
+        async for result in execute_information_collection(default_user, "Research query", None, {"chat": []}, [])
+    ]
+    iterations = [result for result in results if isinstance(result, InformationCollectionIteration)]
+
+    # Assert
+    # Planner picks a single tool per research step with the single tool planning schema
+    assert len(planner.response_schemas) == 3
+    assert all("tool" in schema.model_fields for schema in planner.response_schemas)
+    assert not any("tool_calls" in schema.model_fields for schema in planner.response_schemas)
+    # Research stops once the planner picks the text tool
+    assert tool_runner.iteration_numbers == [1, 2, 3]
+    assert [(iteration.tool, iteration.query) for iteration in iterations] == [
+        ("online", "q1"),
+        ("code", "q2"),
+        ("text", "Respond"),
+    ]
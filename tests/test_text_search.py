@@ -7,7 +7,7 @@ from pathlib import Path
 import pytest
 
 from ridge.database.adapters import EntryAdapters
-from ridge.database.models import Entry, GithubConfig, RidgeUser, LocalOrgConfig
+from ridge.database.models import Entry, EntryStats, GithubConfig, RidgeUser, LocalOrgConfig
 from ridge.processor.content.docx.docx_to_entries import DocxToEntries
 from ridge.processor.content.github.github_to_entries import GithubToEntries
 from ridge.processor.content.images.image_to_entries import ImageToEntries
@@ -444,6 +444,32 @@ def test_update_index_with_deleted_file(
     EntryAdapters.delete_all_entries(default_user)
 
 
+# ----------------------------------------------------------------------------------------------------
+@pytest.mark.django_db
+def test_entry_stats_track_added_and_deleted_entries(search_config: SearchConfig, default_user: RidgeUser):
+    # Arrange
+    file_to_index = "test"
+    new_entry = "* TODO A Chihuahua doing Tango\n- Saw a super cute video of a chihuahua doing the Tango on Youtube\n"
+
+    # Act
+    text_search.setup(OrgToEntries, {file_to_index: new_entry}, regenerate=True, user=default_user)
+    stats_after_add = EntryStats.objects.get(user=default_user, file_type="org")
+    indexed_compiled = Entry.objects.filter(user=default_user, file_type="org").values_list("compiled", flat=True)
+
+    text_search.setup(OrgToEntries, {file_to_index: ""}, regenerate=False, user=default_user)
+    stats_after_delete = EntryStats.objects.get(user=default_user, file_type="org")
+
+    # Assert
+    assert stats_after_add.num_entries == len(indexed_compiled)
+    assert stats_after_add.size_in_bytes == sum(len(compiled.encode("utf-8")) for compiled in indexed_compiled)
+    assert stats_after_delete.num_entries == 0
+    assert stats_after_delete.size_in_bytes == 0
+
+    # Rebuilt stats should match the trigger maintained stats
+    EntryAdapters.rebuild_entry_stats(default_user)
+    assert EntryAdapters.get_indexed_data_stats_by_file_type(default_user).get("org") is None
+
+
 # ----------------------------------------------------------------------------------------------------
 @pytest.mark.skipif(os.getenv("GITHUB_PAT_TOKEN") is None, reason="GITHUB_PAT_TOKEN not set")
 def test_text_search_setup_github(content_config: ContentConfig, default_user: RidgeUser):